@@ -9,18 +9,24 @@ log = fibbingnode.log
 class CrossOptimizer(object):
     def __init__(self, solver):
         self.solver = solver
+        self.stats = _u.SolverStats()
 
-    def solve(self, graph, requirements):
-        lsas = self.solver.solve(graph, requirements)
-        grouped_lsas = collections.defaultdict(list)
-        # Group the LSAs by fakenodes
-        for lsa in lsas:
-            grouped_lsas[(lsa.node, lsa.nh)].append((lsa.cost, lsa.dest))
-        # Build and aggregate LSA from these groups
-        reduced_lsas = [_u.ExtendedLSA(node, nh,
-                                       [_u.ExtLSARoute(dest=d, cost=c)
-                                        for c, d in dests])
-                        for (node, nh), dests in grouped_lsas.iteritems()]
+    def solve(self, graph, requirements, **kw):
+        lsas = self.solver.solve(graph, requirements, **kw)
+        # Extend the stats of the solver with the aggregation
+        self.stats = getattr(self.solver, 'stats', None) or _u.SolverStats()
+        with self.stats.phase('cross_optimize'):
+            grouped_lsas = collections.defaultdict(list)
+            # Group the LSAs by fakenodes
+            for lsa in lsas:
+                grouped_lsas[(lsa.node, lsa.nh)].append((lsa.cost, lsa.dest))
+            # Build and aggregate LSA from these groups
+            reduced_lsas = [_u.ExtendedLSA(node, nh,
+                                           [_u.ExtLSARoute(dest=d, cost=c)
+                                            for c, d in dests])
+                            for (node, nh), dests in grouped_lsas.iteritems()]
+        self.stats.count(cross_lsas_before=len(lsas),
+                         cross_lsas_after=len(reduced_lsas))
         log.info('CrossOptimizer reduced the LSA count to %s (from %s)',
                   len(reduced_lsas), len(lsas))
         log.debug(reduced_lsas)
@@ -2,33 +2,109 @@ import utils as ssu
 import sys
 import abc
 import collections
+import functools
 import itertools
+import time
+from array import array
 
 from fibbingnode import log
-from fibbingnode.misc.igp_graph import ShortestPath
+from fibbingnode.misc.igp_graph import ShortestPath, CompactIGPGraph
+from fibbingnode.algorithms.ospf_simple import OSPFSimple
 
 
 DEFAULT_LB = 0
 DEFAULT_UB = 0
 
 
+class _DeadlineExpired(Exception):
+    """The deadline of the solver has passed"""
+
+
 class Node(object):
+    """A view over the state of a node in a Bounds store"""
     GLOBAL = 'global'  # Globally visible fake node
     LOCAL = 'local'   # Locally-scoped fake node
 
-    def __init__(self, lb=DEFAULT_LB, ub=DEFAULT_UB, fake=None, name=None,
-                 original_nhs=None, forced_nhs=None):
-        self.lb = lb  # Lower bound
-        self.ub = ub  # Upper bound
-        self.fake = fake  # Fake node type if any
-        self.forced_nhs = forced_nhs if forced_nhs else set()
-        self.original_nhs = original_nhs
+    __slots__ = ('_bounds', '_i', 'name')
+
+    def __init__(self, bounds, i, name):
+        """:param bounds: The Bounds store holding the state of the node
+        :param i: The index of the node in that store"""
+        self._bounds = bounds
+        self._i = i
         self.name = name
 
+    def __eq__(self, other):
+        return (isinstance(other, Node) and self._i == other._i and
+                self._bounds is other._bounds and self.name == other.name)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.name)
+
+    @property
+    def lb(self):
+        """Lower bound"""
+        return self._bounds.lb[self._i]
+
+    @lb.setter
+    def lb(self, lb):
+        self._bounds.write(self._bounds.lb, self._i, lb)
+
+    @property
+    def ub(self):
+        """Upper bound"""
+        return self._bounds.ub[self._i]
+
+    @ub.setter
+    def ub(self, ub):
+        self._bounds.write(self._bounds.ub, self._i, ub)
+
+    @property
+    def fake(self):
+        """Fake node type if any"""
+        return Bounds.FAKE_TYPES[self._bounds.fake[self._i]]
+
+    @fake.setter
+    def fake(self, fake):
+        self._bounds.write(self._bounds.fake, self._i,
+                           Bounds.FAKE_TYPES.index(fake))
+
+    @property
+    def forced_nhs(self):
+        return _NextHops(self._bounds, self._bounds.forced_nhs, self._i)
+
+    @forced_nhs.setter
+    def forced_nhs(self, nhs):
+        b = self._bounds
+        b.write(b.forced_nhs, self._i, b.bits(self._i, nhs))
+
+    @property
+    def original_nhs(self):
+        return _NextHops(self._bounds, self._bounds.original_nhs, self._i)
+
+    @original_nhs.setter
+    def original_nhs(self, nhs):
+        b = self._bounds
+        b.write(b.original_nhs, self._i, b.bits(self._i, nhs))
+
+    @property
+    def dag_nhs(self):
+        """The next hops of the node in the requirement DAG"""
+        return _NextHops(self._bounds, self._bounds.dag_nhs, self._i)
+
+    def notify(self):
+        """Notify the listener that the fake node of this node changed"""
+        if self._bounds.listener is not None:
+            self._bounds.listener(self)
+
     def add_fake_node(self, type=GLOBAL):
         """Attach a fake node to this node
         :param type: Whether the node should be locally or globally visible"""
         self.fake = type
+        self.notify()
 
     def remove_fake_node(self, clear_nhs=True):
         """Remove the fake node from this router
@@ -36,20 +112,32 @@ class Node(object):
         :param clear_nhs: Whether to also clear forced_nhs or not"""
         self.fake = None
         if clear_nhs:
-            self.forced_nhs.clear()
+            self._bounds.write(self._bounds.forced_nhs, self._i, 0)
+        self.notify()
+
+    def add_forced_nh(self, nh):
+        """Force the fake node of this node to also use nh"""
+        self.forced_nhs.add(nh)
+        self.notify()
+
+    def remove_forced_nh(self, nh):
+        """Stop forcing the fake node of this node to use nh"""
+        self.forced_nhs.remove(nh)
+        self.notify()
 
     def has_fake_node(self, subtype=None):
         """Whether this node has a fake or not
         :param subtype: check for a particular type of fake node"""
-        return bool(self.forced_nhs) and (self.fake == subtype if
-                                          subtype else True)
+        b, i = self._bounds, self._i
+        return bool(b.forced_nhs[i]) and (
+            b.FAKE_TYPES[b.fake[i]] == subtype if subtype else True)
 
     def has_any_fake_node(self):
-        return self.has_fake_node(Node.GLOBAL)\
-               or self.has_fake_node(Node.LOCAL)
+        b, i = self._bounds, self._i
+        return bool(b.forced_nhs[i]) and b.fake[i] != 0
 
     def __repr__(self):
-        if self.forced_nhs:
+        if self._bounds.forced_nhs[self._i]:
             return '<%s - Fake: %s ]%s,%s[ %s>' % (
                 self.name, self.fake, self.lb, self.ub, self.forced_nhs)
         else:
@@ -64,84 +152,504 @@ class Node(object):
         log.debug('Converting the fake node of %s to a '
                   'locally scoped one', n)
         n.fake = Node.LOCAL
+        n.notify()
+
+
+class Bounds(object):
+    """The state of the nodes of a requirement DAG towards its destination,
+    stored in arrays indexed by interned node ids. The next-hop sets of a
+    node are bitsets over the local numbering of its neighbors (see
+    ssu.NextHopIndex), which keeps them small integers.
+    The nodes outside of the DAG share a last slot, which must not be
+    altered, as they cannot have fake nodes.
+    The changes made within a transaction (see begin()) are journaled, in
+    order to roll them back in time proportional to their number."""
+    FAKE_TYPES = (None, Node.GLOBAL, Node.LOCAL)
+    _GLOBAL = FAKE_TYPES.index(Node.GLOBAL)
+    # The journaled values of the ECMP dependency sets
+    _ABSENT, _PRESENT = object(), object()
+
+    def __init__(self, dag, graph=None):
+        """:param graph: The graph numbering the neighbors of the nodes,
+                         the DAG by default"""
+        self.nh_index = ssu.NextHopIndex(graph if graph is not None else dag)
+        self.names = dag.nodes()
+        self.ids = {n: i for i, n in enumerate(self.names)}
+        self.fixed = size = len(self.names)
+        self.names.append(None)  # The shared slot
+        self.lb = array('l', [DEFAULT_LB]) * (size + 1)
+        self.ub = array('l', [DEFAULT_UB]) * (size + 1)
+        self.fake = array('B', [0]) * (size + 1)
+        self.forced_nhs = [0] * (size + 1)
+        self.original_nhs = [0] * (size + 1)
+        # The next hops in the DAG, which does not change while solving
+        self.dag_nhs = [self.nh_index.bits(n, dag.successors_iter(n))
+                        for n in self.names[:size]] + [0]
+        # node -> the set of its ECMP dependencies
+        self.ecmp = collections.defaultdict(set)
+        # Called with a node whenever its fake node changes
+        self.listener = None
+        # Called with the name of a node whenever its forced_nhs change
+        self.forced_listener = None
+        # [(container, key, previous value)] since the first open transaction
+        self._journal = []
+        # The length of the journal when each open transaction began
+        self._marks = []
+        self.transactions = self.rollbacks = 0
+
+    def write(self, values, i, value):
+        """Set values[i] to value, journaling its previous value"""
+        if self._marks:
+            self._journal.append((values, i, values[i]))
+        values[i] = value
+        if values is self.forced_nhs and self.forced_listener is not None:
+            self.forced_listener(self.names[i])
+
+    def add_ecmp_dep(self, n, e):
+        """Register e as an ECMP dependency of n"""
+        deps = self.ecmp[n]
+        if e not in deps:
+            if self._marks:
+                self._journal.append((deps, e, self._ABSENT))
+            deps.add(e)
+
+    def remove_ecmp_dep(self, n, e):
+        """Unregister the ECMP dependency e of n, raise KeyError if absent"""
+        deps = self.ecmp[n]
+        deps.remove(e)
+        if self._marks:
+            self._journal.append((deps, e, self._PRESENT))
+
+    def begin(self):
+        """Start a transaction, which can be nested"""
+        self._marks.append(len(self._journal))
+        self.transactions += 1
+
+    def commit(self):
+        """Keep the changes of the last open transaction"""
+        self._marks.pop()
+        if not self._marks:
+            del self._journal[:]
+
+    def rollback(self):
+        """Revert the changes of the last open transaction"""
+        mark = self._marks.pop()
+        self.rollbacks += 1
+        changed, forced_changed = set(), set()
+        for values, key, previous in reversed(self._journal[mark:]):
+            if previous is self._ABSENT:
+                values.discard(key)
+            elif previous is self._PRESENT:
+                values.add(key)
+            else:
+                values[key] = previous
+                if values is self.forced_nhs:
+                    forced_changed.add(key)
+                    changed.add(key)
+                elif values is self.fake:
+                    changed.add(key)
+        del self._journal[mark:]
+        if self.listener is not None:
+            for i in changed:
+                self.listener(Node(self, i, self.names[i]))
+        if self.forced_listener is not None:
+            for i in forced_changed:
+                self.forced_listener(self.names[i])
+
+    def node(self, n):
+        """Return the Node view of the node named n"""
+        return Node(self, min(self.ids.get(n, self.fixed), self.fixed), n)
+
+    def has_global_fake_node(self, n):
+        """Whether the node named n has a global fake node, without
+        creating its Node view"""
+        i = self.ids.get(n, self.fixed)
+        return (i < self.fixed and self.fake[i] == self._GLOBAL and
+                bool(self.forced_nhs[i]))
+
+    def nodes(self):
+        """Iterate over the Node views of the nodes of the DAG"""
+        for i in xrange(self.fixed):
+            n = self.names[i]
+            yield n, Node(self, i, n)
+
+    def names_of(self, i, bits):
+        """Iterate over the names of the next hops of node i in the bitset
+        bits"""
+        return self.nh_index.names(self.names[i], bits)
+
+    def bits(self, i, nhs):
+        """Return the bitset of the set of next hops nhs of node i"""
+        if isinstance(nhs, _NextHops) and nhs._bounds is self and\
+                nhs._i == i:
+            return nhs._bitset[i]
+        return self.nh_index.bits(self.names[i], nhs)
+
+
+class Regions(object):
+    """Contract the nodes without a global fake node into regions, i.e. the
+    strongly connected components of the graph restricted to these nodes
+    (its connected components if its links are bidirectional), in order to
+    list the global fake nodes reachable from a node without crossing
+    another one, once per region rather than once per node.
+    The regions are computed lazily, and dropped when the fake node of a
+    node that they reach changes."""
+    def __init__(self, graph, is_fake):
+        """:param graph: The CompactIGPGraph to explore along its real links
+        :param is_fake: A function telling whether the node of a given name
+                        has a global fake node"""
+        self._g = graph
+        self._is_fake = is_fake
+        # node -> the fake nodes reachable from its region, shared across
+        # the region. Every node reached from a node in there is also in
+        # there, unless it has a fake node.
+        self._reach = {}
+
+    def fake_nodes(self, n):
+        """Return the set of the global fake nodes reachable from n without
+        crossing another one"""
+        fakes = set()
+        for m in self._g.real_neighbors(n):
+            if self._is_fake(m):
+                fakes.add(m)
+            elif m in self._reach:
+                fakes |= self._reach[m]
+            else:
+                fakes |= self.__explore(m)
+        return fakes
+
+    def changed(self, n):
+        """Drop the regions reaching n, now that its fake node changed"""
+        reach = self._reach
+        reach.pop(n, None)
+        todo = [n]
+        while todo:
+            for u in self._g.predecessors_iter(todo.pop()):
+                if u in reach:
+                    del reach[u]
+                    todo.append(u)
+
+    def __explore(self, start):
+        """Compute the regions reachable from start, and return the fake
+        nodes that its region reaches, using Tarjan's algorithm"""
+        g, is_fake, reach = self._g, self._is_fake, self._reach
+        index, low = {start: 0}, {start: 0}
+        # The fake nodes reached from each node of the pending regions
+        found = {start: set()}
+        stack = [start]
+        todo = [(start, iter(g.real_neighbors(start)))]
+        while todo:
+            v, successors = todo[-1]
+            for w in successors:
+                if is_fake(w):
+                    found[v].add(w)
+                elif w in reach:
+                    found[v] |= reach[w]
+                elif w not in index:
+                    index[w] = low[w] = len(index)
+                    found[w] = set()
+                    stack.append(w)
+                    todo.append((w, iter(g.real_neighbors(w))))
+                    break
+                elif w in found:  # Still pending, thus in the region of v
+                    low[v] = min(low[v], index[w])
+            else:
+                todo.pop()
+                if low[v] == index[v]:
+                    # v is the root of a region, made of the top of stack
+                    i = stack.index(v)
+                    region = stack[i:]
+                    del stack[i:]
+                    fakes = frozenset().union(*(found.pop(w)
+                                                for w in region))
+                    for w in region:
+                        reach[w] = fakes
+                if todo:
+                    u = todo[-1][0]
+                    low[u] = min(low[u], low[v])
+                    if v in reach:
+                        found[u] |= reach[v]
+        return reach[start]
+
+
+class _NextHops(collections.MutableSet):
+    """A set of next-hops, stored as a bitset in a Bounds store"""
+    __slots__ = ('_bounds', '_bitset', '_i')
+
+    def __init__(self, bounds, bitset, i):
+        """:param bitset: The list holding the bitset at index i"""
+        self._bounds = bounds
+        self._bitset = bitset
+        self._i = i
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __contains__(self, n):
+        b = self._bounds
+        k = b.nh_index.bit(b.names[self._i], n)
+        return k is not None and bool(self._bitset[self._i] >> k & 1)
+
+    def __iter__(self):
+        return self._bounds.names_of(self._i, self._bitset[self._i])
+
+    def __len__(self):
+        return bin(self._bitset[self._i]).count('1')
+
+    def add(self, n):
+        b = self._bounds
+        b.write(self._bitset, self._i,
+                self._bitset[self._i] | b.bits(self._i, (n,)))
+
+    def discard(self, n):
+        b = self._bounds
+        k = b.nh_index.bit(b.names[self._i], n)
+        if k is not None:
+            b.write(self._bitset, self._i, self._bitset[self._i] & ~(1 << k))
+
+    def clear(self):
+        self._bounds.write(self._bitset, self._i, 0)
+
+    def __eq__(self, other):
+        if self.__same_node(other):
+            return self._bitset[self._i] == other._bitset[other._i]
+        return super(_NextHops, self).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def symmetric_difference(self, other):
+        if self.__same_node(other):
+            return set(self._bounds.names_of(self._i,
+                                             self._bitset[self._i] ^
+                                             other._bitset[other._i]))
+        return set(self).symmetric_difference(other)
+
+    def __same_node(self, other):
+        """Whether other is a set of next hops of the same node, i.e. whose
+        bitset uses the same numbering"""
+        return (isinstance(other, _NextHops) and
+                other._bounds is self._bounds and other._i == self._i)
+
+    def __repr__(self):
+        return repr(set(self))
 
 
 class Merger(object):
-    def __init__(self):
+    def __init__(self, processes=1, timeout=None):
+        """:param processes: The number of processes solving the
+                             destinations, None to use all CPUs
+        :param timeout: The time (in seconds) after which solve() stops
+                        reducing the fake nodes, and returns the best valid
+                        LSAs found so far, None to never stop"""
+        self.processes = processes
+        self.timeout = timeout
+        self.deadline = None  # The time at which the current solve stops
+        # The destinations of the last solve that ran out of time
+        self.timed_out = set()
         self.new_edge_metric = int(10e3)  # Default cost for new edges in the graph
         self.g = self._p = self.dag = self.dest = self.reqs = None
-        self.ecmp = collections.defaultdict(set)
+        self._cg = None  # Frozen snapshot of the topology of self.g
+        self._bounds = None  # The Bounds of the current dest
+        # The Regions of the nodes without fake nodes for the current dest
+        self._regions = None
+        # (n, s) -> dag_include_spt(n, s) for the current dest
+        self._dag_include_spt = {}
+        # n -> fixed_nodes_for(n) for the current dest
+        self._fixed_nodes = {}
+        # node -> the nodes whose fixed nodes depend on its forced_nhs
+        self._fixed_nodes_users = collections.defaultdict(set)
+        # The time spent in each phase of the last solve, and its counters
+        self.stats = ssu.SolverStats()
 
-    def solve(self, graph, requirements):
+    def solve(self, graph, requirements, spt=None, dests=None):
         """Compute the augmented topology for a given graph and a set of
         requirements.
+        The destinations are solved in the order of requirements, each of
+        them in the graph where the previous ones are inserted.
         :type graph: IGPGraph
         :type requirements: { dest: IGPGraph }
         :param requirements: the set of requirement DAG on a per dest. basis
+        :type spt: ShortestPath
+        :param spt: The shortest paths of graph, if already known. It will
+                    be updated with the destinations of the requirements
+                    (only in the workers if solving them in parallel).
+        :param dests: The destinations to solve, the others are only
+                      inserted in the graph. None to solve all of them.
         :return: list of fake LSAs"""
         self.reqs = requirements
+        self.stats.clear()
+        self.timed_out.clear()
+        self.deadline = (time.time() + self.timeout
+                         if self.timeout is not None else None)
         log.info('Preparing IGP graph')
-        self.g = prepare_graph(graph, requirements)
-        log.info('Computing SPT')
-        self._p = ShortestPath(graph)
-        lsa = []
-        for dest, dag in requirements.iteritems():
-            self.dest, self.dag = dest, dag
-            self.ecmp.clear()
-            log.info('Evaluating requirement %s', dest)
-            log.info('Ensuring the consistency of the DAG')
+        with self.stats.phase('prepare_graph'):
+            self.g = prepare_graph(graph, requirements)
+            self._cg = CompactIGPGraph(graph)
+        if spt is not None:
+            self._p = spt
+        else:
+            log.info('Computing SPT')
+            with self.stats.phase('spt'):
+                self._p = ShortestPath(graph, compact=self._cg)
+        return ssu.solve_per_destination(self, requirements, self.processes,
+                                         graph=graph, dests=dests)
+
+    def solve_dest(self, dest, dag):
+        """Compute the fake LSAs implementing the requirement DAG of dest
+        :return: list of fake LSAs"""
+        self.dest, self.dag = dest, dag
+        phase = functools.partial(self.stats.phase, dest=dest)
+        log.info('Evaluating requirement %s', dest)
+        log.info('Ensuring the consistency of the DAG')
+        with phase('check_dest'):
             self.check_dest()
-            ssu.complete_dag(self.dag, self.g, self.dest, self._p,
+        with phase('complete_dag'):
+            ssu.complete_dag(self.dag, self._cg, self.dest, self._p,
                              skip=self.reqs.keys())
-            log.info('Computing original and required next-hop sets')
+        log.info('Computing original and required next-hop sets')
+        with phase('nexthops'):
+            self._bounds = Bounds(self.dag, self._cg)
+            self.reset_memos()
             for n, node in self.nodes():
-                node.forced_nhs = set(self.dag.successors(n))
-                node.original_nhs = set([p[1] for p in
-                                         self._p.default_path(n, self.dest)])
-            if not ssu.solvable(self.dag, self.g):
-                log.warning('Consistency check failed, skipping %s', dest)
-                continue
+                node.forced_nhs = node.dag_nhs
+                node.original_nhs = self._p.successors_to(n, self.dest)
+        if not ssu.solvable(self.dag, self.g):
+            log.warning('Consistency check failed, skipping %s', dest)
+            return []
+        try:
+            self.check_deadline()
             log.info('Placing initial fake nodes')
-            self.place_fake_nodes()
+            with phase('place'):
+                self.place_fake_nodes()
+                self.index_fake_neighbors()
             log.info('Initializing fake nodes')
-            self.initialize_fake_nodes()
+            with phase('initialize'):
+                self.initialize_fake_nodes()
+            self.stats.count(dest, lsas_before=self.lsa_count())
             log.info('Propagating initial lower bounds')
-            self.propagate_lb()
-            log.debug('Fake node bounds: %s',
-                      [n for _, n in self.nodes() if n.has_any_fake_node()])
-            log.info('Reducing the augmented topology')
-            self.merge_fake_nodes()
+            with phase('propagate'):
+                self.propagate_lb()
+        except _DeadlineExpired:
+            log.warning('Ran out of time before merging the fake nodes for '
+                        '%s, falling back to their unmerged placement', dest)
+            self.timed_out.add(dest)
+            with phase('fallback'):
+                lsas = self.unmerged_lsas(dest, dag)
+            self.stats.count(dest, timed_out=1, lsas_before=len(lsas),
+                             lsas_after=len(lsas))
+            return lsas
+        log.debug('Fake node bounds: %s',
+                  [n for _, n in self.nodes() if n.has_any_fake_node()])
+        log.info('Reducing the augmented topology')
+        try:
+            with phase('merge'):
+                self.merge_fake_nodes()
+        except _DeadlineExpired:
+            log.warning('Ran out of time while merging the fake nodes for %s, '
+                        'keeping the merges done so far', dest)
+            self.timed_out.add(dest)
+            self.stats.count(dest, timed_out=1)
+        self.stats.count(dest, merges_attempted=self._bounds.transactions,
+                         merges_applied=(self._bounds.transactions -
+                                         self._bounds.rollbacks),
+                         merges_undone=self._bounds.rollbacks)
+        log.debug('Merges attempted/rolled back: %s/%s',
+                  self._bounds.transactions, self._bounds.rollbacks)
+        with phase('remove'):
             self.remove_redundant_fake_nodes()
-            log.info('Generating LSAs')
+        log.info('Generating LSAs')
+        with phase('create_lsas'):
             lsas = self.create_fake_lsa()
-            log.info('Solved the DAG for destination %s with LSA set: %s',
-                     self.dest, lsas)
-            lsa.extend(lsas)
-        return lsa
+        self.stats.count(dest, lsas_after=len(lsas))
+        log.info('Solved the DAG for destination %s with LSA set: %s',
+                 self.dest, lsas)
+        return lsas
+
+    def unmerged_lsas(self, dest, dag):
+        """Return the LSAs placing a fake node on every node of the DAG of
+        dest that needs one, as OSPFSimple does, without merging them"""
+        simple = OSPFSimple()
+        simple.new_edge_metric = self.new_edge_metric
+        simple.prepare(self.g, self.reqs, spt=self._p, compact=self._cg)
+        return simple.solve_dest(dest, dag)
+
+    def lsa_count(self):
+        """Return the number of LSAs the fake nodes currently need"""
+        return sum(len(node.forced_nhs) - (self.dest in node.forced_nhs)
+                   for _, node in self.nodes())
+
+    def check_deadline(self):
+        """Raise _DeadlineExpired if the deadline of the solve has passed"""
+        if self.deadline is not None and time.time() > self.deadline:
+            raise _DeadlineExpired()
 
     #
     # Implementation section
     #
 
-    @staticmethod
-    def __new_dest():
-        return {'data': Node()}
-
     def check_dest(self):
         """Check that the destination is present in the DAG and the graph"""
+        self.insert_dest(self.dest, self.dag)
+
+    def insert_dest(self, dest, dag):
+        """Insert dest in the DAG and the graph, where the destinations
+        solved after it see it"""
         log.debug('Checking dest in dag')
-        ssu.add_dest_to_graph(self.dest, self.dag)
+        ssu.add_dest_to_graph(dest, dag)
         log.debug('Checking dest in graph')
-        ssu.add_dest_to_graph(self.dest, self.g,
-                              edges_src=self.dag.predecessors,
+        ssu.add_dest_to_graph(dest, self.g,
+                              edges_src=dag.predecessors,
                               spt=self._p,
-                              metric=self.new_edge_metric,
-                              node_data_gen=self.__new_dest)
+                              metric=self.new_edge_metric)
+
+    @staticmethod
+    def dest_contexts(graph, requirements):
+        """Return, for each destination of requirements, the nodes whose
+        out-degree only exceeds one once the destinations before it are
+        inserted in graph. As place_fake_nodes skips the nodes with a single
+        successor, these are the changes made by the previous destinations
+        that its solution depends on."""
+        def degree(n):
+            return graph.out_degree(n) if n in graph else 0
+
+        inserted = collections.Counter()
+        contexts = {}
+        for dest, dag in requirements.iteritems():
+            contexts[dest] = frozenset(n for n, c in inserted.iteritems()
+                                       if degree(n) <= 1 < degree(n) + c)
+            inserted.update(ssu.destination_attachments(graph, dest, dag))
+        return contexts
 
     @abc.abstractmethod
     def place_fake_nodes(self):
         """Place the Fake nodes on the graph"""
 
+    def reset_memos(self):
+        """Start memoizing the queries depending on the DAG of the current
+        dest, following the changes of the forced next-hops"""
+        self._dag_include_spt.clear()
+        self._fixed_nodes.clear()
+        self._fixed_nodes_users.clear()
+        self._bounds.forced_listener = self.__forced_nhs_changed
+
+    def __forced_nhs_changed(self, n):
+        for u in self._fixed_nodes_users.pop(n, ()):
+            self._fixed_nodes.pop(u, None)
+
+    def index_fake_neighbors(self):
+        """Start contracting the nodes without a global fake node into
+        regions for the current dest, following the changes of the fake
+        nodes"""
+        self._regions = Regions(self._cg, self._bounds.has_global_fake_node)
+        self._bounds.listener = self.__fake_node_changed
+
+    def __fake_node_changed(self, node):
+        self._regions.changed(node.name)
+
     def initialize_fake_nodes(self):
         self.initialize_ecmp_deps()
         self.compute_initial_lb()
@@ -149,30 +657,65 @@ class Merger(object):
 
     def initialize_ecmp_deps(self):
         """Initialize ECMP dependencies"""
-        for n, node in map(lambda x: (x[0], self.node(x[0])),
-                           filter(lambda x: x[1] > 1,
-                                  self.dag.out_degree_iter())):
+        bounds = self._bounds
+        for n, degree in self.dag.out_degree_iter():
+            if degree < 2:
+                continue
+            node = self.node(n)
             if node.has_any_fake_node():
                 log.debug('%s does ECMP and has a fake node', n)
-                self.ecmp[n].add(n)
+                bounds.add_ecmp_dep(n, n)
+                continue
+            f, path_count = self.first_fake_nodes(n)
+            if 0 < len(f) < path_count:
+                log.warning('%s does ECMP and has less downstream fake '
+                            'nodes than paths (%s < %s), forcing it to '
+                            'have a fake node.', n, len(f), path_count)
+                node.forced_nhs = node.dag_nhs
+                node.add_fake_node()
+                bounds.add_ecmp_dep(n, n)
+            elif f:
+                log.debug('Registering ECMP depencies on %s: %s', n, f)
+                for fake in f:
+                    for e in f:
+                        bounds.add_ecmp_dep(fake, e)
+
+    def first_fake_nodes(self, n):
+        """Explore the shortest paths of n towards the destination
+        :return: the first fake node on each of these paths,
+                 and the number of paths"""
+        spt = self._p.dag_to(n, self.dest)
+        if not spt:
+            return set(), 0
+        fakes = set()
+        reached = set((n,))
+        to_visit = [n]
+        while to_visit:
+            x = to_visit.pop()
+            if x == self.dest:
+                continue
+            if self.node(x).has_any_fake_node():
+                fakes.add(x)
+                continue
+            for y in spt[x]:
+                if y not in reached:
+                    reached.add(y)
+                    to_visit.append(y)
+        # Count the paths bottom-up rather than enumerating them
+        count = {self.dest: 1}
+        to_visit = [n]
+        while to_visit:
+            x = to_visit[-1]
+            if x in count:
+                to_visit.pop()
+                continue
+            pending = [y for y in spt[x] if y not in count]
+            if pending:
+                to_visit.extend(pending)
             else:
-                f = []
-                paths = self._p.default_path(n, self.dest)
-                for p in paths:
-                    # Try to find the first fake node for each path
-                    for h in p[:-1]:
-                        if self.node(h).has_any_fake_node():
-                            f.add(h)
-                            break
-                if len(f) > 0 and len(f) < len(paths):
-                    log.warning('%s does ECMP and has less downstream fake '
-                                'nodes than paths (%s < %s), forcing it to '
-                                'have a fake node.', n, len(f), len(paths))
-                    node.fake_type = Node.GLOBAL
-                elif f:
-                    log.debug('Registering ECMP depencies on %s: %s', n, f)
-                    for fake in f:
-                        self.ecmp[fake].add(f)
+                count[x] = sum(count[y] for y in spt[x])
+                to_visit.pop()
+        return fakes, count[n]
 
     def compute_initial_lb(self):
         """Set the initial values for the lb on every node having a fake node
@@ -181,6 +724,7 @@ class Merger(object):
         # Start at root
         to_visit = set(self.g.predecessors_iter(self.dest))
         while to_visit:
+            self.check_deadline()
             node_name = to_visit.pop()
             log.debug('Exploring %s', node_name)
             if node_name in visited:
@@ -202,9 +746,14 @@ class Merger(object):
                 to_visit |= set(self.g.predecessors_iter(node_name))
 
     def initial_lb_of(self, node):
-        """Compute the initial lower bound of a node"""
+        """Compute the initial lower bound of a node.
+        The bound derived from a neighbor is lowered by one if every last
+        hop of its shortest paths (before the destination or their first
+        global fake node) has its shortest paths towards it in the DAG. This
+        is decided on the shortest-path DAG of the neighbor, without
+        enumerating its paths"""
         lb = DEFAULT_LB
-        for nei in self.g[node]:
+        for nei in self._cg.successors_iter(node):
             if nei in self.reqs:
                 log.debug('Not considering %s for initial LB of %s as '
                           'it is a destination', nei, node)
@@ -217,43 +766,52 @@ class Merger(object):
                 log.debug('Not considering %s for initial LB of %s as '
                           '%s->%s exists in the DAG', nei, node, nei, node)
                 continue
-            nei_dest_paths = self._p.default_path(nei, self.dest)
-            if not nei_dest_paths:
+            nei_dest_dag = self._p.dag_to(nei, self.dest)
+            if not nei_dest_dag:
                 log.debug('Not considering %s for initial LB of %s as '
                           'it has no path to the destination', nei, node)
                 continue
-            # Track whether nei has a path without fake nodes to the dest
-            has_pure_path = False
-            # Track whether node is in the spt of nei to dest
-            node_in_spt = False
-            for p in nei_dest_paths:
-                # Status of this path
-                is_pure = True
-                for n in p[:-1]:
-                    if self.node(n).has_fake_node(Node.GLOBAL):
-                        is_pure = False
-                        break
-                    if node == n:
-                        log.debug('Not considering %s for initial LB of %s as '
-                                  '%s is in its shortest path to the '
-                                  'destination %s', nei, node, node, p)
-                        node_in_spt = True
-                        break
-                if node_in_spt:  # Already logged the cause
-                    break
-                has_pure_path = has_pure_path or is_pure
-            if node_in_spt:
+            # Explore the shortest paths of nei until their first fake node,
+            # and where they stop: their first global fake node, or their
+            # last hop before the destination
+            reached = set((nei,))
+            stops = set()
+            to_visit = [nei]
+            while to_visit:
+                n = to_visit.pop()
+                if n == self.dest:
+                    continue
+                if self.node(n).has_fake_node(Node.GLOBAL):
+                    stops.add(n)
+                    continue
+                for succ in nei_dest_dag[n]:
+                    if succ == self.dest:
+                        stops.add(n)
+                    if succ not in reached:
+                        reached.add(succ)
+                        to_visit.append(succ)
+            # Whether nei has a path without fake nodes to the dest
+            has_pure_path = self.dest in reached
+            # Whether node is in the spt of nei to dest, before any fake node
+            if (node in reached and
+                    not self.node(node).has_fake_node(Node.GLOBAL)):
+                log.debug('Not considering %s for initial LB of %s as '
+                          '%s is in its shortest path to the '
+                          'destination', nei, node, node)
                 continue
             if not has_pure_path:
                 log.debug('Not considering %s for initial LB of %s as '
                           'it does not have a path to the destination without '
                           'the presence of fake nodes.', nei, node)
                 continue
-            nei_lb = (self._p.default_cost(nei, self.dest) -
+            nei_lb = (self._p.cost_to(nei, self.dest) -
                       self._p.default_cost(nei, node))
-            if n != nei and self.dag_include_spt(n, nei):
+            # The fake node is redundant if every shortest path of nei stops
+            # at a node whose shortest paths towards nei are in the DAG
+            if all(last != nei and self.dag_include_spt(last, nei)
+                   for last in stops):
                 log.debug('%s is a redundant fake node with %s, setting LB to '
-                          'shortest-path cost', n, nei)
+                          'shortest-path cost', node, nei)
                 nei_lb -= 1
             if nei_lb > lb:
                 lb = nei_lb
@@ -266,7 +824,7 @@ class Merger(object):
             if node.ub != DEFAULT_UB:
                 log.debug('%s already has its UB set to %s', n, node.ub)
                 continue
-            node.ub = self._p.default_cost(n, self.dest)
+            node.ub = self._p.cost_to(n, self.dest)
             log.debug('Initial ub of %s set to %s', n, node.ub)
 
     def propagate_lb(self, assign=Node.increase_lb, fail_func=Node.setlocal,
@@ -281,19 +839,23 @@ class Merger(object):
         :type initial_nodes: list
         :param initial_nodes: The initial set of nodes to propagare from,
                               or all the nodes if set to None"""
-        pq = ssu.MaxHeap([(self.get_delta(n), n) for n in
-                          ([n for n, _ in self.nodes(Node.GLOBAL)]
-                           if not initial_nodes else initial_nodes)])
+        # Each node is queued at most once, with its latest delta
+        pq = ssu.IndexedMaxHeap([(self.get_delta(n), n) for n in
+                                 ([n for n, _ in self.nodes(Node.GLOBAL)]
+                                  if not initial_nodes else initial_nodes)])
         log.debug('Initial PQ: %s', pq)
+        try:
+            self.__propagate_lb(pq, assign, fail_func)
+        finally:
+            self.stats.count(self.dest, heap_ops=pq.operations)
+
+    def __propagate_lb(self, pq, assign, fail_func):
+        """Propagate the lower bounds of the nodes in pq, see propagate_lb"""
         updates = set()
         while not pq.is_empty():
+            self.check_deadline()
             # Get the node with the biggest influence potential
             delta, node = pq.pop()
-            # Check that we did not already check it before
-            if delta < self.get_delta(node):
-                # This node has already been updated
-                log.debug('Ignoring delta %s for %s', delta, node)
-                continue
             log.debug('Evaluating %s (%s)', node, delta)
             fixed_neighbors = self.fixed_nodes_for(node)
             # Explore its neighbors
@@ -314,7 +876,7 @@ class Merger(object):
                         if nei.lb + lb_diff + 1 < nei.ub:
                             assign(nei, lb_diff)
                             # Schedule the neighbor for update
-                            pq.push((self.get_delta(n), n))
+                            pq.push_or_update(self.get_delta(n), n)
                             # Also take care of the ECMP deps.
                             for e in self.ecmp_dep(n):
                                 if e == n:
@@ -328,7 +890,8 @@ class Merger(object):
                                         e)
                                     assign(e_node, lb_diff)
                                     # Schedule the neighbor for update
-                                    pq.push((self.get_delta(e), e))
+                                    pq.push_or_update(self.get_delta(e),
+                                                      e)
                                 else:
                                     log.debug('Failed to increase the %s '
                                               'as an ECMP dep of %s', e, n)
@@ -342,12 +905,22 @@ class Merger(object):
                         map(fail_func, map(self.node, self.ecmp_dep(nei)))
 
     def fixed_nodes_for(self, n):
-        """Return the list of all nodes without a fake node that rely on the
+        """Return the set of all nodes without a fake node that rely on the
         fake node of n"""
+        try:
+            fixed_nodes = self._fixed_nodes[n]
+        except KeyError:
+            self.stats.count(self.dest, fixed_nodes_for_misses=1)
+        else:
+            self.stats.count(self.dest, fixed_nodes_for_hits=1)
+            return fixed_nodes
         fixed_nodes = set()
+        # The nodes whose forced_nhs define the result
+        read = set()
         stack = [(p, n) for p in self.dag.predecessors(n)]
         while stack:
             u, v = stack.pop()
+            read.add(u)
             # u has a fake node towards v
             if v in self.node(u).forced_nhs:
                 continue
@@ -356,6 +929,9 @@ class Merger(object):
             else:
                 fixed_nodes.add(u)
                 stack.extend([(p, u) for p in self.dag.predecessors(u)])
+        fixed_nodes = self._fixed_nodes[n] = frozenset(fixed_nodes)
+        for u in read:
+            self._fixed_nodes_users[u].add(n)
         return fixed_nodes
 
     def get_delta(self, n):
@@ -385,18 +961,110 @@ class Merger(object):
 
     def merge_fake_nodes(self):
         """Attempt to reduce the number of fake nodes by merging successive
-        ones into each other"""
-        dag_spt = ssu.dag_paths_from_leaves(self.dag, self.dest)
-        for path in dag_spt:
-            log.debug('Trying to merge along %s', path)
-            fake_nodes = [(idx, n) for idx, n in enumerate(path[:-1])
-                          if self.node(n).has_any_fake_node()]
-            for idx, (n_pos, n) in enumerate(fake_nodes[:-1]):
-                _, succ = fake_nodes[idx+1]
-                # We can only merge Global Lies
-                if self.node(n).fake == Node.GLOBAL\
-                   and self.node(succ).fake == Node.GLOBAL:
-                    self.merge(n, succ, path[n_pos + 1])
+        ones into each other.
+        Walk along the paths of the DAG in the order of
+        utils.dag_paths_from_leaves, restarting from the first node of each
+        path, but explore them depth-first to share their prefixes. As a
+        failed merge leaves the bounds untouched, a pair of fake nodes is
+        only attempted again, and the paths below a node only explored again
+        with the same fake node upstream, once some merge has succeeded."""
+        # The nodes on a path towards the destination, not found with
+        # nx.ancestors as it cannot reverse overlays
+        reaches = set()
+        to_visit = [self.dest]
+        while to_visit:
+            for n in self.dag.predecessors_iter(to_visit.pop()):
+                if n not in reaches:
+                    reaches.add(n)
+                    to_visit.append(n)
+        # (n, succ, nh) -> merge count when last attempted
+        attempted = {}
+        # what defines the merges below a node -> merge count when all its
+        # paths were last walked without merging
+        settled = {}
+        for leaf, deg in self.dag.in_degree_iter():
+            if deg or leaf not in reaches:
+                continue
+            # [successors, key, merge count when entered, whether the walk
+            #  must restart from the leaf before the next successor]
+            path, todo = [], []
+            self.__enter(leaf, path, todo, attempted, settled)
+            while todo:
+                self.check_deadline()
+                frame = todo[-1]
+                n = next(frame[0], None)
+                if n is None:
+                    todo.pop()
+                    path.pop()
+                    if frame[2] == self.__merges():
+                        settled[frame[1]] = frame[2]
+                    if todo:
+                        todo[-1][3] = True
+                    continue
+                if n == self.dest:
+                    frame[3] = True
+                    continue
+                if n not in reaches:
+                    continue
+                if frame[3]:
+                    frame[3] = False
+                    self.__merge_path(path, attempted)
+                self.__enter(n, path, todo, attempted, settled)
+
+    def __merges(self):
+        """The number of merges that succeeded so far"""
+        return self._bounds.transactions - self._bounds.rollbacks
+
+    def __enter(self, n, path, todo, attempted, settled):
+        """Walk from path to n, and explore the paths below n unless they
+        have already been walked since the last merge"""
+        key = self.__merge_along(path, n, attempted)
+        if settled.get(key) == self.__merges():
+            if todo:
+                todo[-1][3] = True
+            return
+        path.append(n)
+        todo.append([self.dag.successors_iter(n), key, self.__merges(), False])
+
+    def __merge_path(self, path, attempted):
+        """Try to merge the successive fake nodes of path"""
+        last = None
+        for i, n in enumerate(path):
+            if self.node(n).has_any_fake_node():
+                if last is not None:
+                    self.__try_merge(path[last], n, path[last + 1],
+                                     attempted)
+                last = i
+
+    def __merge_along(self, path, n, attempted):
+        """Try to merge the last fake node of path into n if it has one,
+        and return what defines the merges to attempt downstream of n"""
+        for i in xrange(len(path) - 1, -1, -1):
+            if self.node(path[i]).has_any_fake_node():
+                up = (path[i], path[i + 1] if i + 1 < len(path) else n)
+                break
+        else:
+            up = None
+        if not self.node(n).has_any_fake_node():
+            return n, up
+        # Merges downstream of a fake node only depend on itself
+        if up is not None:
+            self.__try_merge(up[0], n, up[1], attempted)
+        return n, n
+
+    def __try_merge(self, n, succ, nh, attempted):
+        """Try to merge n into succ through nh, unless this already failed
+        or succeeded with the current bounds"""
+        merges = self.__merges()
+        if attempted.get((n, succ, nh)) == merges:
+            return
+        node = self.node(n)
+        # We can only merge Global Lies, not yet merged through nh
+        if node.fake == Node.GLOBAL and\
+                self.node(succ).fake == Node.GLOBAL and\
+                nh in node.forced_nhs:
+            self.merge(n, succ, nh)
+        attempted[n, succ, nh] = self.__merges()
 
     def merge(self, n, succ, nh):
         """Try to merge n into its successor fake node, along the given path"""
@@ -413,17 +1081,22 @@ class Merger(object):
 
     def dag_include_spt(self, n, s):
         """Check if all SP from n to s in the graph are also in the DAG"""
-        for p in self._p.default_path(n, s):
-            for u, v in zip(p[:-1], p[1:]):
-                if not self.dag.has_edge(u, v):
-                    log.debug('(%s, %s) is in the SP set of %s->%s '
-                              'but not in the DAG', u, v, n, s)
-                    return False
-                if v == s:
-                    # We reached the target node, and it is included in the DAG
-                    break
-                # Check that dag <=> SPT
-        return True
+        try:
+            included = self._dag_include_spt[n, s]
+        except KeyError:
+            self.stats.count(self.dest, dag_include_spt_misses=1)
+        else:
+            self.stats.count(self.dest, dag_include_spt_hits=1)
+            return included
+        included = True
+        for u, v in self._p.default_edges(n, s):
+            if not self.dag.has_edge(u, v):
+                log.debug('(%s, %s) is in the SP set of %s->%s '
+                          'but not in the DAG', u, v, n, s)
+                included = False
+                break
+        self._dag_include_spt[n, s] = included
+        return included
 
     def combine_ranges(self, n, s):
         """Attempt to combine the lb,ub interval between the two nodes"""
@@ -451,41 +1124,25 @@ class Merger(object):
     def apply_merge(self, n, s, lb, ub, nh):
         """Try to apply a given merge, n->s, with new lb/ub for s,
         and corresponding to the nexthop of n nh"""
-        undos = []
+        bounds = self._bounds
         propagation_failure = []
 
-        def undo_all():
-            log.debug('Undoing all changes')
-            for (f, args, kw) in reversed(undos):
-                f(*args, **kw)
-
-        def record_undo(f, *args, **kw):
-            undos.append((f, args, kw))
-
         def propagation_fail(n):
             log.debug('The propagation failed on node %s, aborting merge!', n)
             propagation_failure.append(False)
             return True
 
-        def propagation_assign(node, lb):
-            record_undo(setattr, node, 'lb', node.lb)
-            log.debug('Propagation caused the LB of %s to increase by %s',
-                      node, lb)
-            Node.increase_lb(node, lb)
-
         log.debug('Trying to apply merge, n: %s, s:%s, lb:%s, ub:%s, nh:%s',
                   n, s, lb, ub, nh)
+        bounds.begin()
         # Remove the fake node
         node = self.node(n)
-        node.forced_nhs.remove(nh)
-        record_undo(node.forced_nhs.add, nh)
+        node.remove_forced_nh(nh)
 
         # Update the values in its successor
         succ_node = self.node(s)
         path_cost_increase = (self._p.default_cost(n, s) +
                               succ_node.lb - node.lb)
-        record_undo(setattr, succ_node, 'lb', succ_node.lb)
-        record_undo(setattr, succ_node, 'ub', succ_node.ub)
         succ_node.lb = lb
         succ_node.ub = ub
 
@@ -496,48 +1153,44 @@ class Merger(object):
             log.debug('Aborting merge has %s and %s are ECMP dependent: '
                       'Merging them would make it impossible to keep both path'
                       ' with the same cost!', n, s)
-            undo_all()
+            bounds.rollback()
             return
         remove_n = not node.has_fake_node(Node.GLOBAL)
         if remove_n:
-            record_undo(node.add_fake_node, node.fake)
             node.remove_fake_node()
             log.debug('Also removing %s from its ECMP deps has it no longer '
                       'has a fake node.', n)
-        deps = self.ecmp[s]
         for e in ecmp_deps:
             e_node = self.node(e)
-            e_deps = self.ecmp[e]
             if remove_n:
-                e_deps.remove(n)
-                record_undo(e_deps.add, n)
+                bounds.remove_ecmp_dep(e, n)
                 if e == n:
                     continue
-            if e not in deps:
-                deps.add(e)
-                record_undo(deps.remove, e)
-            if s not in e_deps:
-                e_deps.add(s)
-                record_undo(e_deps.remove, s)
+            bounds.add_ecmp_dep(s, e)
+            bounds.add_ecmp_dep(e, s)
             new_lb = e_node.lb + path_cost_increase
             if not self.valid_range(e, new_lb, e_node.ub):
                 log.debug('Cannot increase the ECMP ecmp dep %s of %s by %s. '
                           'Aborting merge!', e, n, path_cost_increase)
-                undo_all()
+                bounds.rollback()
                 return
             else:
                 log.debug('Increased %s to %s', e, new_lb)
-                record_undo(setattr, e_node, 'lb', e_node.lb)
                 e_node.lb = new_lb
 
         ecmp_deps.append(s)
         log.debug('Propagating LB changes')
-        self.propagate_lb(assign=propagation_assign,
-                          fail_func=propagation_fail,
-                          initial_nodes=ecmp_deps)
+        try:
+            self.propagate_lb(fail_func=propagation_fail,
+                              initial_nodes=ecmp_deps)
+        except _DeadlineExpired:
+            bounds.rollback()
+            raise
         if propagation_failure:
-            undo_all()
+            log.debug('Undoing all changes')
+            bounds.rollback()
         else:
+            bounds.commit()
             log.info('Merged %s into %s', n, s)
 
     def remove_redundant_fake_nodes(self):
@@ -557,10 +1210,10 @@ class Merger(object):
             if node.has_fake_node(subtype=Node.GLOBAL):
                 # Is the LB redundant with the original SP ?
                 succ = self.dag.successors(n)
-                succ_dest_cost = self._p.default_cost(succ[0], self.dest)
+                succ_dest_cost = self._p.cost_to(succ[0], self.dest)
                 n_succ_cost = self._p.default_cost(n, succ[0])
                 if node.lb + 1 == succ_dest_cost + n_succ_cost and\
-                   node.original_nhs == set(succ):
+                   node.original_nhs == node.dag_nhs:
                     log.debug('Removing %s as it is redundant with the '
                               'original path [lb: %s, succ cost: %s, '
                               'n-succ cost: %s, succ: %s, orig succ: %s]',
@@ -594,38 +1247,29 @@ class Merger(object):
         return lsa
 
     def nodes(self, fake_type=None):
-        """Iterate over the nodes of the graph for the current dest
+        """Iterate over the nodes of the DAG for the current dest
         :param fake_type: if not None, restrict to nodes having that kind of
                           fake node"""
-        for n, data in self.g.nodes_iter(data=True):
+        for n, node in self._bounds.nodes():
             if n in self.reqs:
                 continue  # Skip the destination nodes
-            node = data['data'][self.dest]
             if not fake_type or node.has_fake_node(fake_type):
                 yield n, node
 
     def node(self, n):
-        """Return the Node for a given node name, for the current dest"""
-        try:
-            return self.g.node[n]['data'][self.dest]
-        except KeyError:
-            return None
+        """Return the Node for a given node name, for the current dest.
+        The nodes outside of the DAG can only be read."""
+        return self._bounds.node(n)
 
     def fake_neighbors(self, node):
-        """Iterator over all fake nodes reachable from node
-        :return: iter((name, node))"""
-        visited = set()
-        to_visit = set(self.g.real_neighbors(node))
-        while to_visit:
-            n = to_visit.pop()
-            if n in visited:
-                continue
-            visited.add(n)
-            n_node = self.node(n)
-            if n_node.has_fake_node(subtype=Node.GLOBAL):
-                yield n, n_node
-            else:
-                to_visit |= set(self.g.real_neighbors(n))
+        """List all fake nodes reachable from node
+        :return: [(name, node)]"""
+        return [(n, self.node(n)) for n in self._regions.fake_nodes(node)]
+
+    @property
+    def ecmp(self):
+        """node -> the set of its ECMP dependencies, for the current dest"""
+        return self._bounds.ecmp
 
     def ecmp_dep(self, node):
         """Iterates over the ECMP dependencies of n"""
@@ -633,23 +1277,19 @@ class Merger(object):
 
     def valid_range(self, s, lb, ub):
         """Check if the proposed lb/ub range is valid for the node named s"""
-        ub_padding = (1 if
-                      set(self.dag.successors(s)) == self.node(s).original_nhs
-                      else 0)
+        node = self.node(s)
+        ub_padding = 1 if node.dag_nhs == node.original_nhs else 0
         return lb + 1 < ub + ub_padding
 
 
 def prepare_graph(g, req):
-    """Copy the given graph and preset nodes attribute
+    """Return a graph that can be modified to solve the requirements without
+    altering the given one
     :type g: DiGraph
     :return: DiGraph
     :type req: {dest: fwd_req}
     :param req: The requirements for that graph"""
-    log.debug('Copying graph')
-    graph = g.copy()
-    for n in graph.nodes():
-        graph.node[n]['data'] = {key: Node(name=n) for key in req}
-    return graph
+    return ssu.overlay(g)
 
 
 class FullMerger(Merger):
@@ -664,7 +1304,7 @@ class FullMerger(Merger):
                 node.add_fake_node()
                 log.debug('Adding a fake node on %s', n)
                 if n in penultimate_nodes:
-                    node.lb = self._p.default_cost(n, self.dest) - 1
+                    node.lb = self._p.cost_to(n, self.dest) - 1
                     node.ub = node.lb + 2
                     log.debug('%s is a penultimate node, LB = cost to dest', n)
 
@@ -690,7 +1330,7 @@ class PartialMerger(Merger):
         successors set.
         :type orig: set
         :type dag: set"""
-        return orig.symmetric_difference(dag)
+        return orig != dag
 
 
 class PartialECMPMerger(PartialMerger):
@@ -699,4 +1339,4 @@ class PartialECMPMerger(PartialMerger):
 
     @staticmethod
     def needs_fake_node(orig, dag):
-        return len(dag) > 1 or orig.symmetric_difference(dag)
+        return len(dag) > 1 or orig != dag
@@ -1,6 +1,8 @@
+import functools
+
 import utils as ssu
 from fibbingnode import log
-from fibbingnode.misc.igp_graph import ShortestPath
+from fibbingnode.misc.igp_graph import ShortestPath, CompactIGPGraph
 
 
 def get_edge_multiplicity(dag, node, req_nh):
@@ -18,8 +20,17 @@ def is_fake(g, u, v):
 
 
 class OSPFSimple(object):
-    def __init__(self):
+    # The solution of a requirement only depends on the shortest paths
+    # towards the destination and the nodes of its DAG, see SensitivityIndex
+    dag_local = True
+
+    def __init__(self, processes=1):
+        """:param processes: The number of processes solving the
+                             destinations, None to use all CPUs"""
+        self.processes = processes
         self.new_edge_metric = int(10e4)
+        # The time spent in each phase of the last solve, and its counters
+        self.stats = ssu.SolverStats()
 
     def get_fake_lsas(self):
         return self.fake_ospf_lsas
@@ -30,12 +41,9 @@ class OSPFSimple(object):
             log.debug('%s does not need a path towards %s', node, dest)
             return []
         # compute the originals next-hops of the current node
-        try:
-            original_nhs = [
-                    p[1] for p in self.igp_paths.default_path(node, dest)]
-        except KeyError:
+        original_nhs = self.igp_paths.successors_to(node, dest)
+        if not original_nhs:
             log.debug("%s had no NH towards %s", node, dest)
-            original_nhs = []
         max_multiplicity = max(
                 map(lambda v: get_edge_multiplicity(dag, node, v), req_nhs))
         if (not set(req_nhs).symmetric_difference(original_nhs) and
@@ -48,18 +56,47 @@ class OSPFSimple(object):
                   max_multiplicity, original_nhs, req_nhs)
         return req_nhs
 
-    def solve(self, topo, requirement_dags):
+    def solve(self, topo, requirement_dags, spt=None, dests=None):
+        """Compute the fake LSAs implementing the requirement DAGs.
+
+        :param spt: A ShortestPath object for topo to use instead of
+                    computing a new one. It will be updated with the
+                    destinations of the requirements (only in the workers
+                    if solving them in parallel).
+        :param dests: The destinations to solve, None for all of them"""
+        self.stats.clear()
+        with self.stats.phase('prepare'):
+            self.prepare(topo, requirement_dags, spt=spt)
         # a list of tuples with info on the node to be attracted,
         # the forwarding address, the cost to be set in the fake LSA,
         # and the respective destinations
-        self.fake_ospf_lsas = []
+        self.fake_ospf_lsas = ssu.solve_per_destination(
+            self, requirement_dags, self.processes, graph=self.igp_graph,
+            dests=dests)
+        return self.fake_ospf_lsas
+
+    def prepare(self, topo, requirement_dags, spt=None, compact=None):
+        """Set the topology and requirements to use in solve_dest
+
+        :param compact: A CompactIGPGraph snapshot of topo, if already built"""
         self.reqs = requirement_dags
         self.igp_graph = topo
-        self.igp_paths = ShortestPath(self.igp_graph)
-        # process input forwarding DAGs, one at the time
-        for dest, dag in requirement_dags.iteritems():
-            log.info('Solving DAG for dest %s', dest)
-            self.dest, self.dag = dest, dag
+        # The routers and their links are not altered while solving
+        self.compact = compact if compact is not None else CompactIGPGraph(
+            topo)
+        self.igp_paths = (spt if spt is not None
+                          else ShortestPath(self.igp_graph,
+                                            compact=self.compact))
+
+    def solve_dest(self, dest, dag):
+        """Compute the fake LSAs implementing the requirement DAG of dest"""
+        log.info('Solving DAG for dest %s', dest)
+        # dest is only inserted in a copy of the graph, which the other
+        # destinations do not see
+        topo, lsas = ssu.overlay(self.igp_graph), []
+        self.dest, self.dag, self.topo = dest, dag, topo
+        phase = functools.partial(self.stats.phase, dest=dest)
+        with phase('check_dest'):
             log.debug('Checking dest in dag')
             ssu.add_dest_to_graph(dest, dag)
             log.debug('Checking dest in igp graph')
@@ -67,30 +104,41 @@ class OSPFSimple(object):
                                   edges_src=dag.predecessors,
                                   spt=self.igp_paths,
                                   metric=self.new_edge_metric)
-            ssu.complete_dag(dag, topo, dest, self.igp_paths,
+        # The nodes added by complete_dag keep their shortest paths
+        requested = set(dag)
+        with phase('complete_dag'):
+            ssu.complete_dag(dag, self.compact, dest, self.igp_paths,
                              skip=self.reqs.keys())
-            # Add temporarily the destination to the igp graph and/or req dags
-            if not ssu.solvable(dag, topo):
-                log.warning('Skipping requirement for dest: %s', dest)
+        # Add temporarily the destination to the igp graph and/or req dags
+        if not ssu.solvable(dag, topo):
+            log.warning('Skipping requirement for dest: %s', dest)
+            return lsas
+        with phase('place'):
+            self.place_fake_nodes(lsas, [n for n in dag if n in requested])
+        self.stats.count(dest, lsas_before=len(lsas), lsas_after=len(lsas))
+        return lsas
+
+    def place_fake_nodes(self, lsas, nodes):
+        """Append to lsas the fake nodes implementing the current DAG
+
+        :param nodes: The nodes of the DAG that may need fake nodes"""
+        topo, dest, dag = self.topo, self.dest, self.dag
+        for node in nodes:
+            nhs = self.nhs_for(node, dest, dag)
+            if not nhs:
                 continue
-            for node in dag:
-                nhs = self.nhs_for(node, dest, dag)
-                if not nhs:
-                    continue
-                for req_nh in nhs:
-                    log.debug('Placing a fake node for %s->%s', node, req_nh)
-                    for i in xrange(get_edge_multiplicity(dag, node, req_nh)):
-                        self.fake_ospf_lsas.append(ssu.LSA(node=node,
-                                                           nh=req_nh,
-                                                           cost=(-1 - i),
-                                                           dest=dest))
-            # Check whether we need to include one more fake node to handle
-            # the case where we create a new route from scratch.
-            for p in dag.predecessors_iter(dest):
-                if not is_fake(topo, p, dest):
-                    continue
-                log.debug('%s is a terminal node towards %s but had no prior '
-                          'route to it! Adding a synthetic route', p, dest)
-                self.fake_ospf_lsas.append(
-                        ssu.GlobalLie(dest, self.new_edge_metric, p))
-        return self.fake_ospf_lsas
+            for req_nh in nhs:
+                log.debug('Placing a fake node for %s->%s', node, req_nh)
+                for i in xrange(get_edge_multiplicity(dag, node, req_nh)):
+                    lsas.append(ssu.LSA(node=node,
+                                        nh=req_nh,
+                                        cost=(-1 - i),
+                                        dest=dest))
+        # Check whether we need to include one more fake node to handle
+        # the case where we create a new route from scratch.
+        for p in dag.predecessors_iter(dest):
+            if not is_fake(topo, p, dest):
+                continue
+            log.debug('%s is a terminal node towards %s but had no prior '
+                      'route to it! Adding a synthetic route', p, dest)
+            lsas.append(ssu.GlobalLie(dest, self.new_edge_metric, p))
@@ -0,0 +1,202 @@
+"""This file indexes the IGP edges on which the solutions of the forwarding
+requirements depend, in order to tell which requirements are affected by a
+topology change."""
+
+import collections
+
+from fibbingnode.algorithms.utils import find_sink
+from fibbingnode.misc.igp_graph import ShortestPath
+
+
+class SensitivityIndex(object):
+    """Map each IGP edge to the (root, node) pairs whose non-fibbed shortest
+    paths towards root use it, and to the prefixes whose requirement DAG
+    contains it.
+    The roots of a prefix are the nodes of its DAG, as the solvers use the
+    paths between them, and the prefix itself (or the nodes of the DAG it
+    gets attached to if it is not announced in the IGP graph).
+    Unless the solver only uses these paths, the roots also include the
+    neighbors of the nodes of the DAG, and the prefix depends on the
+    presence of the edges leaving the nodes of its DAG (e.g. the out-degrees
+    of Merger), and of those changing which nodes of the DAG reach each
+    other through nodes outside of it (e.g. the regions of Merger, as its
+    fake nodes are on the nodes of the DAG).
+    The in-trees towards the roots are shared across the prefixes."""
+    def __init__(self):
+        # (root, seeds) -> (dist, nhs) of the in-tree towards the seeds
+        self._trees = {}
+        # (root, seeds) -> the prefixes depending on that in-tree
+        self._users = collections.defaultdict(set)
+        # prefix -> (its (root, seeds) keys, the edges of its DAG)
+        self._prefixes = {}
+        # (u, v) -> {((root, seeds), u)} for the in-trees using u->v
+        self._edges = collections.defaultdict(set)
+        # (u, v) -> the prefixes whose requirement DAG contains u->v
+        self._dag_edges = collections.defaultdict(set)
+        # prefix -> (the nodes of its DAG, their reach and the routers
+        # crossed, see _reach) for the prefixes
+        # depending on the connectivity around their DAG
+        self._connected = {}
+
+    def __contains__(self, prefix):
+        return prefix in self._prefixes
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def clear(self):
+        self._trees.clear()
+        self._users.clear()
+        self._prefixes.clear()
+        self._edges.clear()
+        self._dag_edges.clear()
+        self._connected.clear()
+
+    @staticmethod
+    def _roots(graph, compact, prefix, dag, dag_local):
+        """Yield the (root, seeds) keys of the in-trees of prefix"""
+        if prefix in graph and any(graph.is_real_route(p, prefix)
+                                   for p in graph.predecessors_iter(prefix)):
+            seeds = (prefix,)
+        elif prefix in dag:
+            seeds = dag.predecessors(prefix)
+        else:
+            seeds = find_sink(dag)
+        yield prefix, frozenset(seeds)
+        roots = set(dag)
+        if not dag_local:
+            roots.update(nei for n in dag if n in compact
+                         for nei in compact.successors_iter(n))
+        for n in roots:
+            if n != prefix:
+                yield n, frozenset((n,))
+
+    @staticmethod
+    def _reach(graph, prefix, nodes):
+        """Return, for each node of the DAG, the nodes of the DAG (or prefix)
+        that it reaches through routers outside of the DAG, along with the
+        set of these routers
+
+        :param nodes: The nodes of the DAG"""
+        stops = set(nodes)
+        stops.add(prefix)
+        reach, crossed = {}, set()
+        for n in nodes:
+            if n not in graph:
+                continue
+            found, seen = set(), set()
+            todo = [n]
+            while todo:
+                for m in graph.successors_iter(todo.pop()):
+                    if m in stops:
+                        found.add(m)
+                    elif m not in seen and graph.is_router(m):
+                        seen.add(m)
+                        todo.append(m)
+            reach[n] = frozenset(found)
+            crossed |= seen
+        return reach, crossed
+
+    def add(self, graph, compact, prefix, dag, dag_local=False):
+        """Index the requirement of prefix, replacing its previous one
+
+        :param graph: The IGP graph
+        :param compact: The CompactIGPGraph of graph
+        :param dag: The requirement DAG, as completed by the solver
+        :param dag_local: Whether the solution of the requirement only
+                          depends on the shortest paths towards prefix and
+                          the nodes of dag"""
+        self.remove(prefix)
+        keys = set()
+        for key in self._roots(graph, compact, prefix, dag, dag_local):
+            keys.add(key)
+            self._users[key].add(prefix)
+            if key in self._trees:
+                continue
+            tree = self._trees[key] = compact.reverse_spt(
+                {n: 0 for n in key[1] if n in compact})
+            for n, nhs in tree[1].iteritems():
+                for nh in nhs:
+                    self._edges[n, nh].add((key, n))
+        dag_edges = dag.edges()
+        for e in dag_edges:
+            self._dag_edges[e].add(prefix)
+        self._prefixes[prefix] = keys, dag_edges
+        if not dag_local:
+            nodes = frozenset(dag)
+            self._connected[prefix] = (nodes,) + self._reach(graph, prefix,
+                                                             nodes)
+
+    def remove(self, prefix):
+        """Stop indexing the requirement of prefix, if any"""
+        try:
+            keys, dag_edges = self._prefixes.pop(prefix)
+        except KeyError:
+            return
+        self._connected.pop(prefix, None)
+        for e in dag_edges:
+            self.__discard(self._dag_edges, e, prefix)
+        for key in keys:
+            self.__discard(self._users, key, prefix)
+            if key in self._users:
+                continue
+            _, nhs = self._trees.pop(key)
+            for n, n_nhs in nhs.iteritems():
+                for nh in n_nhs:
+                    self.__discard(self._edges, (n, nh), (key, n))
+
+    @staticmethod
+    def __discard(index, k, v):
+        values = index[k]
+        values.discard(v)
+        if not values:
+            del index[k]
+
+    def __reach_changed(self, graph, u):
+        """Return the prefixes depending on the connectivity around their
+        DAG whose reach changes now that an edge leaving u was added or
+        removed, and update the reach of the others"""
+        changed = set()
+        for prefix, (nodes, reach, crossed) in self._connected.items():
+            if u in nodes:
+                changed.add(prefix)
+            elif u in crossed:
+                new_reach, new_crossed = self._reach(graph, prefix, nodes)
+                if new_reach != reach:
+                    changed.add(prefix)
+                else:
+                    self._connected[prefix] = nodes, new_reach, new_crossed
+        return changed
+
+    def users(self, u, v):
+        """Return the (root, node) pairs whose shortest paths towards root
+        use the edge u->v"""
+        return set((key[0], n) for key, n in self._edges.get((u, v), ()))
+
+    def affected(self, graph, u, v, old):
+        """Return the prefixes whose solution can change now that the edge
+        u->v has its new state in graph.
+        Removing or increasing the metric of an edge only matters to the
+        in-trees using it, while adding or decreasing the metric of an edge
+        only matters to the in-trees in which it creates a new (or equal)
+        shortest path. Adding or removing an edge also matters to the
+        prefixes depending on the connectivity around their DAG, if it
+        leaves a node of their DAG or changes which of these nodes reach
+        each other.
+
+        :param old: The previous weight of u->v, as given by
+                    ShortestPath.default_weight, None if it was not usable"""
+        w = ShortestPath.default_weight(graph, u, v)
+        if w == old:
+            return set()
+        prefixes = set(self._dag_edges.get((u, v), ()))
+        if w is None or old is None:
+            prefixes.update(self.__reach_changed(graph, u))
+        if w is None or (old is not None and w > old):
+            keys = set(key for key, _ in self._edges.get((u, v), ()))
+        else:
+            keys = set(key for key, (dist, nhs) in self._trees.iteritems()
+                       if ShortestPath.in_tree_changed(dist, nhs, u, v, w))
+        for key in keys:
+            prefixes.update(self._users[key])
+        return prefixes
@@ -1,15 +1,18 @@
 """This file defines Northbound application controller classes."""
 
 import abc
-import copy
+import collections
 from ConfigParser import DEFAULTSECT
 
 import networkx as nx
 
 from fibbingnode.southbound.interface import FakeNodeProxy, ShapeshifterProxy
 from fibbingnode.algorithms.ospf_simple import OSPFSimple
+from fibbingnode.algorithms.utils import overlay
+from fibbingnode.algorithms.sensitivity import SensitivityIndex
 from fibbingnode.misc.sjmp import SJMPClient, ProxyCloner
-from fibbingnode.misc.igp_graph import IGPGraph
+from fibbingnode.misc.igp_graph import IGPGraph, SPTCache, ShortestPath,\
+        CompactIGPGraph
 from fibbingnode import CFG
 from fibbingnode import log
 
@@ -193,25 +196,156 @@ class SouthboundManager(SouthboundController):
                  *args, **kwargs):
         self.additional_routes = additional_routes
         self.current_lsas = set([])
-        self.optimizer = optimizer if optimizer else OSPFSimple()
+        self.optimizer = optimizer if optimizer else OSPFSimple(
+            processes=CFG.getint(DEFAULTSECT, 'solver_processes') or None)
         self.fwd_dags = fwd_dags if fwd_dags else {}
         self.has_initial_topo = False
+        # The SPTs of igp_graph, shared across the solves on a topology
+        # and repaired on every edge change
+        cache_size = CFG.getint(DEFAULTSECT, 'spt_cache_size')
+        processes = CFG.getint(DEFAULTSECT, 'spt_processes')
+        self.spt_cache = SPTCache(lazy=cache_size > 0,
+                                  cache_size=cache_size or None,
+                                  processes=processes or None)
+        # prefix -> the LSAs implementing its requirement on the current
+        # topology, only the prefixes missing from it are solved again
+        self._solutions = {}
+        # The IGP edges on which these solutions depend
+        self._sensitivity = SensitivityIndex()
+        # prefix -> the context of its solution, for the optimizers whose
+        # solutions depend on the prefixes solved before (dest_contexts)
+        self._contexts = {}
+        # The prefixes affected by the topology changes of the last commit
+        self.affected_prefixes = set()
+        self._pending_prefixes = set()
+        # The SolverStats of the last solve, if the optimizer records them
+        self.solver_stats = None
         super(SouthboundManager, self).__init__(*args, **kwargs)
 
+    def add_edge(self, source, destination, properties={'metric': 1}):
+        version = self.igp_graph.version
+        old = ShortestPath.default_weight(self.igp_graph, source, destination)
+        super(SouthboundManager, self).add_edge(source, destination,
+                                                properties)
+        self.spt_cache.repair(self.igp_graph, version, (source, destination))
+        self._edge_changed(source, destination, old)
+
+    def remove_edge(self, source, destination):
+        version = self.igp_graph.version
+        old = [(u, v, ShortestPath.default_weight(self.igp_graph, u, v))
+               for u, v in ((source, destination), (destination, source))]
+        super(SouthboundManager, self).remove_edge(source, destination)
+        self.spt_cache.repair(self.igp_graph, version,
+                              (source, destination), (destination, source))
+        for u, v, w in old:
+            self._edge_changed(u, v, w)
+
+    def update_node_properties(self, **properties):
+        super(SouthboundManager, self).update_node_properties(**properties)
+        self._pending_prefixes.update(self.fwd_dags)
+        self._forget_all()
+
+    def commit(self):
+        stale, _ = self._stale_prefixes()
+        self.affected_prefixes = self._pending_prefixes | stale
+        self._pending_prefixes = set()
+        if self.dirty and not stale:
+            log.debug('The topology changes do not affect any requirement')
+            self.dirty = False
+        elif self.affected_prefixes:
+            log.info('The topology changes affect the prefixes: %s',
+                     self.affected_prefixes)
+        super(SouthboundManager, self).commit()
+
+    def _forget(self, prefix):
+        """Solve the requirement of prefix again on the next refresh"""
+        self._solutions.pop(prefix, None)
+        self._contexts.pop(prefix, None)
+        self._sensitivity.remove(prefix)
+
+    def _forget_all(self):
+        self._solutions.clear()
+        self._contexts.clear()
+        self._sensitivity.clear()
+
+    def _stale_prefixes(self):
+        """Return the prefixes whose requirement must be solved again: those
+        without a solution for the current topology, and those whose
+        solution was computed in another context, along with the current
+        contexts (None if the optimizer does not depend on them)"""
+        stale = set(p for p in self.fwd_dags if p not in self._solutions)
+        dest_contexts = getattr(self.optimizer, 'dest_contexts', None)
+        if dest_contexts is None:
+            return stale, None
+        contexts = dest_contexts(self.igp_graph, self.fwd_dags)
+        stale.update(p for p, c in contexts.iteritems()
+                     if p in self._solutions and self._contexts.get(p) != c)
+        return stale, contexts
+
+    def _edge_changed(self, u, v, old):
+        """Forget the solutions of the prefixes affected by the new state of
+        the edge u->v
+
+        :param old: The previous weight of u->v"""
+        affected = self._sensitivity.affected(self.igp_graph, u, v, old)
+        if affected:
+            log.debug('%s->%s changed the requirements of %s',
+                      u, v, affected)
+            self._pending_prefixes.update(affected)
+            for prefix in affected:
+                self._forget(prefix)
+
+    def _solve_stale_prefixes(self):
+        """Solve the requirements of the stale prefixes, and reuse the
+        solutions of the other prefixes.
+        The optimizer still walks all the requirements, in the order of
+        fwd_dags, and only inserts the other prefixes. As a solution only
+        depends on the prefixes before it through its context, this yields
+        the same LSAs as solving all the requirements again"""
+        for prefix in set(self._solutions).difference(self.fwd_dags):
+            self._forget(prefix)
+        stale, contexts = self._stale_prefixes()
+        if not stale:
+            log.debug('Reusing the solutions of all prefixes')
+            return
+        log.info('Solving the requirements of %d/%d prefixes',
+                 len(stale), len(self.fwd_dags))
+        # The solvers get copy-on-write views of the graph and DAGs
+        graph = self.igp_graph.overlay()
+        dags = collections.OrderedDict((p, overlay(dag))
+                                       for p, dag in self.fwd_dags.iteritems())
+        lsas = self.optimizer.solve(graph, dags,
+                                    spt=self.spt_cache.get(graph),
+                                    dests=stale)
+        self.solver_stats = getattr(self.optimizer, 'stats', None)
+        log.info('Solver statistics: %s', self.solver_stats)
+        log.debug('SPT cache: %s', self.spt_cache.cache_info())
+        solutions = {p: [] for p in stale}
+        for lsa in lsas:
+            solutions.setdefault(lsa.dest, []).append(lsa)
+        compact = CompactIGPGraph(self.igp_graph)
+        dag_local = getattr(self.optimizer, 'dag_local', False)
+        for prefix in stale:
+            # The solver completed the DAG with the paths it relies on
+            self._sensitivity.add(self.igp_graph, compact, prefix,
+                                  dags[prefix], dag_local=dag_local)
+            if contexts is not None:
+                self._contexts[prefix] = contexts[prefix]
+        self._solutions.update(solutions)
+
     def refresh_augmented_topo(self):
         log.info('Solving topologies')
         if not self.json_proxy.alive() or not self.has_initial_topo:
             log.debug('Skipping as we do not yet have a topology')
             return self.advertized_lsa
         try:
-            self.optimizer.solve(self.igp_graph.copy(),
-                                 {p: dag.copy()
-                                  for p, dag in self.fwd_dags.iteritems()})
+            self._solve_stale_prefixes()
         except Exception as e:
             log.exception(e)
             return self.advertized_lsa
         else:
-            return set(self.optimizer.get_fake_lsas())
+            return set(lsa for lsas in self._solutions.itervalues()
+                       for lsa in lsas)
 
     def simple_path_requirement(self, prefix, path):
         """Add a path requirement for the given prefix.
@@ -221,10 +355,12 @@ class SouthboundManager(SouthboundController):
                      used as requirements: [](A, B), (B, C), (C, D)]"""
         self.fwd_dags[prefix] = IGPGraph(
                 [(s, d) for s, d in zip(path[:-1], path[1:])])
+        self._forget(prefix)
         self.refresh_lsas()
 
     def add_dag_requirement(self, prefix, dag):
         self.fwd_dags[prefix] = dag.copy()
+        self._forget(prefix)
         self.refresh_lsas()
 
     def add_dag_requirements_from(self, fw_dags):
@@ -232,16 +368,21 @@ class SouthboundManager(SouthboundController):
         Adds a bunch of fw dag requirements
         :param fw_dags: dictionary prefix -> dag
         """
-        self.fwd_dags.update(copy.deepcopy(fw_dags))
+        self.fwd_dags.update((prefix, dag.copy())
+                             for prefix, dag in fw_dags.iteritems())
+        for prefix in fw_dags:
+            self._forget(prefix)
         self.refresh_lsas()
 
     def remove_dag_requirement(self, prefix):
         if prefix in self.fwd_dags.keys():
             self.fwd_dags.pop(prefix)
+            self._forget(prefix)
             self.refresh_lsas()
 
     def remove_all_dag_requirements(self):
         self.fwd_dags.clear()
+        self._forget_all()
         self.refresh_lsas()
 
     def received_initial_graph(self):
@@ -1,7 +1,9 @@
 import heapq
 import sys
-import functools
+import time
+import contextlib
 import collections
+import multiprocessing
 from fibbingnode import log as log
 from fibbingnode.misc.utils import extend_paths_list, is_container
 import networkx as nx
@@ -27,10 +29,320 @@ def add_separate_destination_to_sinks(destination, input_topo, dag, cost=1):
     return destination
 
 
-def all_shortest_paths(g, metric='metric'):
+def all_shortest_paths(g, metric='metric', processes=1):
     """Return all shortest paths for all pairs of node in the graph
-    :type g: DiGraph"""
-    return {n: single_source_all_sp(g, n, metric=metric) for n in g}
+    :type g: DiGraph
+    :param processes: The number of processes to use, None for all CPUs"""
+    if processes == 1 or len(g) < 2:
+        return {n: single_source_all_sp(g, n, metric=metric) for n in g}
+    # Only send the metrics of the edges to the workers
+    adj = {u: {v: {metric: d.get(metric, 1)} for v, d in g[u].iteritems()}
+           for u in g}
+    processes = processes or multiprocessing.cpu_count()
+    sources = list(g)
+    chunk_size = max(1, len(sources) // (processes * 4))
+    pool = multiprocessing.Pool(processes, initializer=_init_sp_worker,
+                                initargs=(adj, metric))
+    try:
+        results = pool.map(_sp_worker,
+                           [sources[i:i + chunk_size]
+                            for i in xrange(0, len(sources), chunk_size)])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return {n: sp for result in results for n, sp in result}
+
+
+# The adjacency and metric given to the workers of all_shortest_paths
+_worker_adj = _worker_metric = None
+
+
+def _init_sp_worker(adj, metric):
+    global _worker_adj, _worker_metric
+    _worker_adj, _worker_metric = adj, metric
+
+
+def _sp_worker(sources):
+    return [(n, single_source_all_sp(_worker_adj, n, metric=_worker_metric))
+            for n in sources]
+
+
+def solve_per_destination(solver, requirements, processes=1, graph=None,
+                          dests=None):
+    """Solve each requirement with solver.solve_dest(dest, dag), and return
+    the concatenation of the resulting lists of LSAs.
+    The destinations are solved in the order of requirements. The solvers
+    whose solutions depend on the destinations solved before (e.g. as they
+    are inserted in the graph) define solver.insert_dest(dest, dag), which
+    makes the same changes as solving dest without solving it. It is called
+    for the destinations that are not solved in a process, so that each
+    destination is solved in the same state whatever the process count.
+    The workers are forked from this process, thus share the state of the
+    solver (e.g. its SPT), and keep the changes made to it while solving to
+    themselves. The changes made to the requirement DAGs (e.g. completing
+    them with the shortest paths) are copied back into requirements.
+
+    The destinations that ran out of time in the workers are added to the
+    timed_out set of the solver, and their SolverStats to its stats, if it
+    has them.
+
+    :param requirements: {dest: requirement DAG}
+    :param processes: The number of processes to use, None for all CPUs
+    :param graph: The IGP graph before any destination was inserted in it.
+                  If set, only solve one destination per class of
+                  destination_classes, and reuse its LSAs and the changes
+                  made to its DAG for the others. The solvers defining
+                  solver.dest_contexts(graph, requirements) only group
+                  destinations with the same context.
+    :param dests: The destinations to solve and return the LSAs of, the
+                  others are only inserted. None to solve all of them."""
+    if dests is not None:
+        dests = set(dests)
+    selected = collections.OrderedDict(
+        (d, dag) for d, dag in requirements.iteritems()
+        if dests is None or d in dests)
+    if graph is None:
+        return _solve_each(solver, requirements, selected, processes)
+    contexts = getattr(solver, 'dest_contexts', None)
+    classes = destination_classes(
+        graph, selected,
+        contexts=(contexts(graph, requirements) if contexts is not None
+                  else None))
+    lsas = _solve_each(solver, requirements, classes, processes)
+    members = {m: rep for rep, ms in classes.iteritems() for m in ms}
+    if not members:
+        return lsas
+    log.info('Solved %d destinations for %d requirements',
+             len(classes), len(selected))
+    timed_out = getattr(solver, 'timed_out', None)
+    if timed_out is not None:
+        timed_out.update(m for m, rep in members.iteritems()
+                         if rep in timed_out)
+    stats = getattr(solver, 'stats', None)
+    for rep, ms in classes.iteritems():
+        if not ms:
+            continue
+        if stats is not None:
+            stats.count(rep, equivalent_dests=len(ms))
+        for m in ms:
+            _copy_dag(requirements[rep], rep, requirements[m], m)
+    solved = collections.defaultdict(list)
+    for lsa in lsas:
+        solved[lsa.dest].append(lsa)
+    return [lsa if dest not in members else lsa._replace(dest=dest)
+            for dest in selected
+            for lsa in solved[members.get(dest, dest)]]
+
+
+def destination_classes(graph, requirements, contexts=None):
+    """Group the destinations that can be implemented by the same LSAs, up
+    to their destination field: those attached to the same nodes with the
+    same edge attributes in graph, and with the same requirement DAG once
+    their own name is left out.
+
+    :param requirements: {dest: requirement DAG}
+    :param contexts: {dest: the state, besides graph and its DAG, that the
+                      solution of dest depends on}, if any
+    :return: {representative: [the other destinations of its class]}, in
+             the order of requirements"""
+    classes = collections.OrderedDict()
+    reps = {}
+    for dest, dag in requirements.iteritems():
+        key = _destination_key(graph, dest, dag)
+        if contexts is not None:
+            key = key, contexts[dest]
+        try:
+            rep = reps.setdefault(key, dest)
+        except TypeError:  # Unhashable attributes, keep it on its own
+            rep = dest
+        members = classes.setdefault(rep, [])
+        if rep != dest:
+            members.append(dest)
+    return classes
+
+
+def destination_attachments(graph, dest, dag):
+    """Return the nodes of graph from which add_dest_to_graph adds an edge
+    towards dest, when inserting it for its requirement dag as the solvers
+    do, without changing graph nor dag"""
+    if dest in graph and not _is_fake_dest(graph, dest):
+        return []
+    dag = overlay(dag)
+    add_dest_to_graph(dest, dag)
+    return [n for n in dag.predecessors_iter(dest)
+            if not graph.has_edge(n, dest)]
+
+
+def _destination_key(graph, dest, dag):
+    def name(n):
+        return None if n == dest else n
+
+    def attrs(data):
+        return tuple(sorted(data.iteritems()))
+
+    attachments = None
+    if dest in graph:
+        attachments = (
+            frozenset((p, attrs(graph[p][dest]))
+                      for p in graph.predecessors_iter(dest)),
+            frozenset((s, attrs(data))
+                      for s, data in graph[dest].iteritems()))
+    return (attachments,
+            frozenset(name(n) for n in dag),
+            frozenset((name(u), name(v), attrs(data))
+                      for u, v, data in dag.edges_iter(data=True)))
+
+
+def _copy_dag(src, src_dest, dst, dst_dest):
+    """Add the nodes and edges of the requirement DAG src of src_dest to the
+    one of dst_dest"""
+    def name(n):
+        return dst_dest if n == src_dest else n
+
+    dst.add_nodes_from(name(n) for n in src)
+    for u, v, data in src.edges_iter(data=True):
+        if not dst.has_edge(name(u), name(v)):
+            dst.add_edge(name(u), name(v), **data)
+
+
+def _solve_each(solver, requirements, dests, processes):
+    """Solve the destinations of dests, in the order of requirements"""
+    if processes == 1 or len(dests) < 2:
+        return _solve_in_order(solver, requirements, dests)
+    processes = processes or multiprocessing.cpu_count()
+    dests = list(dests)
+    chunk_size = max(1, len(dests) // (processes * 4))
+    pool = multiprocessing.Pool(processes, initializer=_init_solve_worker,
+                                initargs=(solver, requirements),
+                                maxtasksperchild=1)
+    try:
+        results = pool.map(_solve_worker,
+                           [dests[i:i + chunk_size]
+                            for i in xrange(0, len(dests), chunk_size)],
+                           chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    for _, _, _, dags in results:
+        for dest, dag in dags:
+            _copy_dag(dag, dest, requirements[dest], dest)
+    timed_out = getattr(solver, 'timed_out', None)
+    if timed_out is not None:
+        timed_out.update(d for _, dests, _, _ in results for d in dests)
+    stats = getattr(solver, 'stats', None)
+    if stats is not None:
+        for _, _, worker_stats, _ in results:
+            stats.update(worker_stats)
+    return [lsa for lsas, _, _, _ in results for lsa in lsas]
+
+
+def _solve_in_order(solver, requirements, dests):
+    """Walk requirements up to the last of dests, solving those in dests,
+    and inserting the others if the solver depends on them"""
+    insert = getattr(solver, 'insert_dest', None)
+    left, lsas = set(dests), []
+    for dest, dag in requirements.iteritems():
+        if not left:
+            break
+        if dest in left:
+            left.discard(dest)
+            lsas.extend(solver.solve_dest(dest, dag))
+        elif insert is not None:
+            insert(dest, dag)
+    return lsas
+
+
+# The solver and requirements given to the workers of solve_per_destination
+_worker_solver = _worker_reqs = None
+
+
+def _init_solve_worker(solver, requirements):
+    global _worker_solver, _worker_reqs
+    _worker_solver, _worker_reqs = solver, requirements
+    # Only report what the worker did to the parent
+    if getattr(solver, 'stats', None) is not None:
+        solver.stats = SolverStats()
+
+
+def _solve_worker(dests):
+    # Each worker is forked for a single chunk, and first inserts the
+    # destinations before it
+    lsas = _solve_in_order(_worker_solver, _worker_reqs, dests)
+    return (lsas, list(getattr(_worker_solver, 'timed_out', ())),
+            getattr(_worker_solver, 'stats', None),
+            [(dest, _worker_reqs[dest]) for dest in dests])
+
+
+class SolverStats(object):
+    """The wall-clock and CPU time spent by a solve in each of its phases,
+    and its counters (e.g. heap operations, merges, LSAs, hits and misses
+    of memoized queries), per destination.
+    The steps that are not specific to a destination are recorded under the
+    None destination."""
+    def __init__(self):
+        # dest -> {phase: [wall time, cpu time]}
+        self.times = collections.OrderedDict()
+        # dest -> Counter
+        self.counters = collections.OrderedDict()
+
+    def clear(self):
+        self.times.clear()
+        self.counters.clear()
+
+    @contextlib.contextmanager
+    def phase(self, name, dest=None):
+        """Add the time spent in the enclosed block to the phase name of
+        dest"""
+        wall, cpu = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - wall, time.clock() - cpu, dest)
+
+    def add_time(self, name, wall, cpu, dest=None):
+        t = self.times.setdefault(dest, collections.OrderedDict())\
+            .setdefault(name, [0, 0])
+        t[0] += wall
+        t[1] += cpu
+
+    def count(self, dest=None, **counts):
+        """Add counts to the counters of dest"""
+        self.counters.setdefault(dest, collections.Counter()).update(counts)
+
+    def update(self, other):
+        """Add the times and counters of another SolverStats to these"""
+        for dest, phases in other.times.iteritems():
+            for name, (wall, cpu) in phases.iteritems():
+                self.add_time(name, wall, cpu, dest)
+        for dest, counts in other.counters.iteritems():
+            self.count(dest, **counts)
+
+    def phase_totals(self):
+        """Return {phase: [wall time, cpu time]} over all destinations"""
+        totals = collections.OrderedDict()
+        for phases in self.times.itervalues():
+            for name, (wall, cpu) in phases.iteritems():
+                t = totals.setdefault(name, [0, 0])
+                t[0] += wall
+                t[1] += cpu
+        return totals
+
+    def totals(self):
+        """Return the sum of the counters of all destinations"""
+        return sum(self.counters.itervalues(), collections.Counter())
+
+    def __repr__(self):
+        return 'SolverStats(%s; %s)' % (
+            ', '.join('%s: %.3fs wall/%.3fs cpu' % (name, wall, cpu)
+                      for name, (wall, cpu)
+                      in self.phase_totals().iteritems()),
+            ', '.join('%s: %s' % kv for kv in sorted(self.totals().items())))
 
 
 def single_source_all_sp(g, source, metric='metric'):
@@ -80,40 +392,156 @@ def dag_paths_from_leaves(dag, target):
     return paths
 
 
-class MaxHeap(object):
+class IndexedMaxHeap(object):
+    """A max-heap of unique items, whose keys can be changed in O(log n).
+    Ties between keys are broken by comparing the items."""
     def __init__(self, initial_elem=()):
-        self.pq = map(_ReverseCompare, initial_elem)
-        heapq.heapify(self.pq)
-
-    def push(self, *item):
-        for i in item:
-            heapq.heappush(self.pq, _ReverseCompare(i))
+        """:param initial_elem: (key, item) pairs, the last key of an item
+                                wins"""
+        self._pos = {}
+        for key, item in initial_elem:
+            self._pos[item] = key
+        self._items = self._pos.keys()
+        self._keys = [self._pos[item] for item in self._items]
+        for i, item in enumerate(self._items):
+            self._pos[item] = i
+        # The number of insertions, updates and removals so far
+        self.operations = len(self._items)
+        for i in reversed(xrange(len(self._items) // 2)):
+            self._sift_down(i)
+
+    def _higher(self, i, j):
+        ki, kj = self._keys[i], self._keys[j]
+        return ki > kj or (ki == kj and self._items[i] > self._items[j])
+
+    def _swap(self, i, j):
+        keys, items = self._keys, self._items
+        keys[i], keys[j] = keys[j], keys[i]
+        items[i], items[j] = items[j], items[i]
+        self._pos[items[i]] = i
+        self._pos[items[j]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) >> 1
+            if not self._higher(i, parent):
+                break
+            self._swap(i, parent)
+            i = parent
+        return i
+
+    def _sift_down(self, i):
+        n = len(self._keys)
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and self._higher(child + 1, child):
+                child += 1
+            if not self._higher(child, i):
+                break
+            self._swap(i, child)
+            i = child
+        return i
+
+    def push_or_update(self, key, item):
+        """Insert item in the heap, or change its key if already present"""
+        self.operations += 1
+        i = self._pos.get(item)
+        if i is None:
+            i = self._pos[item] = len(self._keys)
+            self._keys.append(key)
+            self._items.append(item)
+        else:
+            self._keys[i] = key
+        self._sift_down(self._sift_up(i))
 
     def pop(self):
-        return heapq.heappop(self.pq).obj
+        """Remove and return the (key, item) pair with the highest key"""
+        if not self._keys:
+            raise IndexError('pop from an empty heap')
+        key, item = self._keys[0], self._items[0]
+        self.__remove_at(0)
+        return key, item
+
+    def remove(self, item):
+        """Remove item from the heap, raise KeyError if it is absent"""
+        self.__remove_at(self._pos[item])
+
+    def __remove_at(self, i):
+        self.operations += 1
+        last = len(self._keys) - 1
+        if i != last:
+            self._swap(i, last)
+        self._keys.pop()
+        del self._pos[self._items.pop()]
+        if i != last:
+            self._sift_down(self._sift_up(i))
+
+    def key(self, item):
+        """Return the key of item, raise KeyError if it is absent"""
+        return self._keys[self._pos[item]]
 
     def is_empty(self):
-        return len(self.pq) == 0
+        return not self._keys
 
-    def __repr__(self):
-        return ', '.join(str(item) for item in self.pq)
-
-
-# http://stackoverflow.com/questions/12681772
-# CC BY-SA 3.0
-@functools.total_ordering
-class _ReverseCompare(object):
-    def __init__(self, obj):
-        self.obj = obj
+    def __len__(self):
+        return len(self._keys)
 
-    def __eq__(self, other):
-        return self.obj == other.obj
-
-    def __le__(self, other):
-        return self.obj >= other.obj
+    def __contains__(self, item):
+        return item in self._pos
 
     def __repr__(self):
-        return repr(self.obj)
+        return ', '.join(str(x) for x in zip(self._keys, self._items))
+
+
+class NextHopIndex(object):
+    """Number the neighbors of each node locally, in order to store its
+    next-hop sets as bitsets whose bit k stands for its k-th neighbor.
+    A node is numbered on first use, starting with its successors in the
+    graph; its other next hops (e.g. a destination not yet in the graph)
+    get the next free bits."""
+    def __init__(self, graph):
+        """:param graph: The graph (or CompactIGPGraph) numbering the
+                         neighbors"""
+        self.graph = graph
+        # node -> ([neighbor names], {neighbor name: bit})
+        self._nbrs = {}
+
+    def _neighbors(self, n):
+        try:
+            return self._nbrs[n]
+        except KeyError:
+            names = (list(self.graph.successors_iter(n))
+                     if n in self.graph else [])
+            nbrs = self._nbrs[n] = names, {m: k for k, m in enumerate(names)}
+            return nbrs
+
+    def bit(self, n, nh):
+        """Return the bit of the next hop nh of n, None if it has none"""
+        return self._neighbors(n)[1].get(nh)
+
+    def bits(self, n, nhs):
+        """Return the bitset of the next hops nhs of n"""
+        names, ids = self._neighbors(n)
+        bits = 0
+        for m in nhs:
+            k = ids.get(m)
+            if k is None:
+                k = ids[m] = len(names)
+                names.append(m)
+            bits |= 1 << k
+        return bits
+
+    def names(self, n, bits):
+        """Iterate over the names of the next hops of n in the bitset bits"""
+        names = self._neighbors(n)[0]
+        k = 0
+        while bits:
+            if bits & 1:
+                yield names[k]
+            bits >>= 1
+            k += 1
 
 
 """A tuple whose fields can be accessed by their names representing a LSA"""
@@ -152,6 +580,15 @@ def _add_fake_route(g, n, d, **kw):
         g.add_edge(n, d, **kw)
 
 
+def overlay(g):
+    """Return a copy-on-write view of g if possible, a copy otherwise"""
+    try:
+        return g.overlay()
+    except AttributeError:  # Not an IGPGraph
+        log.debug('Copying graph')
+        return g.copy()
+
+
 def _is_fake_dest(g, d):
     """Test whether d is reachable through at least one non-fake link"""
     try:
@@ -224,30 +661,11 @@ def _update_paths_towards(spt, g, dest, added_edges):
 
 
 def __update_default_paths(spt, g, dest, added):
-    spt._default_paths[dest] = {dest: [[dest]]}
-    spt._default_dist[dest] = {dest: 0}
-    for n in g.routers:
-        paths = []
-        cost = sys.maxint
-        for s in added:
-            try:
-                c = spt.default_cost(n, s) + g.metric(s, dest)
-            except KeyError:  # No path from n to s, skip
-                continue
-            p = spt.default_path(n, s)
-            if c < cost:  # new spt towards s is n-p-s
-                paths = list(extend_paths_list(p, dest))
-                cost = c
-            elif c == cost:  # ecmp
-                paths.extend(extend_paths_list(p, dest))
-        if paths:
-            log.debug('Adding paths (cost: %s): %s', cost, paths)
-            spt._default_paths[n][dest] = paths
-            spt._default_dist[n][dest] = cost
+    spt.add_destination(g, dest, added)
 
 
 def __update_fibbed_paths(spt, g, dest, added):
-    pass
+    spt.update_fibbed(g, dest)
 
 
 def complete_dag(dag, graph, dest, paths, skip=()):
@@ -255,19 +673,24 @@ def complete_dag(dag, graph, dest, paths, skip=()):
     destinations that are not yet in the dag
 
     :param dag: the dag to complete
-    :param graph: the graph to explore
+    :param graph: the graph to explore, either an IGPGraph or a
+                  CompactIGPGraph snapshot of it
     :param dest: the destination to consider
     :param paths: a ShortestPath object
     :param skip: nodes that must not be considered"""
-    for n in filter(lambda r: (r not in dag and r not in skip and
-                               graph.successors(r)),
-                    graph.routers):
-        for p in paths.default_path(n, dest):
-            for u, v in zip(p[:-1], p[1:]):
-                v_in_dag = v in dag
-                dag.add_edge(u, v)
-                if v_in_dag:  # we connected u to the new SPT
-                    break
+    to_visit = filter(lambda r: (r not in dag and r not in skip and
+                                 graph.successors(r)),
+                      graph.routers)
+    visited = set(to_visit)
+    while to_visit:
+        u = to_visit.pop()
+        for v in paths.successors_to(u, dest):
+            v_in_dag = v in dag
+            dag.add_edge(u, v)
+            if not v_in_dag and v not in visited and v not in skip:
+                # v is a new node in the dag, also connect it to the SPT
+                visited.add(v)
+                to_visit.append(v)
 
 
 def solvable(dag, graph):
@@ -1,13 +1,19 @@
 """This module provides a structure to represent an IGP topology"""
 import os
 import sys
+import copy
 import heapq
+import weakref
+import collections
+import multiprocessing
+from array import array
 import networkx as nx
-from itertools import count
+from copy import deepcopy
+from itertools import count, chain
 
 from fibbingnode import log
 import fibbingnode.algorithms.utils as ssu
-from fibbingnode.misc.utils import extend_paths_list, is_container
+from fibbingnode.misc.utils import is_container, LRUCache
 
 # The draw_graph call will be remapped to 'nothing' if matplotlib (aka extra
 # packages) is not available
@@ -48,12 +54,625 @@ LOCAL = 'target'
 MULTIPLICITY_KEY = 'multiplicity'
 
 
+# The attributes defining the role of a node or of an edge
+_ROLE_KEYS = frozenset(('router', 'prefix', 'controller', FAKE, LOCAL))
+# The attributes whose changes alter the topology seen by the SPT
+_WATCHED_KEYS = _ROLE_KEYS | frozenset((METRIC,))
+# The source of the topology versions of the graphs
+_versions = count()
+
+
+class _Attrs(dict):
+    """The attributes of a node or an edge, notifying the graphs holding them
+    whenever an attribute defining the role or the metric of their element
+    changes"""
+    __slots__ = ('_watchers',)
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self._watchers = []
+
+    def _watch(self, graph, key, is_edge):
+        for ref, k, e in self._watchers:
+            if ref() is graph and k == key and e == is_edge:
+                return
+        self._watchers.append((weakref.ref(graph), key, is_edge))
+
+    def _notify(self, *keys):
+        if not self._watchers or _WATCHED_KEYS.isdisjoint(keys):
+            return
+        watchers = []
+        for ref, key, is_edge in self._watchers:
+            g = ref()
+            if g is None:
+                continue
+            watchers.append((ref, key, is_edge))
+            if is_edge:
+                g._edge_changed(*key)
+            else:
+                g._node_changed(key)
+        self._watchers = watchers
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._notify(key)
+
+    def __delitem__(self, key):
+        super(_Attrs, self).__delitem__(key)
+        self._notify(key)
+
+    def update(self, *args, **kw):
+        dict.update(self, *args, **kw)
+        if self._watchers:
+            self._notify(*self.iterkeys())
+
+    def setdefault(self, key, default=None):
+        v = super(_Attrs, self).setdefault(key, default)
+        self._notify(key)
+        return v
+
+    def pop(self, key, *default):
+        v = super(_Attrs, self).pop(key, *default)
+        self._notify(key)
+        return v
+
+    def popitem(self):
+        k, v = super(_Attrs, self).popitem()
+        self._notify(k)
+        return k, v
+
+    def clear(self):
+        keys = self.keys()
+        super(_Attrs, self).clear()
+        self._notify(*keys)
+
+    # Copies are plain, unwatched, dicts
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {k: deepcopy(v, memo) for k, v in self.iteritems()}
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+def _copy_attrs(attrs, memo):
+    """Return an unwatched _Attrs holding a deep copy of attrs"""
+    return _Attrs((k, v if type(v) in _ATOMIC else deepcopy(v, memo))
+                  for k, v in dict.iteritems(attrs))
+
+
+# The types of the attribute values that copies can share
+_ATOMIC = frozenset((int, long, float, bool, str, unicode, type(None)))
+
+
+class _NodeMap(dict):
+    """The node -> attributes map of an IGPGraph"""
+
+    def __init__(self, graph):
+        super(_NodeMap, self).__init__()
+        self._graph = graph
+
+    def __setitem__(self, n, attrs):
+        attrs = _unwrap(attrs)
+        if not isinstance(attrs, _Attrs):
+            attrs = _Attrs(attrs)
+        attrs._watch(self._graph, n, False)
+        dict.__setitem__(self, n, attrs)
+        self._graph._node_changed(n)
+
+    def __delitem__(self, n):
+        super(_NodeMap, self).__delitem__(n)
+        self._graph._node_changed(n)
+
+    def update(self, *args, **kw):
+        for n, attrs in dict(*args, **kw).iteritems():
+            self[n] = attrs
+
+
+class _AdjMap(dict):
+    """The node -> neighbors map of an IGPGraph, either succ or pred"""
+
+    def __init__(self, graph):
+        super(_AdjMap, self).__init__()
+        self._graph = graph
+
+    def __setitem__(self, n, nbrs):
+        nbrs = _unwrap(nbrs)
+        if not isinstance(nbrs, _Neighbors) or nbrs._map is not None:
+            nbrs = _Neighbors(nbrs)
+        nbrs._map, nbrs._node = self, n
+        dict.__setitem__(self, n, nbrs)
+        for v in nbrs.keys():
+            nbrs[v] = nbrs[v]  # Bind the edge attributes
+
+    def __delitem__(self, n):
+        nbrs = dict.__getitem__(self, n)
+        super(_AdjMap, self).__delitem__(n)
+        if self is self._graph.succ:
+            for v in nbrs:
+                self._graph._edge_changed(n, v)
+
+
+class _Neighbors(dict):
+    """The neighbor -> edge attributes map of a node in an IGPGraph"""
+    __slots__ = ('_map', '_node')
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self._map = self._node = None
+
+    def __setitem__(self, v, data):
+        data = _unwrap(data)
+        if not isinstance(data, _Attrs):
+            data = _Attrs(data)
+        dict.__setitem__(self, v, data)
+        # Edges are stored in both succ and pred, only track them in succ
+        adj = self._map
+        if adj is not None and adj is adj._graph.succ:
+            graph = adj._graph
+            data._watch(graph, (self._node, v), True)
+            graph._edge_changed(self._node, v)
+
+    def __delitem__(self, v):
+        super(_Neighbors, self).__delitem__(v)
+        if self._map is not None and self._map is self._map._graph.succ:
+            self._map._graph._edge_changed(self._node, v)
+
+    def _own(self, v):
+        return dict.__getitem__(self, v)
+
+
+class _OverlayMixin(object):
+    """Return the values of an overlay map through __getitem__, so that
+    they are only handed out through copy-on-write views"""
+
+    def get(self, k, default=None):
+        return self[k] if k in self else default
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return self[k]
+
+    def pop(self, k, *default):
+        if k not in self:
+            return dict.pop(self, k, *default)
+        value = self[k]
+        del self[k]
+        return value
+
+    def itervalues(self):
+        for k in self.keys():
+            yield self[k]
+
+    def iteritems(self):
+        for k in self.keys():
+            yield k, self[k]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def _shared(self, k):
+        """Return the current value of k, which must not be changed"""
+        return dict.__getitem__(self, k)
+
+
+class _SharedView(collections.MutableMapping):
+    """A view of a value that an overlay map (its container) may share with
+    its base. It reads the current value of its key in the container, and
+    has the container copy it before the first change"""
+
+    def __init__(self, container, key):
+        self._container, self._key = container, key
+
+    def _current(self):
+        return self._container._shared(self._key)
+
+    def _owned(self):
+        """Return the value of the overlay, copying it if needed"""
+        return self._container._own(self._key)
+
+    def __getitem__(self, k):
+        return self._current()[k]
+
+    def __setitem__(self, k, v):
+        self._owned()[k] = v
+
+    def __delitem__(self, k):
+        del self._owned()[k]
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+    def __contains__(self, k):
+        return k in self._current()
+
+    def __repr__(self):
+        return repr(self._current())
+
+    # Copies are plain dicts
+    def copy(self):
+        return dict(self.iteritems())
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return {k: deepcopy(v, memo) for k, v in self.iteritems()}
+
+    def __reduce__(self):
+        return dict, (self.copy(),)
+
+
+def _unwrap(value):
+    """Return the value of the overlay behind a _SharedView"""
+    # Exact type test, as isinstance is slow on abstract base classes
+    return value._owned() if type(value) in _SHARED_VIEWS else value
+
+
+class _SharedNeighbors(_SharedView):
+    """A view of the neighbors of a node that an overlay may share with its
+    base, handing out views of the edge attributes"""
+
+    def __getitem__(self, v):
+        nbrs = self._current()
+        if isinstance(nbrs, _OverlayNeighbors):
+            return nbrs[v]
+        dict.__getitem__(nbrs, v)  # Raise KeyError for unknown neighbors
+        return _SharedView(self, v)
+
+    def _shared(self, v):
+        return dict.__getitem__(self._current(), v)
+
+    def _own(self, v):
+        return self._owned()._own(v)
+
+
+_SHARED_VIEWS = (_SharedView, _SharedNeighbors)
+
+
+class _OverlayNodeMap(_OverlayMixin, _NodeMap):
+    """The node -> attributes map of an overlay, sharing the attributes of
+    its base until they are first changed"""
+
+    def __init__(self, graph, base):
+        super(_OverlayNodeMap, self).__init__(graph)
+        dict.update(self, base)
+        self._owned = set()
+
+    def __getitem__(self, n):
+        attrs = dict.__getitem__(self, n)
+        if n in self._owned:
+            return attrs
+        return _SharedView(self, n)
+
+    def _own(self, n):
+        attrs = dict.__getitem__(self, n)
+        if n not in self._owned:
+            attrs = _Attrs(attrs)
+            attrs._watch(self._graph, n, False)
+            dict.__setitem__(self, n, attrs)
+            self._owned.add(n)
+        return attrs
+
+    def __setitem__(self, n, attrs):
+        super(_OverlayNodeMap, self).__setitem__(n, _unwrap(attrs))
+        self._owned.add(n)
+
+    def __delitem__(self, n):
+        super(_OverlayNodeMap, self).__delitem__(n)
+        self._owned.discard(n)
+
+
+class _OverlayAdjMap(_OverlayMixin, _AdjMap):
+    """The succ or pred map of an overlay, sharing the neighbors of its base
+    until they are first changed"""
+
+    def __init__(self, graph, base):
+        super(_OverlayAdjMap, self).__init__(graph)
+        dict.update(self, base)
+        self._owned = set()
+
+    def __getitem__(self, n):
+        nbrs = dict.__getitem__(self, n)
+        if n in self._owned:
+            return nbrs
+        return _SharedNeighbors(self, n)
+
+    def _own(self, n):
+        nbrs = dict.__getitem__(self, n)
+        if n not in self._owned:
+            nbrs = _OverlayNeighbors(nbrs)
+            nbrs._map, nbrs._node = self, n
+            dict.__setitem__(self, n, nbrs)
+            self._owned.add(n)
+        return nbrs
+
+    def __setitem__(self, n, nbrs):
+        super(_OverlayAdjMap, self).__setitem__(n, _unwrap(nbrs))
+        self._owned.add(n)
+
+    def __delitem__(self, n):
+        super(_OverlayAdjMap, self).__delitem__(n)
+        self._owned.discard(n)
+
+
+class _OverlayNeighbors(_OverlayMixin, _Neighbors):
+    """The neighbors of a node in an overlay, sharing the edge attributes
+    of its base until they are first changed"""
+
+    def __init__(self, *args, **kw):
+        super(_OverlayNeighbors, self).__init__(*args, **kw)
+        self._owned = set()
+
+    def __getitem__(self, v):
+        data = dict.__getitem__(self, v)
+        if v in self._owned:
+            return data
+        return _SharedView(self, v)
+
+    def _own(self, v):
+        data = dict.__getitem__(self, v)
+        if v not in self._owned:
+            # Edges are stored in both succ and pred, copy them at once
+            graph, u = self._map._graph, self._node
+            data = _Attrs(data)
+            if self._map is graph.succ:
+                twin = graph.pred._own(v)
+                data._watch(graph, (u, v), True)
+            else:
+                twin = graph.succ._own(v)
+                data._watch(graph, (v, u), True)
+            dict.__setitem__(self, v, data)
+            dict.__setitem__(twin, u, data)
+            self._owned.add(v)
+            if isinstance(twin, _OverlayNeighbors):
+                twin._owned.add(u)
+        return data
+
+    def __setitem__(self, v, data):
+        super(_OverlayNeighbors, self).__setitem__(v, data)
+        self._owned.add(v)
+
+    def __delitem__(self, v):
+        super(_OverlayNeighbors, self).__delitem__(v)
+        self._owned.discard(v)
+
+
+class _IndexView(collections.Set):
+    """A read-only view of a role index of an IGPGraph, which follows the
+    changes of the graph.
+    ! Copy it (e.g. with set()) to change the graph while iterating over it"""
+    __slots__ = ('_index',)
+
+    def __init__(self, index):
+        self._index = index
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return frozenset(it)
+
+    def __contains__(self, x):
+        return x in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self._index))
+
+
 class IGPGraph(nx.DiGraph):
-    """This class represents an IGP graph, and defines a few useful bindings"""
+    """This class represents an IGP graph, and defines a few useful bindings.
+    The nodes and edges are indexed by their role (router, prefix, fake
+    route, ...) as the graph changes, and the graph carries a version that
+    changes with its topology"""
+
+    adjlist_dict_factory = _Neighbors
+    edge_attr_dict_factory = _Attrs
+    # The node indexes, and the attribute defining them
+    _NODE_INDEXES = (('_routers', 'router'),
+                     ('_prefixes', 'prefix'),
+                     ('_controllers', 'controller'))
+    # The edge indexes, in the order in which _edge_changed evaluates them
+    _EDGE_INDEXES = ('_routes', '_real_routes', '_fake_routes',
+                     '_global_lies', '_local_lies', '_router_links')
+    _MAPS = ('node', 'adj', 'succ', 'pred', 'edge')
 
-    def __init__(self, *args, **kwargs):
-        super(IGPGraph, self).__init__(*args, **kwargs)
+    def __init__(self, data=None, **attr):
+        super(IGPGraph, self).__init__(**attr)
         self._export_keys = (METRIC, LOCAL, FAKE)
+        self.__init_indexes()
+        if data is not None:
+            nx.convert.to_networkx_graph(data, create_using=self)
+            self.graph.update(attr)
+            if not isinstance(self.node, _NodeMap):
+                # The conversion can overwrite the node attributes map
+                nodes, self.node = self.node, _NodeMap(self)
+                self.node.update(nodes)
+
+    def __init_indexes(self):
+        self.node = _NodeMap(self)
+        self.succ = self.adj = self.edge = _AdjMap(self)
+        self.pred = _AdjMap(self)
+        self._version = next(_versions)
+        for name in self.__indexes():
+            setattr(self, name, set())
+        self._edge_indexes = [getattr(self, name)
+                              for name in self._EDGE_INDEXES]
+
+    def __indexes(self):
+        return [name for name, _ in self._NODE_INDEXES] + list(
+            self._EDGE_INDEXES)
+
+    def _node_changed(self, n):
+        """Update the indexes after the addition/removal of n, or a change
+        in its attributes"""
+        self._version = next(_versions)
+        attrs = self.node.get(n, {})
+        for name, key in self._NODE_INDEXES:
+            index = getattr(self, name)
+            if attrs.get(key) == True:
+                index.add(n)
+            else:
+                index.discard(n)
+        # The role of the edges depend on the one of their endpoints
+        for v in self.succ.get(n, ()):
+            self._edge_changed(n, v)
+        for u in self.pred.get(n, ()):
+            self._edge_changed(u, n)
+
+    def _edge_changed(self, u, v):
+        """Update the indexes after the addition/removal of u->v, or a change
+        in its attributes"""
+        self._version = next(_versions)
+        # Inlined version of the is_xxx predicates, reading the roles of the
+        # endpoints from the node indexes
+        try:
+            data = self.succ[u][v]
+        except KeyError:
+            roles = (False,) * 6
+        else:
+            link = u in self._routers and v in self._routers
+            if v in self._prefixes:
+                fake = data.get(FAKE, False) == True
+                local = data.get(LOCAL, False)
+                roles = (True, not fake, fake, fake and not local == True,
+                         fake and bool(local), link)
+            else:
+                roles = (False, False, False, False, False, link)
+        e = (u, v)
+        for index, role in zip(self._edge_indexes, roles):
+            if role:
+                index.add(e)
+            else:
+                index.discard(e)
+
+    def __reindex(self):
+        for name in self.__indexes():
+            getattr(self, name).clear()
+        for n in self.node.keys():
+            self.node[n] = self.node[n]
+        for adj in (self.succ, self.pred):
+            for n in adj.keys():
+                nbrs = dict.pop(adj, n)
+                nbrs._map = None
+                adj[n] = nbrs
+
+    def clear(self):
+        super(IGPGraph, self).clear()
+        self._version = next(_versions)
+        for name in self.__indexes():
+            getattr(self, name).clear()
+
+    @property
+    def version(self):
+        """A number identifying the topology of this graph: it changes
+        whenever a node, an edge, a role or a metric changes, and is kept
+        by the copies of the graph until they diverge"""
+        return self._version
+
+    def reverse(self, copy=True):
+        if not copy and isinstance(self.succ, _OverlayAdjMap):
+            raise nx.NetworkXError('Cannot reverse an overlay in place')
+        if copy:
+            H = self.__class__(name='Reverse of (%s)' % self.name)
+            H.graph = deepcopy(self.graph)
+            H.add_nodes_from(deepcopy(self.nodes(data=True)))
+            H.add_edges_from((v, u, deepcopy(d))
+                             for u, v, d in self.edges_iter(data=True))
+            return H
+        self.pred, self.succ = self.succ, self.pred
+        self.adj = self.edge = self.succ
+        self.__reindex()
+        return self
+
+    def overlay(self):
+        """Return a copy-on-write view of this graph, which can be modified
+        without altering it. The neighbors and attributes of this graph are
+        read through the view, and only copied once changed through it,
+        which makes creating, reading and discarding it cheap.
+        ! This graph should not be modified while the view is in use !"""
+        g = self.__class__.__new__(self.__class__)
+        g.__dict__.update((k, v) for k, v in self.__dict__.iteritems()
+                          if k not in self._MAPS)
+        g.graph = dict(self.graph)
+        g.node = _OverlayNodeMap(g, self.node)
+        g.succ = g.adj = g.edge = _OverlayAdjMap(g, self.succ)
+        g.pred = _OverlayAdjMap(g, self.pred)
+        for name in self.__indexes():
+            setattr(g, name, set(getattr(self, name)))
+        g._edge_indexes = [getattr(g, name) for name in self._EDGE_INDEXES]
+        return g
+
+    def __getstate__(self):
+        # The indexes are kept, to restore the roles without recomputing them
+        state = {k: v for k, v in self.__dict__.iteritems()
+                 if k not in self._MAPS}
+        del state['_edge_indexes']
+        state['nodes'] = [(n, dict(d)) for n, d in dict.iteritems(self.node)]
+        state['edges'] = [(u, v, dict(d))
+                          for u, nbrs in dict.iteritems(self.succ)
+                          for v, d in dict.iteritems(nbrs)]
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        nodes, edges = state.pop('nodes'), state.pop('edges')
+        self.__dict__.update(state)
+        self.__fill(nodes, edges)
+
+    def __deepcopy__(self, memo):
+        g = self.__class__.__new__(self.__class__)
+        memo[id(self)] = g
+        skip = set(self._MAPS).union(self.__indexes(), ('_edge_indexes',))
+        g.__dict__.update(deepcopy({k: v for k, v in self.__dict__.iteritems()
+                                    if k not in skip}, memo))
+        for name in self.__indexes():
+            setattr(g, name, set(getattr(self, name)))
+        g.__fill(((n, _copy_attrs(d, memo))
+                  for n, d in dict.iteritems(self.node)),
+                 ((u, v, _copy_attrs(d, memo))
+                  for u, nbrs in dict.iteritems(self.succ)
+                  for v, d in dict.iteritems(nbrs)))
+        return g
+
+    def __fill(self, nodes, edges):
+        """Build the maps of this graph from its (node, attributes) and
+        (u, v, attributes) lists, without going through add_node/add_edge
+        as its indexes already hold their roles"""
+        self.node = node = _NodeMap(self)
+        self.succ = self.adj = self.edge = succ = _AdjMap(self)
+        self.pred = pred = _AdjMap(self)
+        self._edge_indexes = [getattr(self, name)
+                              for name in self._EDGE_INDEXES]
+        ref = weakref.ref(self)
+        for n, attrs in nodes:
+            attrs = _Attrs(attrs) if type(attrs) is not _Attrs else attrs
+            attrs._watchers.append((ref, n, False))
+            dict.__setitem__(node, n, attrs)
+            for adj in (succ, pred):
+                nbrs = _Neighbors()
+                nbrs._map, nbrs._node = adj, n
+                dict.__setitem__(adj, n, nbrs)
+        for u, v, data in edges:
+            data = _Attrs(data) if type(data) is not _Attrs else data
+            data._watchers.append((ref, (u, v), True))
+            dict.__setitem__(dict.__getitem__(succ, u), v, data)
+            dict.__setitem__(dict.__getitem__(pred, v), u, data)
 
     def draw(self, dest):
         """Draw this graph to dest"""
@@ -149,66 +768,59 @@ class IGPGraph(nx.DiGraph):
         except KeyError:
             raise ValueError('%s is not a local lie!' % n)
 
-    def _get_all(self, predicate):
-        for n in self.nodes_iter():
-            if predicate(n):
-                yield n
-
-    def _get_all_edges(self, predicate):
-        for u, v in self.edges_iter():
-            if predicate(u, v):
-                yield u, v
-
     @property
     def routers(self):
-        """Returns a generator over all routers in the graph
+        """Returns a read-only view of the set of all routers in the graph
         Example: all_routers = list(graph.routers)
         """
-        return self._get_all(self.is_router)
+        return _IndexView(self._routers)
 
     @property
     def controllers(self):
-        """Returns a generator over all controllers in the graph
+        """Returns a read-only view of the set of all controllers in the graph
         Example: all_controllers = list(graph.controllers)
         """
-        return self._get_all(self.is_controller)
+        return _IndexView(self._controllers)
 
     @property
     def prefixes(self):
-        """Returns a generator over all prefixes in the graph"""
-        return self._get_all(self.is_prefix)
+        """Returns a read-only view of the set of all prefixes in the graph"""
+        return _IndexView(self._prefixes)
 
     @property
     def all_routes(self):
-        """Returns a generator over all routes in the graph"""
-        return self._get_all_edges(self.is_route)
+        """Returns a read-only view of the set of all routes in the graph"""
+        return _IndexView(self._routes)
 
     @property
     def real_routes(self):
-        """Returns a generator over all real routes in the graph"""
-        return self._get_all_edges(self.is_real_route)
+        """Returns a read-only view of the set of all real routes in the
+        graph"""
+        return _IndexView(self._real_routes)
 
     @property
     def fake_routes(self):
-        """Returns a generator over all fake routes in the graph"""
-        return self._get_all_edges(self.is_fake_route)
+        """Returns a read-only view of the set of all fake routes in the
+        graph"""
+        return _IndexView(self._fake_routes)
 
     @property
     def local_lies(self, target=False):
         """Returns a generator over all local lies in the graph, possibly
         return the target neighbours of it."""
-        for n in self._get_all_edges(self.is_local_lie):
+        for n in frozenset(self._local_lies):
             yield n if not target else (n, self.local_lie_target(n))
 
     @property
     def global_lies(self):
-        """Returns a generator over all global lies in the graph"""
-        return self._get_all_edges(self.is_global_lie)
+        """Returns a read-only view of the set of all global lies in the
+        graph"""
+        return _IndexView(self._global_lies)
 
     @property
     def router_links(self):
-        """Return a generator over all intra-router links"""
-        return self._get_all_edges(self.is_router_link)
+        """Return a read-only view of the set of all intra-router links"""
+        return _IndexView(self._router_links)
 
     def metric(self, u, v, m=None):
         """Return the link metric for link u->v, or set it if m is not None"""
@@ -254,103 +866,1342 @@ class IGPGraph(nx.DiGraph):
         return self[u][v].get(MULTIPLICITY_KEY, 1)
 
 
-class ShortestPath(object):
-    """A class storing shortest-path trees"""
-    def __init__(self, graph):
-        self._default_paths = {}
-        self._default_dist = {}
-        # Calculate non-fibbed Dijkstra
-        for n in graph.nodes_iter():
-            (self._default_paths[n],
-             self._default_dist[n]) = self.__default_spt_for_src(graph, n)
-        # We do not Fib all destinations, re-use pre-computed ones
-        fibbed_dst = set(v for _, v in graph.fake_routes)
-        pure_dst = set(n for n in graph.nodes_iter()
-                       if n not in fibbed_dst)
-        self._paths = {n: [p[:] for p in self._default_paths[n]]
-                       for n in pure_dst}
-        self._dist = {n: self._default_dist[n]
-                      for n in pure_dst}
-        # Compute the Fibbed paths
-        for n in fibbed_dst:
-            (self._paths[n],
-             self._dist[n]) = self.__fibbed_spt_for_src(graph, n)
+class CompactIGPGraph(object):
+    """A frozen, array-backed snapshot of an IGPGraph.
+    Node names are interned to integer ids, and the adjacency is stored in
+    compressed sparse rows: the out-edges of node i are the indices
+    offsets[i] .. offsets[i+1] of the targets/metrics/flags arrays.
+    The shortest paths are computed on the reduction of the graph (see
+    TopologyReduction), then expanded back to all its nodes.
+    ! The snapshot does not follow the subsequent changes of the graph"""
 
-    @staticmethod
-    def __default_spt_for_src(g, source):
+    # Node flags
+    ROUTER = 1
+    PREFIX = 2
+    CONTROLLER = 4
+    # Edge flags
+    FAKE = 1  # The edge is a fake route
+    LOCAL = 2  # The edge is a local lie
+
+    def __init__(self, graph, reduce=True):
+        """:param reduce: Whether to compute the shortest paths on the
+                          reduction of the graph, if it has one"""
+        self.names = names = graph.nodes()
+        self.ids = ids = {n: i for i, n in enumerate(names)}
+        self.node_flags = array('B', (
+            (self.ROUTER if graph.is_router(n) else 0) |
+            (self.PREFIX if graph.is_prefix(n) else 0) |
+            (self.CONTROLLER if graph.is_controller(n) else 0)
+            for n in names))
+        self.offsets = offsets = array('l', [0])
+        self.sources = sources = array('l')
+        self.targets = targets = array('l')
+        self.metrics = metrics = array('l')
+        self.edge_flags = edge_flags = array('B')
+        self.multiplicity = multiplicity = array('l')
+        # Local lies are rare, keep their targets aside: edge idx -> targets
+        self.lie_targets = {}
+        for u in names:
+            for v, data in graph[u].iteritems():
+                flags = 0
+                if graph.is_fake_route(u, v):
+                    flags |= self.FAKE
+                    if data.get(LOCAL):
+                        flags |= self.LOCAL
+                        self.lie_targets[len(targets)] = data[LOCAL]
+                sources.append(ids[u])
+                targets.append(ids[v])
+                metrics.append(data.get(METRIC, 1))
+                edge_flags.append(flags)
+                multiplicity.append(data.get(MULTIPLICITY_KEY, 1))
+            offsets.append(len(targets))
+        # Reverse adjacency: the in-edges of node i are the edge indices
+        # in_edges[in_offsets[i] .. in_offsets[i+1]]
+        self.in_offsets = in_offsets = array('l', [0] * (len(names) + 1))
+        for v in targets:
+            in_offsets[v + 1] += 1
+        for i in xrange(len(names)):
+            in_offsets[i + 1] += in_offsets[i]
+        self.in_edges = in_edges = array('l', [0] * len(targets))
+        fill = array('l', in_offsets[:-1])
+        for e, v in enumerate(targets):
+            in_edges[fill[v]] = e
+            fill[v] += 1
+        # The TopologyReduction, built on the first shortest path query
+        self._reduction = None if reduce else False
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, n):
+        return n in self.ids
+
+    def _edge(self, u, v):
+        """Return the index of the edge u->v in the edge arrays"""
+        i, j = self.ids[u], self.ids[v]
+        for e in xrange(self.offsets[i], self.offsets[i + 1]):
+            if self.targets[e] == j:
+                return e
+        raise KeyError((u, v))
+
+    def has_edge(self, u, v):
+        try:
+            self._edge(u, v)
+            return True
+        except KeyError:
+            return False
+
+    def is_router(self, n):
+        """Return whether n is a router or not"""
+        return n in self.ids and bool(self.node_flags[self.ids[n]] &
+                                      self.ROUTER)
+
+    def is_prefix(self, n):
+        """Return whether n is a prefix or not"""
+        return n in self.ids and bool(self.node_flags[self.ids[n]] &
+                                      self.PREFIX)
+
+    @property
+    def routers(self):
+        """Returns a generator over all routers in the graph"""
+        flags, router = self.node_flags, self.ROUTER
+        return (n for i, n in enumerate(self.names) if flags[i] & router)
+
+    def successors_iter(self, n):
+        i = self.ids[n]
+        names, targets = self.names, self.targets
+        return (names[targets[e]]
+                for e in xrange(self.offsets[i], self.offsets[i + 1]))
+
+    def successors(self, n):
+        return list(self.successors_iter(n))
+
+    def predecessors_iter(self, n):
+        i = self.ids[n]
+        names, sources, in_edges = self.names, self.sources, self.in_edges
+        return (names[sources[in_edges[x]]]
+                for x in xrange(self.in_offsets[i], self.in_offsets[i + 1]))
+
+    def real_neighbors(self, n):
+        """List the real (non dest) nodes in this graph"""
+        i = self.ids[n]
+        names, targets, flags = self.names, self.targets, self.node_flags
+        router = self.ROUTER
+        return [names[targets[e]]
+                for e in xrange(self.offsets[i], self.offsets[i + 1])
+                if flags[targets[e]] & router]
+
+    def metric(self, u, v):
+        """Return the link metric for link u->v"""
+        return self.metrics[self._edge(u, v)]
+
+    def is_fake_route(self, u, v):
+        """Return whether edge u,v is a route from a fake LSA"""
+        return bool(self.edge_flags[self._edge(u, v)] & self.FAKE)
+
+    def is_local_lie(self, u, v, target=None):
+        """Return wether u,v is a local lie, optionally check if it applies to
+        the given target(s)"""
+        e = self._edge(u, v)
+        return (bool(self.edge_flags[e] & self.LOCAL) and
+                (not target or target in self.lie_targets[e]))
+
+    def get_edge_multiplicity(self, u, v):
+        """Return the multiplicity of the edge u, v"""
+        return self.multiplicity[self._edge(u, v)]
+
+    def spt(self, source):
+        """Compute the non-fibbed shortest paths from source, ignoring the
+        fake routes.
+
+        :return: dist, preds: the distance and the set of shortest-path
+                 predecessors of each reachable node, keyed by node name"""
+        reduction = self.reduction()
+        if reduction:
+            return self.__named(*reduction.spt({self.ids[source]: 0}))
         # Adapted from single_source_dijkstra in networkx
+        offsets, targets = self.offsets, self.targets
+        metrics, edge_flags, fake = self.metrics, self.edge_flags, self.FAKE
+        src = self.ids[source]
         dist = {}  # dictionary of final distances
-        paths = {source: [[source]]}  # dictionary of list of paths
-        seen = {source: 0}
-        fringe = []
-        c = count()  # We want to skip comparing node labels
-        heapq.heappush(fringe, (0, next(c), source))
+        preds = {src: []}  # dictionary of shortest-path predecessors
+        seen = {src: 0}
+        fringe = [(0, src)]
         while fringe:
-            (d, _, v) = heapq.heappop(fringe)
+            (d, v) = heapq.heappop(fringe)
             if v in dist:
                 continue  # already searched this node.
             dist[v] = d
-            for w, edgedata in g[v].iteritems():
-                if g.is_fake_route(v, w):
+            for e in xrange(offsets[v], offsets[v + 1]):
+                if edge_flags[e] & fake:
                     # Deal with fake edges at a later stage
                     continue
-                vw_dist = d + edgedata.get(METRIC, 1)
+                w = targets[e]
+                vw_dist = d + metrics[e]
                 seen_w = seen.get(w, sys.maxint)
                 if vw_dist < dist.get(w, 0):
                     raise ValueError('Contradictory paths found: '
                                      'negative metric?')
                 elif vw_dist < seen_w:  # vw is better than the old path
                     seen[w] = vw_dist
-                    heapq.heappush(fringe, (vw_dist, next(c), w))
-                    paths[w] = list(extend_paths_list(paths[v], w))
+                    heapq.heappush(fringe, (vw_dist, w))
+                    preds[w] = [v]
                 elif vw_dist == seen_w:  # vw is ECMP
-                    paths[w].extend(extend_paths_list(paths[v], w))
+                    preds[w].append(v)
                 # else w is already pushed in the fringe and will pop later
-        return paths, dist
+        return self.__named(dist, preds)
+
+    def reverse_spt(self, seeds):
+        """Compute the non-fibbed distance of every node towards the closest
+        of the seeds, ignoring the fake routes.
+
+        :param seeds: {node: initial distance}
+        :return: dist, nhs: the distance of each node that can reach a seed,
+                 and the set of its neighbors on the shortest paths
+                 towards them, keyed by node name"""
+        reduction = self.reduction()
+        if reduction:
+            ids = self.ids
+            return self.__named(*reduction.spt(
+                {ids[n]: d for n, d in seeds.iteritems()}, forward=False))
+        in_offsets, in_edges = self.in_offsets, self.in_edges
+        sources, metrics = self.sources, self.metrics
+        edge_flags, fake = self.edge_flags, self.FAKE
+        ids = self.ids
+        dist = {}
+        nhs = {}
+        seen = {}
+        fringe = []
+        for n, d in seeds.iteritems():
+            i = ids[n]
+            seen[i] = d
+            nhs[i] = []
+            fringe.append((d, i))
+        heapq.heapify(fringe)
+        while fringe:
+            (d, v) = heapq.heappop(fringe)
+            if v in dist:
+                continue
+            dist[v] = d
+            for e in (in_edges[x]
+                      for x in xrange(in_offsets[v], in_offsets[v + 1])):
+                if edge_flags[e] & fake:
+                    continue
+                w = sources[e]
+                wv_dist = d + metrics[e]
+                seen_w = seen.get(w, sys.maxint)
+                if wv_dist < dist.get(w, 0):
+                    raise ValueError('Contradictory paths found: '
+                                     'negative metric?')
+                elif wv_dist < seen_w:
+                    seen[w] = wv_dist
+                    heapq.heappush(fringe, (wv_dist, w))
+                    nhs[w] = [v]
+                elif wv_dist == seen_w:
+                    nhs[w].append(v)
+        return self.__named(dist, nhs)
+
+    def __named(self, dist, links):
+        """Key dist and links by node name, turning the latter into sets"""
+        names = self.names
+        return ({names[v]: d for v, d in dist.iteritems()},
+                {names[v]: {names[x] for x in xs}
+                 for v, xs in links.iteritems()})
+
+    def reduction(self):
+        """Return the TopologyReduction of this graph, None if it has none or
+        if it was built with reduce=False"""
+        if self._reduction is None:
+            self._reduction = TopologyReduction.build(self) or False
+        return self._reduction or None
+
+
+class TopologyReduction(object):
+    """The non-fake edges of a CompactIGPGraph, once the trees hanging off
+    the rest of the graph (stubs) are pruned, and the paths whose inner
+    nodes have two neighbors (chains) are contracted into super-edges between
+    their end points. The remaining nodes form the core.
+    The shortest paths are computed on the core, then expanded back to the
+    chains and stubs, which is exact as every metric is positive.
+    The eliminated nodes are grouped in pieces: the nodes of a chain and the
+    stubs hanging off them, or the stubs hanging off a core node. A piece is
+    attached to the core through at most two nodes."""
+
+    def __init__(self, n, core, adj, weight, parent, order, chains):
+        """Use TopologyReduction.build instead"""
+        # eliminated id -> [(neighbor id, metric of id->nbr, of nbr->id)]
+        self.adj = {x: [(y, weight.get((x, y)), weight.get((y, x)))
+                        for y in adj[x]]
+                    for x in xrange(n) if x not in core}
+        # The core adjacency, including the super-edges, as
+        # id -> [(successor, metric, predecessor of the successor)] and
+        # id -> [(predecessor, metric, successor of the predecessor)]
+        self.succ = succ = [[] for _ in xrange(n)]
+        self.pred = pred = [[] for _ in xrange(n)]
+        for (u, v), m in weight.iteritems():
+            if u in core and v in core:
+                succ[u].append((v, m, u))
+                pred[v].append((u, m, v))
+        # [(path, forward metrics, backward metrics)] where path is
+        # [a, chain nodes.., b], and the metrics those of path[i]->path[i+1]
+        # and of path[i+1]->path[i], None if the edge is missing
+        self.chains = []
+        # eliminated id -> its piece, piece -> its attachments
+        self.piece = {}
+        self.attachments = {}
+        for c, path in enumerate(chains):
+            fw = [weight.get(e) for e in zip(path, path[1:])]
+            bw = [weight.get(e) for e in zip(path[1:], path)]
+            self.chains.append((path, fw, bw))
+            a, b = path[0], path[-1]
+            for x in path[1:-1]:
+                self.piece[x] = c
+            self.attachments[c] = (a, b)
+            if a == b:
+                continue
+            if None not in fw:
+                succ[a].append((b, sum(fw), path[-2]))
+                pred[b].append((a, sum(fw), path[1]))
+            if None not in bw:
+                succ[b].append((a, sum(bw), path[1]))
+                pred[a].append((b, sum(bw), path[-2]))
+        # [(stub id, parent id, metric of parent->stub, of stub->parent,
+        #   piece)], parents first
+        self.stubs = []
+        for x in reversed(order):
+            p = parent[x]
+            if p is None:
+                self.piece[x] = ('tree', x)
+                self.attachments[('tree', x)] = ()
+                continue
+            if p in core:
+                self.piece[x] = ('stub', p)
+                self.attachments[('stub', p)] = (p,)
+            else:
+                self.piece[x] = self.piece[p]
+            self.stubs.append((x, p, weight.get((p, x)), weight.get((x, p)),
+                               self.piece[x]))
+        # piece -> its eliminated nodes
+        self.members = collections.defaultdict(list)
+        for x, piece in self.piece.iteritems():
+            self.members[piece].append(x)
+
+    @classmethod
+    def build(cls, graph):
+        """Reduce a CompactIGPGraph
+
+        :return: The TopologyReduction, None if it would leave the graph
+                 unchanged or if some non-fake edge has a non-positive
+                 metric"""
+        n = len(graph.names)
+        sources, targets = graph.sources, graph.targets
+        metrics, edge_flags, fake = (graph.metrics, graph.edge_flags,
+                                     graph.FAKE)
+        weight = {}
+        adj = [set() for _ in xrange(n)]
+        for e in xrange(len(targets)):
+            if edge_flags[e] & fake:
+                continue
+            if metrics[e] <= 0:
+                return None
+            u, v = sources[e], targets[e]
+            if u != v:
+                weight[u, v] = metrics[e]
+                adj[u].add(v)
+                adj[v].add(u)
+        # Prune the stubs, leaves first
+        degree = map(len, adj)
+        parent = [None] * n
+        order = []
+        removed = set()
+        todo = [x for x in xrange(n) if degree[x] < 2]
+        while todo:
+            x = todo.pop()
+            if x in removed:
+                continue
+            removed.add(x)
+            order.append(x)
+            for y in adj[x]:
+                if y not in removed:
+                    parent[x] = y
+                    degree[y] -= 1
+                    if degree[y] == 1:
+                        todo.append(y)
+        core = set(x for x in xrange(n)
+                   if x not in removed and degree[x] > 2)
+        # Walk the chains from their end points
+        chains = []
+        in_chain = set()
+        for a in core:
+            for c in adj[a]:
+                if c in removed or c in core or c in in_chain:
+                    continue
+                path = [a]
+                prev = a
+                while c not in core:
+                    path.append(c)
+                    in_chain.add(c)
+                    prev, c = c, next(y for y in adj[c]
+                                      if y != prev and y not in removed)
+                path.append(c)
+                chains.append(path)
+        # The cycles without any core node are kept as they are
+        core.update(x for x in xrange(n)
+                    if x not in removed and x not in in_chain)
+        if len(core) == n:
+            return None
+        return cls(n, core, adj, weight, parent, order, chains)
+
+    def spt(self, seeds, forward=True):
+        """Compute the shortest paths from the closest seed to every node that
+        it can reach, or towards the closest seed if not forward.
+
+        :param seeds: {node id: initial distance}
+        :return: dist, links: the distance of each node, and its neighbors on
+                 its shortest paths, i.e. its predecessors if forward, its
+                 next hops otherwise, keyed by node id"""
+        # Explore the pieces containing seeds first, to seed their
+        # attachments in the core
+        core_seeds = {}
+        links = {}
+        by_piece = collections.defaultdict(dict)
+        for x, d in seeds.iteritems():
+            if x in self.piece:
+                by_piece[self.piece[x]][x] = d
+            else:
+                self.__seed(core_seeds, links, x, d, [])
+        local = {}
+        for p, p_seeds in by_piece.iteritems():
+            attachments = self.attachments[p]
+            p_dist, p_links = self.__explore(p_seeds, forward)
+            for x, d in p_dist.iteritems():
+                if x in attachments:
+                    self.__seed(core_seeds, links, x, d, p_links[x])
+                else:
+                    local[x] = d
+        dist = self.__dijkstra(core_seeds, links,
+                               self.succ if forward else self.pred)
+        # Then expand the chains from both ends
+        for c, (path, fw, bw) in enumerate(self.chains):
+            from_a, from_b = (fw, bw) if forward else (bw, fw)
+            if c in by_piece:
+                self.__expand_chain(path, from_a, from_b, dist, local)
+                continue
+            last = len(path) - 1
+            d = dist.get(path[0])
+            a_side = [d]
+            for i in xrange(1, last):
+                m = from_a[i - 1]
+                d = None if d is None or m is None else d + m
+                a_side.append(d)
+            d = dist.get(path[last])
+            for i in xrange(last - 1, 0, -1):
+                m = from_b[i]
+                d = None if d is None or m is None else d + m
+                d_a = a_side[i]
+                if d_a is not None and (d is None or d_a <= d):
+                    dist[path[i]] = d_a
+                    links[path[i]] = ([path[i - 1], path[i + 1]]
+                                      if d_a == d else [path[i - 1]])
+                elif d is not None:
+                    dist[path[i]] = d
+                    links[path[i]] = [path[i + 1]]
+        # And the stubs, from their root
+        for x, p, down, up, piece in self.stubs:
+            m = down if forward else up
+            d = dist.get(p)
+            if piece in by_piece:
+                d = self.__shortest(d, m, local.get(x))
+            elif d is not None and m is not None:
+                d += m
+                links[x] = [p]
+            else:
+                continue
+            if d is not None:
+                dist[x] = d
+        # The trees that are disconnected from the core
+        for x, d in local.iteritems():
+            dist.setdefault(x, d)
+        # The links within the pieces containing seeds can go both ways,
+        # check which neighbors are tight
+        for p in by_piece:
+            for x in self.members[p]:
+                d = dist.get(x)
+                if d is None:
+                    continue
+                links[x] = x_links = []
+                for y, out, in_ in self.adj[x]:
+                    m = in_ if forward else out
+                    if m is not None and dist.get(y, d) + m == d:
+                        x_links.append(y)
+        return dist, links
+
+    def __expand_chain(self, path, from_a, from_b, dist, local):
+        """Expand the chain path, some of whose nodes are at distance local
+        from the seeds"""
+        last = len(path) - 1
+        best = [local.get(x) for x in path]
+        d = dist.get(path[0])
+        for i in xrange(1, last):
+            d = best[i] = self.__shortest(d, from_a[i - 1], best[i])
+        d = dist.get(path[last])
+        for i in xrange(last - 1, 0, -1):
+            d = self.__shortest(d, from_b[i], best[i])
+            if d is not None:
+                dist[path[i]] = d
 
     @staticmethod
-    def __fibbed_spt_for_src(g, source):
-        """Compute the actual used paths due to Fibbing.
-        ! the router to which a fake edge is attached does not use it"""
+    def __seed(seeds, links, x, d, x_links):
+        """Seed x at distance d, reached through x_links"""
+        old = seeds.get(x)
+        if old is None or d < old:
+            seeds[x] = d
+            links[x] = list(x_links)
+        elif d == old:
+            links[x].extend(x_links)
 
-        return None, None
+    @staticmethod
+    def __shortest(d, metric, other):
+        """Return the shortest of d + metric and other, where None stands
+        for an infinite distance"""
+        if d is None or metric is None:
+            return other
+        d += metric
+        return d if other is None or d < other else other
 
     @staticmethod
-    def _get(d, u, v=None):
-        return d[u][v] if v else d[u]
+    def __dijkstra(seeds, links, adj):
+        """Dijkstra over the core from seeds {id: distance}, whose links are
+        already in links"""
+        dist = {}
+        seen = dict(seeds)
+        fringe = [(d, x) for x, d in seeds.iteritems()]
+        heapq.heapify(fringe)
+        while fringe:
+            d, v = heapq.heappop(fringe)
+            if v in dist:
+                continue
+            dist[v] = d
+            for w, m, via in adj[v]:
+                vw_dist = d + m
+                seen_w = seen.get(w, sys.maxint)
+                if vw_dist < seen_w:
+                    seen[w] = vw_dist
+                    heapq.heappush(fringe, (vw_dist, w))
+                    links[w] = [via]
+                elif vw_dist == seen_w:
+                    links[w].append(via)
+        return dist
+
+    def __explore(self, seeds, forward):
+        """Dijkstra within the piece of the seeds, stopping at its
+        attachments"""
+        adj = self.adj
+        dist = {}
+        links = {x: [] for x in seeds}
+        seen = dict(seeds)
+        fringe = [(d, x) for x, d in seeds.iteritems()]
+        heapq.heapify(fringe)
+        while fringe:
+            d, v = heapq.heappop(fringe)
+            if v in dist:
+                continue
+            dist[v] = d
+            if v not in adj:
+                continue  # An attachment
+            for w, out, in_ in adj[v]:
+                m = out if forward else in_
+                if m is None:
+                    continue
+                vw_dist = d + m
+                seen_w = seen.get(w, sys.maxint)
+                if vw_dist < seen_w:
+                    seen[w] = vw_dist
+                    heapq.heappush(fringe, (vw_dist, w))
+                    links[w] = [v]
+                elif vw_dist == seen_w:
+                    links[w].append(v)
+        return dist, links
+
+
+# The snapshot given to the worker processes of parallel_spt
+_worker_graph = None
+
+
+def _init_spt_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _spt_worker(sources):
+    return [(s,) + _worker_graph.spt(s) for s in sources]
+
+
+def parallel_spt(graph, sources, processes=None):
+    """Compute the shortest-path trees of many sources on a process pool.
+    The graph is sent once to every worker, which then get the sources in
+    chunks.
+
+    :param graph: A CompactIGPGraph
+    :param sources: The nodes whose tree should be computed
+    :param processes: The number of workers, None to use all CPUs
+    :return: A generator over (source, dist, preds)"""
+    sources = list(sources)
+    processes = processes or multiprocessing.cpu_count()
+    # A few chunks per worker, to balance their load
+    chunk_size = max(1, len(sources) // (processes * 4))
+    chunks = [sources[i:i + chunk_size]
+              for i in xrange(0, len(sources), chunk_size)]
+    pool = multiprocessing.Pool(processes, initializer=_init_spt_worker,
+                                initargs=(graph,))
+    try:
+        for result in pool.imap_unordered(_spt_worker, chunks):
+            for tree in result:
+                yield tree
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# A shortest-path tree, stored as the DAG of the shortest-path predecessors of
+# each node, along with a memo of the first hops used to reach them.
+_Tree = collections.namedtuple('_Tree', 'dist preds nhs')
+# The forwarding towards a fibbed destination: the cost each router computes
+# to reach it, and the next hops it uses for it
+_FibbedTree = collections.namedtuple('_FibbedTree', 'cost nhs')
+# A shortest-path in-tree rooted at a destination: the distance of each node
+# towards it, and the set of ECMP successors each node uses to reach it
+_InTree = collections.namedtuple('_InTree', 'dist nhs')
+
+
+def _copy_tree(tree):
+    """Return a copy of tree, whose predecessor sets can be changed in place
+    by the repairs without altering those of tree"""
+    return _Tree(tree.dist.copy(),
+                 {x: set(p) for x, p in tree.preds.iteritems()},
+                 tree.nhs.copy())
+
+
+class ShortestPath(object):
+    """A class storing shortest-path trees"""
+    def __init__(self, graph, lazy=False, cache_size=None, compact=None,
+                 processes=1):
+        """:param lazy: Only compute the tree of a source when it is first
+                        queried, instead of computing all of them upfront
+        :param cache_size: In lazy mode, the maximal number of trees to keep
+                           at once, or None to keep all of them
+        :param compact: A CompactIGPGraph snapshot of graph, if already
+                        built
+        :param processes: The number of processes computing the trees
+                          upfront, None to use all CPUs"""
+        self._graph = graph
+        self._compact = compact
+        self._lazy = lazy
+        self._trees = LRUCache(cache_size if lazy else None)
+        # dest -> {attachment: metric} for the destinations added to the SPT
+        self._destinations = {}
+        # dest -> _InTree, computed when first queried
+        self._in_trees = {}
+        # The ShortestPath this one is a copy of, computing and holding the
+        # trees and in-trees that this one did not change, and the live
+        # copies of this one, relying on its trees
+        self._parent = None
+        self._copies = weakref.WeakSet()
+        # Calculate non-fibbed Dijkstra
+        if not lazy:
+            if processes == 1 or len(graph) < 2:
+                for n in graph.nodes_iter():
+                    self.__add_source(graph, n)
+            else:
+                for n, dist, preds in parallel_spt(
+                        self._snapshot(graph, None), graph, processes):
+                    self.__add_tree(graph, n, _Tree(dist, preds, {}))
+        # We do not Fib all destinations, the others use the default paths
+        self._fibbed_dst = set(v for _, v in graph.fake_routes)
+        # fibbed dest -> _FibbedTree, computed when first queried
+        self._fibbed = {}
+
+    def _tree(self, source):
+        """Return the shortest-path tree of source, computing it if needed"""
+        try:
+            return self._trees[source]
+        except KeyError:
+            if self._parent is not None and source not in self._destinations:
+                return self._parent._tree(source)
+            if not self._lazy or source not in self._graph:
+                raise
+            log.debug('Computing the SPT of %s', source)
+            return self.__add_source(self._graph, source)
+
+    def _snapshot(self, g, source):
+        """Return a CompactIGPGraph of g, containing source if not None"""
+        if self._compact is None or (source is not None and
+                                     source not in self._compact):
+            self._compact = CompactIGPGraph(g)
+        return self._compact
+
+    def __add_source(self, g, source):
+        return self.__add_tree(
+            g, source, _Tree(*self._snapshot(g, source).spt(source), nhs={}))
+
+    def __add_tree(self, g, source, tree):
+        self._trees[source] = tree
+        return tree
+
+    def cache_info(self):
+        """Return the hit/miss/eviction statistics of the trees cache"""
+        return self._trees.cache_info()
+
+    def add_destination(self, graph, dest, attachments):
+        """Add a new destination to the SPT, reachable from the attachment
+        nodes using the metric of their edge towards it in graph.
+        The paths towards it are only computed when first queried.
+        ! The destination should not be in the already existing SPT!"""
+        self.__detach_copies()
+        attachments = {s: graph.metric(s, dest) for s in attachments}
+        self._destinations[dest] = attachments
+        self._trees[dest] = _Tree({dest: 0}, {dest: set()}, {})
+        self._in_trees.pop(dest, None)
+
+    def towards(self, dest):
+        """Return the shortest-path in-tree rooted at dest"""
+        try:
+            return self._in_trees[dest]
+        except KeyError:
+            pass
+        if self._parent is not None and dest not in self._destinations:
+            return self._parent.towards(dest)
+        g = self._graph
+        attachments = self._destinations.get(dest)
+        if attachments is not None:
+            seeds, root = attachments, None
+        else:
+            seeds, root = ({dest: 0} if dest in g else {}), dest
+        if seeds:
+            log.debug('Computing the SPT towards %s', dest)
+            dist, nhs = self._snapshot(g, root).reverse_spt(seeds)
+        else:
+            dist, nhs = {}, {}
+        if attachments is not None:
+            for s, metric in attachments.iteritems():
+                if dist.get(s) == metric:
+                    nhs[s].add(dest)
+            dist[dest], nhs[dest] = 0, set()
+        tree = self._in_trees[dest] = _InTree(dist, nhs)
+        return tree
+
+    def cost_to(self, u, dest):
+        """Return the cost of the pure IGP shortest paths from u to dest"""
+        return self.towards(dest).dist.get(u, sys.maxint)
+
+    def successors_to(self, u, dest):
+        """Return the set of next hops used by u to reach dest along its pure
+        IGP shortest paths"""
+        return self.towards(dest).nhs.get(u, set())
+
+    def dag_to(self, u, dest):
+        """Return the DAG of all pure IGP shortest paths from u to dest,
+        as a dict mapping each of its nodes to their successors"""
+        nhs = self.towards(dest).nhs
+        if u not in nhs:
+            return {}
+        dag = {u: nhs[u]}
+        to_visit = [u]
+        while to_visit:
+            x = to_visit.pop()
+            for y in nhs[x]:
+                if y not in dag:
+                    dag[y] = nhs[y]
+                    to_visit.append(y)
+        return dag
+
+    def paths_to(self, u, dest):
+        """Iterate lazily over the pure IGP shortest paths from u to dest"""
+        nhs = self.towards(dest).nhs
+        if u not in nhs:
+            return
+        stack = [[u]]
+        while stack:
+            path = stack.pop()
+            x = path[-1]
+            if x == dest:
+                yield path
+                continue
+            for y in nhs[x]:
+                stack.append(path + [y])
+
+    @staticmethod
+    def in_tree_changed(dist, nhs, u, v, w):
+        """Return whether the new weight w of u->v (None if the edge is gone)
+        changes the in-tree given by the distance and next-hops of its
+        nodes"""
+        used = v in nhs.get(u, ())
+        v_dist = dist.get(v)
+        if w is None or v_dist is None:
+            return used
+        u_dist = dist.get(u)
+        new_dist = v_dist + w
+        if u_dist is None or new_dist < u_dist:
+            return True
+        elif new_dist == u_dist:
+            return not used
+        return used
+
+    @staticmethod
+    def default_weight(g, u, v):
+        """Return the metric of u->v as used by the non-fibbed SPT,
+        or None if that edge is not usable"""
+        try:
+            data = g[u][v]
+        except KeyError:
+            return None
+        return None if g.is_fake_route(u, v) else data.get(METRIC, 1)
+
+    def update_edge(self, graph, u, v):
+        """Repair the shortest-path trees after the edge u->v has been
+        added, removed, or had its metric changed in graph.
+        Only the parts of the trees that depend on that edge are recomputed.
+
+        :param graph: The graph, already holding the new state of u->v"""
+        self.__detach()
+        self.__detach_copies()
+        self._graph = graph
+        self._compact = None  # Outdated
+        if graph.is_prefix(v) or v in self._fibbed_dst:
+            # Only the forwarding towards v can have changed
+            self.update_fibbed(graph, v)
+        else:
+            self._fibbed.clear()
+        if not self._lazy:
+            for n in (u, v):
+                if n in graph and n not in self._trees:
+                    log.debug('Computing the SPT of the new node %s', n)
+                    self.__add_source(graph, n)
+        w = self.default_weight(graph, u, v)
+        for dest, tree in self._in_trees.items():
+            if self.in_tree_changed(tree.dist, tree.nhs, u, v, w):
+                log.debug('%s->%s changed the SPT towards %s', u, v, dest)
+                del self._in_trees[dest]
+        for src, tree in self._trees.iteritems():
+            changed = self.__repair_spt(graph, tree, src, u, v, w)
+            if changed:
+                log.debug('%s->%s changed the SPT of %s for %s',
+                          u, v, src, changed)
+                self.__invalidate(graph, tree, changed)
+
+    def __repair_spt(self, g, tree, src, u, v, w):
+        """Repair the SPT of src for the new weight w of u->v (None if the
+        edge is gone), and return the set of nodes whose predecessors
+        changed"""
+        dist, preds = tree.dist, tree.preds
+        if u not in dist or v == src:
+            return ()
+        was_used = u in preds.get(v, ())
+        if w is not None:
+            new_dist = dist[u] + w
+            old_dist = dist.get(v)
+            if old_dist is None or new_dist < old_dist:
+                return self.__decrease(g, dist, preds, u, v, new_dist)
+            elif new_dist == old_dist:
+                if was_used:
+                    return ()
+                preds[v].add(u)
+                return (v,)
+        if was_used:
+            return self.__increase(g, dist, preds, u, v)
+        return ()
+
+    def __decrease(self, g, dist, preds, u, v, d):
+        """Propagate the shorter distance d for v, using u as predecessor"""
+        dist[v] = d
+        preds[v] = set((u,))
+        changed = set((v,))
+        c = count()
+        fringe = [(d, next(c), v)]
+        while fringe:
+            (d, _, x) = heapq.heappop(fringe)
+            if d > dist[x]:
+                continue  # Stale entry
+            for y in g.successors_iter(x):
+                xy_weight = self.default_weight(g, x, y)
+                if xy_weight is None:
+                    continue
+                xy_dist = d + xy_weight
+                y_dist = dist.get(y)
+                if y_dist is None or xy_dist < y_dist:
+                    dist[y] = xy_dist
+                    preds[y] = set((x,))
+                    changed.add(y)
+                    heapq.heappush(fringe, (xy_dist, next(c), y))
+                elif xy_dist == y_dist and x not in preds[y]:
+                    preds[y].add(x)
+                    changed.add(y)
+        return changed
+
+    def __increase(self, g, dist, preds, u, v):
+        """Recompute the SPT parts that relied on u->v, which is either gone
+        or has a larger metric. Adapted from Ramalingam and Reps."""
+        preds[v].discard(u)
+        if preds[v]:  # v still has other ECMP paths with the same cost
+            return (v,)
+        # Find the nodes that lost all of their shortest paths
+        affected = set()
+        unaffected_preds = {}
+        to_visit = [v]
+        while to_visit:
+            x = to_visit.pop()
+            affected.add(x)
+            for y in g.successors_iter(x):
+                y_preds = preds.get(y)
+                if not y_preds or x not in y_preds or y in affected:
+                    continue
+                remaining = unaffected_preds.get(y, len(y_preds)) - 1
+                unaffected_preds[y] = remaining
+                if remaining == 0:
+                    to_visit.append(y)
+        changed = set(affected)
+        # Unaffected nodes can no longer use affected ones as their distance
+        # strictly increased
+        for x in affected:
+            del dist[x]
+            preds[x] = set()
+            for y in g.successors_iter(x):
+                if y not in affected and x in preds.get(y, ()):
+                    preds[y].discard(x)
+                    changed.add(y)
+        # Seed the affected nodes from their unaffected predecessors
+        c = count()
+        fringe = []
+        for x in affected:
+            for p in g.predecessors_iter(x):
+                if p in affected or p not in dist:
+                    continue
+                p_weight = self.default_weight(g, p, x)
+                if p_weight is None:
+                    continue
+                p_dist = dist[p] + p_weight
+                x_dist = dist.get(x)
+                if x_dist is None or p_dist < x_dist:
+                    dist[x] = p_dist
+                    preds[x] = set((p,))
+                elif p_dist == x_dist:
+                    preds[x].add(p)
+            if x in dist:
+                heapq.heappush(fringe, (dist[x], next(c), x))
+        # Then run Dijkstra restricted to the affected nodes
+        while fringe:
+            (d, _, x) = heapq.heappop(fringe)
+            if d > dist[x]:
+                continue
+            for y in g.successors_iter(x):
+                if y not in affected:
+                    continue
+                xy_weight = self.default_weight(g, x, y)
+                if xy_weight is None:
+                    continue
+                xy_dist = d + xy_weight
+                y_dist = dist.get(y)
+                if y_dist is None or xy_dist < y_dist:
+                    dist[y] = xy_dist
+                    preds[y] = set((x,))
+                    heapq.heappush(fringe, (xy_dist, next(c), y))
+                elif xy_dist == y_dist:
+                    preds[y].add(x)
+        for x in affected:
+            if x not in dist:
+                log.debug('%s is no longer reachable', x)
+                del preds[x]
+        return changed
+
+    @staticmethod
+    def __invalidate(g, tree, changed):
+        """Flush the first hops memoized for the changed nodes and for all the
+        nodes downstream of them in the tree"""
+        preds, nhs = tree.preds, tree.nhs
+        visited = set()
+        to_visit = list(changed)
+        while to_visit:
+            x = to_visit.pop()
+            if x in visited:
+                continue
+            visited.add(x)
+            nhs.pop(x, None)
+            to_visit.extend(y for y in g.successors_iter(x)
+                            if x in preds.get(y, ()))
+
+    def copy(self, graph=None):
+        """Return a copy of this object, whose trees can be extended (e.g.
+        by adding destinations) without altering this one.
+        The copy shares the trees and in-trees of this object, and has the
+        ones it is missing computed in it, until either of them is changed.
+
+        :param graph: Bind the copy to this graph instead, which must have
+                      the same topology (e.g. a copy of the original one)"""
+        spt = copy.copy(self)
+        if graph is not None:
+            spt._graph = graph
+        spt._parent = self if self._parent is None else self._parent
+        spt._parent._copies.add(spt)
+        spt._copies = weakref.WeakSet()
+        if self._parent is None:
+            spt._trees = LRUCache(self._trees.maxsize)
+            spt._in_trees = {}
+        else:
+            spt._trees = self._trees.copy()
+            for n, tree in self._trees.iteritems():
+                spt._trees[n] = _copy_tree(tree)
+            spt._in_trees = self._in_trees.copy()
+        spt._destinations = self._destinations.copy()
+        spt._fibbed_dst = self._fibbed_dst.copy()
+        spt._fibbed = self._fibbed.copy()
+        return spt
+
+    def __detach(self):
+        """Stop relying on the trees of the parent, by copying them"""
+        parent = self._parent
+        if parent is None:
+            return
+        self._parent = None
+        parent._copies.discard(self)
+        for n, tree in parent._trees.iteritems():
+            if n not in self._trees:
+                self._trees[n] = _copy_tree(tree)
+        for dest, tree in parent._in_trees.iteritems():
+            if dest not in self._destinations:
+                self._in_trees.setdefault(dest, tree)
+
+    def __detach_copies(self):
+        """Make the copies of this object stop relying on its trees, before
+        they are changed"""
+        for spt in list(self._copies):
+            spt.__detach()
+
+    def update_fibbed(self, graph, dest):
+        """Account for a change in the routes (real or fake) towards dest,
+        the forwarding towards it will be recomputed when next queried"""
+        self._graph = graph
+        self._fibbed.pop(dest, None)
+        if dest in graph and any(graph.is_fake_route(u, dest)
+                                 for u in graph.predecessors_iter(dest)):
+            self._fibbed_dst.add(dest)
+        else:
+            self._fibbed_dst.discard(dest)
+
+    def _fibbed_tree(self, dest):
+        """Return the forwarding towards the fibbed destination dest"""
+        try:
+            return self._fibbed[dest]
+        except KeyError:
+            log.debug('Computing the fibbed paths towards %s', dest)
+            tree = self._fibbed[dest] = self.__fibbed_spt_for_dst(dest)
+            return tree
+
+    def __fibbed_spt_for_dst(self, dest):
+        """Compute the actual used paths due to Fibbing.
+        ! the router to which a fake edge is attached does not use it"""
+        g = self._graph
+        real, lies, local_lies = {}, {}, collections.defaultdict(dict)
+        for u in g.predecessors_iter(dest):
+            m = g.metric(u, dest)
+            if not g.is_fake_route(u, dest):
+                real[u] = m
+            elif g.is_local_lie(u, dest):
+                for t in g[u][dest][LOCAL]:
+                    local_lies[t][u] = m
+            else:
+                lies[u] = m
+        # Every router that is not attached to a lie uses all routes
+        seeds = dict(real)
+        for u, m in lies.iteritems():
+            seeds[u] = min(m, seeds.get(u, sys.maxint))
+        cost, nhs = self._snapshot(g, dest).reverse_spt(seeds)
+        for u, m in real.iteritems():
+            if cost[u] == m:
+                nhs[u].add(dest)
+        # The routers with a global lie attached cannot use it, compute their
+        # path towards the other routes from their own SPT
+        for u in lies:
+            u_cost, u_nhs = real.get(u, sys.maxint), set()
+            if u_cost != sys.maxint:
+                u_nhs.add(dest)
+            for v, m in chain(real.iteritems(), lies.iteritems()):
+                if v == u:
+                    continue
+                c = self.default_cost(u, v)
+                if c == sys.maxint:
+                    continue
+                c += m
+                if c < u_cost:
+                    u_cost, u_nhs = c, set(self.first_hops(u, v))
+                elif c == u_cost:
+                    u_nhs |= self.first_hops(u, v)
+            if u_cost == sys.maxint:
+                cost.pop(u, None)
+                nhs.pop(u, None)
+            else:
+                cost[u], nhs[u] = u_cost, u_nhs
+        # Local lies are only seen by their targets, which forward directly to
+        # the router holding the private forwarding address
+        for t, t_lies in local_lies.iteritems():
+            for u, m in t_lies.iteritems():
+                w = self.default_weight(g, t, u)
+                if w is None:
+                    log.warning('Ignoring the local lie %s->%s for %s as '
+                                'they are not adjacent', u, dest, t)
+                    continue
+                c = w + m
+                t_cost = cost.get(t, sys.maxint)
+                if c < t_cost:
+                    cost[t], nhs[t] = c, set((u,))
+                elif c == t_cost:
+                    nhs[t].add(u)
+        cost[dest], nhs[dest] = 0, set()
+        return _FibbedTree(cost, nhs)
+
+    def fibbed_path_iter(self, u, v):
+        """Iterate over the paths actually followed by the traffic of u
+        towards v, as it is forwarded hop-by-hop by the routers"""
+        if v not in self._fibbed_dst:
+            for p in self.default_path_iter(u, v):
+                yield p
+            return
+        nhs = self._fibbed_tree(v).nhs
+        if u not in nhs:
+            return
+        stack = [[u]]
+        while stack:
+            path = stack.pop()
+            x = path[-1]
+            if x == v:
+                yield path
+                continue
+            for nh in nhs.get(x, ()):
+                if nh in path:
+                    log.warning('Forwarding loop towards %s: %s', v,
+                                path + [nh])
+                    continue
+                stack.append(path + [nh])
 
     def fibbed_path(self, u, v=None):
-        """Return the path, as seen by the routers, between u and v,
-        or a dictionary of all shortest-paths starting at u if v is None"""
-        return self._get(self._paths, u, v)
+        """Return the paths, as seen by the routers, between u and v,
+        or a dictionary of all paths starting at u if v is None"""
+        if v:
+            return list(self.fibbed_path_iter(u, v))
+        return {dst: list(self.fibbed_path_iter(u, dst))
+                for dst in self.fibbed_cost(u)}
 
     def fibbed_cost(self, u, v=None):
-        """Return the cost of the fibbed path between u and v,
-        or a dict of cost of all shortest-paths starting at u"""
-        return self._get(self._dist, u, v)
+        """Return the cost computed by u to reach v once the lies are
+        accounted for, or a dict of those costs for all destinations if v is
+        None"""
+        if not v:
+            costs = self.default_cost(u)
+            costs = costs.copy() if costs != sys.maxint else {}
+            for dst in self._fibbed_dst:
+                c = self.fibbed_cost(u, dst)
+                if c == sys.maxint:
+                    costs.pop(dst, None)
+                else:
+                    costs[dst] = c
+            return costs
+        if v not in self._fibbed_dst:
+            return self.default_cost(u, v)
+        return self._fibbed_tree(v).cost.get(u, sys.maxint)
+
+    def fibbed_first_hops(self, u, v):
+        """Return the set of next hops used by u to reach v once the lies
+        are accounted for"""
+        if v not in self._fibbed_dst:
+            return self.first_hops(u, v)
+        return self._fibbed_tree(v).nhs.get(u, set())
+
+    def default_path_iter(self, u, v):
+        """Iterate lazily over the pure IGP shortest paths between u and v"""
+        if v in self._destinations:
+            for p in self.paths_to(u, v):
+                yield p
+            return
+        try:
+            preds = self._tree(u).preds
+        except KeyError:
+            return
+        if v not in preds:
+            return
+        # Walk the predecessors DAG back from v, building reversed paths
+        stack = [[v]]
+        while stack:
+            rpath = stack.pop()
+            x = rpath[-1]
+            if x == u:
+                yield rpath[::-1]
+                continue
+            for p in preds[x]:
+                stack.append(rpath + [p])
 
     def default_path(self, u, v=None):
         """Return the paths of the pure IGP shortest path if Fibbing was not in
         use on the current network, between u an v or a dict of paths if v is
         None"""
+        if v:
+            return list(self.default_path_iter(u, v))
         try:
-            return self._get(self._default_paths, u, v)
+            self._tree(u)
         except KeyError as e:
             log.debug('%s had no path to %s (lookup key: %s)', u, v, e)
             return []
+        return {dst: list(self.default_path_iter(u, dst))
+                for dst in self.default_cost(u)}
+
+    def default_dag(self, u, v):
+        """Return the DAG of all pure IGP shortest paths between u and v,
+        as a dict mapping each of its nodes to their successors"""
+        if v in self._destinations:
+            return self.dag_to(u, v)
+        try:
+            preds = self._tree(u).preds
+        except KeyError:
+            return {}
+        if v not in preds:
+            return {}
+        dag = {v: set()}
+        to_visit = [v]
+        while to_visit:
+            x = to_visit.pop()
+            for p in preds[x]:
+                if p not in dag:
+                    dag[p] = set()
+                    to_visit.append(p)
+                dag[p].add(x)
+        return dag
+
+    def default_edges(self, u, v):
+        """Iterate over the edges of all pure IGP shortest paths between u
+        and v"""
+        for x, succ in self.default_dag(u, v).iteritems():
+            for y in succ:
+                yield x, y
+
+    def first_hops(self, u, v):
+        """Return the set of next hops used by u to reach v along its pure
+        IGP shortest paths"""
+        if v in self._destinations:
+            return self.successors_to(u, v)
+        try:
+            tree = self._tree(u)
+        except KeyError:
+            return set()
+        if v not in tree.preds or u == v:
+            return set()
+        try:
+            return tree.nhs[v]
+        except KeyError:
+            pass
+        # Resolve the next hops of v's predecessors first
+        preds, nhs = tree.preds, tree.nhs
+        stack = [v]
+        while stack:
+            x = stack[-1]
+            missing = [p for p in preds[x] if p != u and p not in nhs]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            x_nhs = set()
+            for p in preds[x]:
+                if p == u:
+                    x_nhs.add(x)
+                else:
+                    x_nhs |= nhs[p]
+            nhs[x] = x_nhs
+        return nhs[v]
+
+    def on_shortest_path(self, u, v, via):
+        """Return whether via is on at least one pure IGP shortest path
+        between u and v"""
+        cost = self.default_cost(u, v)
+        if cost == sys.maxint:
+            return False
+        return self.default_cost(u, via) + self.default_cost(via, v) == cost
 
     def default_cost(self, u, v=None):
         """Return the cost of the pure IGP shortest path if Fibbing was not in
         use on the current network, between u and v or a dict of cost if v
         is None"""
+        if v in self._destinations:
+            return self.cost_to(u, v)
         try:
-            return self._get(self._default_dist, u, v)
+            dist = self._tree(u).dist
+            if v:
+                return dist[v]
+            if self._destinations:
+                dist = dist.copy()
+                for dest in self._destinations:
+                    c = self.cost_to(u, dest)
+                    if c != sys.maxint:
+                        dist[dest] = c
+            return dist
         except KeyError as e:
             log.debug('%s had no path to %s (lookup key: %s)', u, v, e)
             return sys.maxint
 
     def __repr__(self):
+        sources = set(self._trees.keys())
+        if self._parent is not None:
+            sources.update(self._parent._trees.keys())
         return '\n'.join('%s -> %s: %s' % (src, dst, p)
-                         for src, d in self._default_paths.iteritems()
-                         for dst, paths in d.iteritems()
-                         for p in paths)
+                         for src in sources
+                         for dst in self.default_cost(src)
+                         for p in self.default_path_iter(src, dst))
+
+
+class SPTCache(object):
+    """A cache of shortest-path trees, shared across successive solves and
+    keyed by the version of the topology they were computed on. Changes in
+    the requirements thus reuse the previous trees, while changes in the
+    topology either repair them or invalidate them"""
+    def __init__(self, maxsize=2, **kw):
+        """:param maxsize: The number of topology versions to keep
+        :param kw: The parameters of the ShortestPath built on misses"""
+        self._cache = LRUCache(maxsize)
+        self._kw = kw
+
+    def get(self, graph):
+        """Return a private copy of the ShortestPath of graph, computing it
+        if its current version is unknown. The trees and in-trees that the
+        copy queries are computed in the cached ShortestPath, and thus
+        reused by the next copies"""
+        try:
+            spt = self._cache[graph.version]
+        except KeyError:
+            log.debug('Computing the SPT of topology version %d',
+                      graph.version)
+            spt = self._cache[graph.version] = ShortestPath(graph, **self._kw)
+        return spt.copy(graph)
+
+    def repair(self, graph, version, *edges):
+        """Move the ShortestPath of a previous version of graph to its
+        current version, by repairing it for the given changed edges
+
+        :param version: The version of graph before the change
+        :param edges: The (u, v) edges that were changed since"""
+        if version == graph.version:
+            return
+        spt = self._cache.pop(version, None)
+        if spt is None:
+            return
+        for u, v in edges:
+            spt.update_edge(graph, u, v)
+        self._cache[graph.version] = spt
+
+    def clear(self):
+        self._cache.clear()
+
+    def cache_info(self):
+        """Return the hit/miss/eviction statistics of the cache"""
+        return self._cache.cache_info()
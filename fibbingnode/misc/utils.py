@@ -168,3 +168,75 @@ def start_daemon_thread(target, name, *args, **kwargs):
     t = daemon_thread(target=target, name=name, *args, **kwargs)
     t.start()
     return t
+
+
+CacheInfo = collections.namedtuple('CacheInfo',
+                                   'hits misses evictions maxsize currsize')
+
+
+class LRUCache(object):
+    """A dictionary-like structure that holds at most maxsize items, and
+    evicts the least recently used ones when it overflows.
+    If maxsize is None, the cache is unbounded and never evicts items."""
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._items = {} if maxsize is None else collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def __getitem__(self, key):
+        try:
+            if self.maxsize is None:
+                value = self._items[key]
+            else:  # Move the item to the MRU position
+                value = self._items.pop(key)
+                self._items[key] = value
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if self.maxsize is not None:
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.keys())
+
+    def keys(self):
+        return self._items.keys()
+
+    def iteritems(self):
+        """Iterate over the cached items without updating their recency"""
+        return self._items.iteritems()
+
+    def pop(self, key, *default):
+        return self._items.pop(key, *default)
+
+    def clear(self):
+        self._items.clear()
+
+    def copy(self):
+        """Return a new cache with the same content and fresh statistics"""
+        c = LRUCache(self.maxsize)
+        c._items = self._items.copy()
+        return c
+
+    def cache_info(self):
+        """Return the cache statistics"""
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.maxsize, len(self._items))
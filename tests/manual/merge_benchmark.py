@@ -0,0 +1,83 @@
+"""Compare the time taken to merge the fake nodes of a requirement DAG,
+walking it depth-first or along each of its paths, on layered
+topologies whose number of paths is exponential in their width.
+
+Usage: python merge_benchmark.py [width [depth]]"""
+import sys
+import random
+import timeit
+import logging
+
+from fibbingnode import log
+import fibbingnode.algorithms.utils as ssu
+from fibbingnode.algorithms.merger import PartialECMPMerger, Node
+from fibbingnode.misc.igp_graph import IGPGraph
+
+log.setLevel(logging.WARNING)
+DEST = '10.0.0.0/24'
+
+
+def layered_topo(width, depth, seed=0):
+    """Build depth layers of width routers, fully connected between
+    successive layers with random metrics, the last one leading to D.
+    Also return the requirement DAG using all edges towards D"""
+    rand = random.Random(seed)
+    layers = [['%d_%d' % (l, i) for i in xrange(width)]
+              for l in xrange(depth)] + [['D']]
+    topo, dag = IGPGraph(), IGPGraph()
+    for up, down in zip(layers[:-1], layers[1:]):
+        for u in up:
+            for v in down:
+                for x, y in ((u, v), (v, u)):
+                    topo.add_edge(x, y, metric=rand.randint(1, 10))
+                dag.add_edge(u, v)
+    for n in topo:
+        topo.node[n]['router'] = True
+    topo.add_route('D', DEST, metric=1)
+    dag.add_edge('D', DEST)
+    return topo, dag
+
+
+class PathMerger(PartialECMPMerger):
+    """The merger walking the DAG along all of its paths"""
+    def merge_fake_nodes(self):
+        for path in ssu.dag_paths_from_leaves(self.dag, self.dest):
+            fake_nodes = [(idx, n) for idx, n in enumerate(path[:-1])
+                          if self.node(n).has_any_fake_node()]
+            for idx, (n_pos, n) in enumerate(fake_nodes[:-1]):
+                _, succ = fake_nodes[idx+1]
+                nh = path[n_pos + 1]
+                # Skip the pairs already merged on a previous path
+                if self.node(n).fake == Node.GLOBAL\
+                   and self.node(succ).fake == Node.GLOBAL\
+                   and nh in self.node(n).forced_nhs:
+                    self.merge(n, succ, nh)
+
+
+def run(solver, topo, dag):
+    timings = {}
+
+    def timed(f):
+        def inner():
+            start = timeit.default_timer()
+            f(solver)
+            timings['merge'] = timeit.default_timer() - start
+        return inner
+    solver.merge_fake_nodes = timed(solver.__class__.merge_fake_nodes)
+    lsas = solver.solve(topo, {DEST: dag.copy()})
+    return timings['merge'], sorted(lsas)
+
+
+def main(width=4, depth=6):
+    topo, dag = layered_topo(width, depth)
+    print 'Topology of %d nodes, requirement DAG with %d paths' % (
+        len(topo), width ** depth)
+    dp_time, dp_lsas = run(PartialECMPMerger(), topo, dag)
+    path_time, path_lsas = run(PathMerger(), topo, dag)
+    print 'Depth-first walk: %.3fs' % dp_time
+    print 'All paths:        %.3fs' % path_time
+    print 'Same LSAs: %s (%d)' % (dp_lsas == path_lsas, len(dp_lsas))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
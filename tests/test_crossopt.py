@@ -116,6 +116,9 @@ class CrossOptimizerTestCase(MergerTestCase):
         lsas = solver.solve(igp_topo, fwd_dags)
         self.assertTrue(check_fwd_dags(fwd_dags, igp_topo, lsas, solver))
         self.assertTrue(len(lsas) == expected_lsa_count)
+        totals = solver.stats.totals()
+        self.assertEqual(totals['cross_lsas_after'], len(lsas))
+        self.assertTrue(totals['cross_lsas_before'] >= len(lsas))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,615 @@
+import pickle
+import random
+import sys
+
+import pytest
+import networkx as nx
+
+import fibbingnode.algorithms.merger as merger
+import fibbingnode.algorithms.utils as ssu
+from fibbingnode.misc.igp_graph import (IGPGraph, ShortestPath,
+                                        CompactIGPGraph, SPTCache)
+from test_merger import Gadgets
+
+
+def same_paths(x, y):
+    return sorted(x) == sorted(y)
+
+
+def check_same_spt(spt, graph):
+    """Check that spt holds the same content as a freshly computed one"""
+    ref = ShortestPath(graph)
+    for src in graph:
+        assert spt.default_cost(src) == ref.default_cost(src)
+        ref_paths = ref.default_path(src)
+        paths = spt.default_path(src)
+        assert sorted(paths.keys()) == sorted(ref_paths.keys())
+        for dst, p in ref_paths.iteritems():
+            assert same_paths(paths[dst], p)
+
+
+@pytest.fixture(scope='function')
+def gadgets():
+    return Gadgets()
+
+
+@pytest.mark.parametrize('name', ['trap', 'diamond', 'square', 'paper_gadget',
+                                  'weird', 'parallel', 'ddiamond'])
+def test_incremental_spt(gadgets, name):
+    graph = getattr(gadgets, name)
+    graph.add_route(graph.nodes()[0], '1.2.3.0/24', metric=3)
+    spt = ShortestPath(graph)
+    rand = random.Random(name)
+    for _ in xrange(30):
+        u, v = rand.choice(graph.edges())
+        if not graph.is_router(v):
+            continue
+        action = rand.choice(('increase', 'decrease', 'flap'))
+        if action == 'increase':
+            graph.metric(u, v, graph.metric(u, v) + rand.randint(1, 10))
+            spt.update_edge(graph, u, v)
+        elif action == 'decrease':
+            graph.metric(u, v, max(1, graph.metric(u, v) -
+                                   rand.randint(1, 10)))
+            spt.update_edge(graph, u, v)
+        else:
+            metric = graph.metric(u, v)
+            graph.remove_edge(u, v)
+            spt.update_edge(graph, u, v)
+            check_same_spt(spt, graph)
+            graph.add_edge(u, v, metric=metric)
+            spt.update_edge(graph, u, v)
+        check_same_spt(spt, graph)
+
+
+def test_incremental_spt_new_node(gadgets):
+    graph = gadgets.trap
+    spt = ShortestPath(graph)
+    graph.add_router('N')
+    for u, v in (('N', 'R1'), ('R1', 'N'), ('N', 'D'), ('D', 'N')):
+        graph.add_edge(u, v, metric=1)
+        spt.update_edge(graph, u, v)
+        check_same_spt(spt, graph)
+
+
+def test_spt_copy_is_independent(gadgets):
+    graph = gadgets.trap
+    spt = ShortestPath(graph)
+    spt_copy = spt.copy()
+    graph = graph.copy()
+    graph.remove_edge('E1', 'D')
+    spt_copy.update_edge(graph, 'E1', 'D')
+    assert spt_copy.default_cost('E1', 'D') == 220
+    assert spt.default_cost('E1', 'D') == 10
+
+
+@pytest.mark.parametrize('name', ['trap', 'paper_gadget', 'weird',
+                                  'ddiamond'])
+def test_spt_copy_survives_repairs(gadgets, name):
+    graph = getattr(gadgets, name)
+    ref = graph.copy()
+    spt = ShortestPath(graph)
+    spt_copy = spt.copy(ref)
+    rand = random.Random(name)
+    for _ in xrange(10):
+        u, v = rand.choice(graph.edges())
+        if rand.random() < .5:
+            graph.metric(u, v, graph.metric(u, v) + rand.randint(1, 10))
+        else:
+            graph.remove_edge(u, v)
+        spt.update_edge(graph, u, v)
+        check_same_spt(spt_copy, ref)
+
+
+@pytest.mark.parametrize('cache_size', [None, 1, 3])
+def test_lazy_spt(gadgets, cache_size):
+    graph = gadgets.paper_gadget
+    ref = ShortestPath(graph)
+    spt = ShortestPath(graph, lazy=True, cache_size=cache_size)
+    assert spt.cache_info().currsize == 0
+    for src in graph:
+        for dst in graph:
+            assert spt.default_cost(src, dst) == ref.default_cost(src, dst)
+            assert same_paths(spt.default_path(src, dst),
+                              ref.default_path(src, dst))
+    info = spt.cache_info()
+    assert info.misses == len(graph)
+    if cache_size:
+        assert info.currsize == cache_size
+        assert info.evictions == len(graph) - cache_size
+    else:
+        assert info.currsize == len(graph)
+        assert info.evictions == 0
+    graph.metric('X', 'Y', 1)
+    spt.update_edge(graph, 'X', 'Y')
+    check_same_spt(spt, graph)
+
+
+@pytest.mark.parametrize('name', ['paper_gadget', 'ddiamond', 'parallel'])
+def test_spt_dag_queries(gadgets, name):
+    graph = getattr(gadgets, name)
+    spt = ShortestPath(graph)
+    for src in graph:
+        for dst in graph:
+            paths = spt.default_path(src, dst)
+            assert same_paths(list(spt.default_path_iter(src, dst)), paths)
+            edges = set((u, v) for p in paths for u, v in zip(p[:-1], p[1:]))
+            assert set(spt.default_edges(src, dst)) == edges
+            dag = spt.default_dag(src, dst)
+            assert set((u, v) for u, succs in dag.iteritems()
+                       for v in succs) == edges
+            assert sorted(spt.first_hops(src, dst)) ==\
+                sorted(set(p[1] for p in paths if len(p) > 1))
+            on_path = set(n for p in paths for n in p)
+            for n in graph:
+                assert spt.on_shortest_path(src, dst, n) == (n in on_path)
+
+
+@pytest.mark.parametrize('name', ['trap', 'paper_gadget', 'parallel'])
+def test_compact_graph(gadgets, name):
+    graph = getattr(gadgets, name)
+    graph.add_fake_route(graph.nodes()[0], '1.2.3.0/24', metric=3)
+    graph.add_local_route(graph.nodes()[1], '1.2.4.0/24', graph.nodes()[0])
+    cg = CompactIGPGraph(graph)
+    assert sorted(cg) == sorted(graph)
+    assert sorted(cg.routers) == sorted(graph.routers)
+    for u in graph:
+        assert sorted(cg.successors(u)) == sorted(graph.successors(u))
+        assert sorted(cg.real_neighbors(u)) == sorted(graph.real_neighbors(u))
+        for v in graph.successors_iter(u):
+            assert cg.metric(u, v) == graph.metric(u, v)
+            assert cg.is_fake_route(u, v) == graph.is_fake_route(u, v)
+            assert bool(cg.is_local_lie(u, v)) ==\
+                bool(graph.is_local_lie(u, v))
+    ref = ShortestPath(graph)
+    for src in graph:
+        dist, preds = cg.spt(src)
+        assert dist == ref.default_cost(src)
+        assert preds == ref._tree(src).preds
+
+
+def check_reduced(graph, seeds):
+    """Check that the shortest paths computed on the reduction of graph are
+    those computed on the whole graph"""
+    ref, cg = CompactIGPGraph(graph, reduce=False), CompactIGPGraph(graph)
+    for src in graph:
+        assert cg.spt(src) == ref.spt(src)
+    for s in seeds:
+        assert cg.reverse_spt(s) == ref.reverse_spt(s)
+    return cg
+
+
+def test_reduced_spt():
+    # A core (A, B, C, D) with stubs, chains, one-way links, a cycle
+    # without core node and a tree disconnected from the rest
+    graph = IGPGraph()
+    for u, v, metric in (('A', 'B', 1), ('B', 'C', 1), ('C', 'A', 3),
+                         ('A', 'D', 1), ('B', 'D', 2), ('C', 'D', 1),
+                         # A chain with ECMP through it
+                         ('A', 'X1', 1), ('X1', 'X2', 1), ('X2', 'C', 1),
+                         # A chain back to its end point
+                         ('D', 'Y1', 1), ('Y1', 'Y2', 2), ('Y2', 'D', 1),
+                         # Stubs, one hanging off the first chain
+                         ('B', 'S1', 1), ('S1', 'S2', 1), ('S1', 'S3', 2),
+                         ('X1', 'S4', 1),
+                         ('R1', 'R2', 1), ('R2', 'R3', 1), ('R3', 'R1', 1),
+                         ('T1', 'T2', 1)):
+        graph.add_edge(u, v, metric=metric)
+        graph.add_edge(v, u, metric=metric)
+    graph.add_edge('X2', 'X1', metric=5)
+    graph.remove_edge('Y1', 'D')
+    graph.remove_edge('S3', 'S1')
+    for r, p in (('A', 'p1'), ('S2', 'p2'), ('X2', 'p3'), ('R1', 'p4')):
+        graph.add_edge(r, p, metric=1)
+    graph.add_fake_route('S2', 'p1', metric=1)
+    cg = check_reduced(graph, (
+        {'p1': 0}, {'p2': 0}, {'p3': 0, 'S3': 2}, {'X2': 1, 'Y1': 0},
+        {'p4': 0, 'T2': 0}, {'A': 0, 'S1': 0}))
+    # The cycle without core node is kept
+    assert set(cg.names[x] for x in cg.reduction().adj) ==\
+        set(graph) - set(('A', 'B', 'C', 'D', 'R1', 'R2', 'R3'))
+
+
+def test_reduced_spt_random():
+    rand = random.Random(42)
+    for _ in xrange(200):
+        graph = IGPGraph()
+        nodes = range(rand.randint(2, 10))
+        for _ in xrange(2 * len(nodes)):
+            u, v = rand.sample(nodes, 2)
+            graph.add_edge(u, v, metric=rand.choice((1, 2, 3)))
+            if rand.random() < .8:
+                graph.add_edge(v, u, metric=rand.choice((1, 2, 3)))
+        # Hang paths off the nodes, closing some of them into chains
+        for _ in xrange(rand.randint(0, 5)):
+            u = rand.choice(nodes)
+            for _ in xrange(rand.randint(1, 3)):
+                v = len(graph)
+                graph.add_edge(u, v, metric=rand.choice((1, 2)))
+                graph.add_edge(v, u, metric=rand.choice((1, 2)))
+                u = v
+            if rand.random() < .5:
+                graph.add_edge(u, rand.choice(nodes), metric=1)
+        seeds = [{n: rand.randint(0, 2) for n in rand.sample(graph, 2)}
+                 for _ in xrange(3)]
+        check_reduced(graph, seeds)
+
+
+def test_reduced_spt_fallback(gadgets):
+    graph = gadgets.trap
+    assert CompactIGPGraph(graph).reduction() is None
+    graph.add_edge('X', graph.nodes()[0], metric=1)
+    assert CompactIGPGraph(graph).reduction()
+    assert CompactIGPGraph(graph, reduce=False).reduction() is None
+    graph.add_edge('Y', 'X', metric=0)
+    assert CompactIGPGraph(graph).reduction() is None
+
+
+def fibbed_forwarding(graph, dest):
+    """Compute the routes of each router towards dest by brute-force"""
+    real = graph.copy()
+    real.remove_edges_from(list(graph.fake_routes))
+    dist = nx.all_pairs_dijkstra_path_length(real, weight='metric')
+    costs, nhs = {dest: 0}, {dest: set()}
+    for r in graph.routers:
+        routes = []
+        for u in graph.predecessors_iter(dest):
+            m = graph.metric(u, dest)
+            if graph.is_local_lie(u, dest):
+                if r in graph[u][dest]['target'] and u in real[r]:
+                    routes.append((real.metric(r, u) + m, set((u,))))
+            elif graph.is_fake_route(u, dest) and u == r:
+                continue
+            elif u == r:
+                routes.append((m, set((dest,))))
+            elif u in dist[r]:
+                routes.append((dist[r][u] + m,
+                               set(s for s in real.routers
+                                   if s in real[r] and u in dist[s] and
+                                   real.metric(r, s) + dist[s][u] ==
+                                   dist[r][u])))
+        if not routes:
+            continue
+        costs[r] = min(c for c, _ in routes)
+        nhs[r] = set().union(*(h for c, h in routes if c == costs[r]))
+    return costs, nhs
+
+
+def check_fibbed(spt, graph, dest):
+    costs, nhs = fibbed_forwarding(graph, dest)
+    for r in graph.routers:
+        assert spt.fibbed_cost(r, dest) == costs.get(r, sys.maxint)
+        assert spt.fibbed_first_hops(r, dest) == nhs.get(r, set())
+
+
+def test_fibbed_spt(gadgets):
+    graph = gadgets.trap
+    graph.add_route('D', 'P', metric=1)
+    graph.add_fake_route('R2', 'P', metric=1)
+    spt = ShortestPath(graph)
+    check_fibbed(spt, graph, 'P')
+    # R1 is attracted by the lie, but R2 does not use its own
+    assert spt.fibbed_cost('R1', 'P') == 101
+    assert spt.fibbed_path('R1', 'P') == [['R1', 'R2', 'E2', 'D', 'P']]
+    assert spt.fibbed_path('R2', 'P') == [['R2', 'E2', 'D', 'P']]
+    # Make E2 do ECMP between D and R2, which creates a loop through R2
+    graph.add_local_route('R2', 'P', 'E2', metric=1)
+    spt.update_edge(graph, 'R2', 'P')
+    check_fibbed(spt, graph, 'P')
+    assert spt.fibbed_first_hops('E2', 'P') == set(('D', 'R2'))
+    assert spt.fibbed_path('E2', 'P') == [['E2', 'D', 'P']]
+    assert spt.fibbed_path('E1', 'P') == spt.default_path('E1', 'P')
+    # Removing the lie restores the default paths
+    graph.remove_edge('R2', 'P')
+    spt.update_edge(graph, 'R2', 'P')
+    assert spt.fibbed_path('R1', 'P') == spt.default_path('R1', 'P')
+
+
+@pytest.mark.parametrize('name', ['paper_gadget', 'ddiamond', 'parallel'])
+def test_fibbed_spt_random_lies(gadgets, name):
+    graph = getattr(gadgets, name)
+    rand = random.Random(name)
+    routers = graph.nodes()
+    for r in rand.sample(routers, 2):
+        graph.add_route(r, 'P', metric=rand.randint(1, 20))
+    spt = ShortestPath(graph)
+    for _ in xrange(10):
+        u = rand.choice(routers)
+        if graph.has_edge(u, 'P') and graph.is_fake_route(u, 'P'):
+            graph.remove_edge(u, 'P')
+        elif not graph.has_edge(u, 'P'):
+            m = rand.randint(1, 20)
+            if rand.random() < .5:
+                graph.add_fake_route(u, 'P', metric=m)
+            else:
+                graph.add_local_route(u, 'P', rand.sample(routers, 2),
+                                      metric=m)
+        spt.update_edge(graph, u, 'P')
+        check_fibbed(spt, graph, 'P')
+        check_fibbed(ShortestPath(graph), graph, 'P')
+
+
+def test_parallel_spt(gadgets):
+    graph = gadgets.paper_gadget
+    graph.add_route('X', 'P', metric=3)
+    check_same_spt(ShortestPath(graph, processes=2), graph)
+    ref = ssu.all_shortest_paths(graph)
+    for n, (paths, dist) in ssu.all_shortest_paths(graph,
+                                                   processes=2).iteritems():
+        assert dist == ref[n][1]
+        assert sorted(paths.keys()) == sorted(ref[n][0].keys())
+        for dst, p in paths.iteritems():
+            assert same_paths(p, ref[n][0][dst])
+
+
+@pytest.mark.parametrize('name', ['paper_gadget', 'square', 'ddiamond'])
+def test_spt_towards(gadgets, name):
+    graph = getattr(gadgets, name)
+    routers = graph.nodes()
+    graph.add_route(routers[0], 'P', metric=3)
+    spt = ShortestPath(graph)
+    # An added destination, only reachable through the new edges
+    for r in routers[1:3]:
+        graph.add_fake_route(r, 'Q', metric=5)
+    spt.add_destination(graph, 'Q', routers[1:3])
+    ref = graph.copy()
+    for r in routers[1:3]:
+        ref[r]['Q']['fake'] = False
+    ref_spt = ShortestPath(ref)
+    for dest in ('P', 'Q'):
+        for u in routers:
+            assert spt.cost_to(u, dest) == ref_spt.default_cost(u, dest)
+            assert spt.successors_to(u, dest) ==\
+                ref_spt.first_hops(u, dest)
+            assert same_paths(list(spt.paths_to(u, dest)),
+                              ref_spt.default_path(u, dest))
+            assert set((x, y) for x, succ in
+                       spt.dag_to(u, dest).iteritems() for y in succ) ==\
+                set(ref_spt.default_edges(u, dest))
+    # The in-trees follow the changes of the graph
+    rand = random.Random(name)
+    for _ in xrange(20):
+        u, v = rand.choice(ref.edges())
+        if not graph.is_router(v):
+            continue
+        m = rand.randint(1, 20)
+        for g in (graph, ref):
+            g.metric(u, v, m)
+        spt.update_edge(graph, u, v)
+        ref_spt = ShortestPath(ref)
+        for dest in ('P', 'Q'):
+            for x in routers:
+                assert spt.cost_to(x, dest) == ref_spt.default_cost(x, dest)
+                assert spt.successors_to(x, dest) ==\
+                    ref_spt.first_hops(x, dest)
+
+
+def check_indexes(graph):
+    """Check the role indexes of graph against full scans"""
+    nodes, edges = graph.nodes(), graph.edges()
+    assert graph.routers == set(filter(graph.is_router, nodes))
+    assert graph.prefixes == set(filter(graph.is_prefix, nodes))
+    assert graph.controllers == set(filter(graph.is_controller, nodes))
+    for name in ('route', 'real_route', 'fake_route', 'global_lie',
+                 'local_lie', 'router_link'):
+        predicate = getattr(graph, 'is_%s' % name)
+        expected = set(e for e in edges if predicate(*e))
+        index = getattr(graph, 'all_routes' if name == 'route' else
+                        '%ss' % name)
+        assert set(index) == expected
+
+
+def test_role_indexes(gadgets):
+    graph = gadgets.paper_gadget
+    check_indexes(graph)
+    graph.add_route('X', 'P1', metric=2)
+    graph.add_fake_route('Y', 'P1', metric=3)
+    graph.add_local_route('A1', 'P2', ['H1'])
+    graph.add_controller('C')
+    graph.add_edge('C', 'X')
+    check_indexes(graph)
+    # Attribute changes
+    graph['Y']['P1']['fake'] = False
+    graph.node['H3']['router'] = False
+    graph.node['P2'].update(prefix=False)
+    check_indexes(graph)
+    graph.node['P2']['prefix'] = True
+    del graph['A1']['P2']['target']
+    check_indexes(graph)
+    # Structural changes
+    graph.remove_edge('X', 'H2')
+    graph.remove_node('A2')
+    graph.contract('X', ['H2', 'H3'])
+    check_indexes(graph)
+    for g in (graph.copy(), graph.reverse(), graph.subgraph(['X', 'Y', 'P1']),
+              IGPGraph(graph), pickle.loads(pickle.dumps(graph))):
+        check_indexes(g)
+    # Copies are independent
+    g = graph.copy()
+    g.node['X']['router'] = False
+    assert graph.is_router('X') and 'X' in graph.routers
+    check_indexes(g)
+    # The properties are read-only views of the indexes
+    routers = graph.routers
+    graph.add_router('Z')
+    assert 'Z' in routers and not hasattr(routers, 'add')
+    assert routers & set(['Z', 'W']) == frozenset(['Z'])
+    graph.reverse(copy=False)
+    check_indexes(graph)
+    graph.clear()
+    check_indexes(graph)
+    assert not graph.routers
+
+
+def test_graph_version(gadgets):
+    graph = gadgets.trap
+    version = graph.version
+    # Copies share the version of their original until they diverge
+    g = graph.copy()
+    assert g.version == version
+    assert pickle.loads(pickle.dumps(graph)).version == version
+    graph.graph['name'] = 'trap'
+    graph.node['R1']['data'] = 42
+    assert graph.version == version
+    for change in (lambda x: x.metric('R1', 'R2', 5),
+                   lambda x: x.add_route('D', 'P'),
+                   lambda x: x.node['E1'].update(router=False),
+                   lambda x: x.remove_edge('E1', 'D'),
+                   lambda x: x.clear()):
+        change(graph)
+        assert graph.version != version
+        version = graph.version
+    g.metric('R1', 'R2', 5)
+    assert g.version != graph.version
+
+
+def test_spt_cache(gadgets):
+    graph = gadgets.paper_gadget
+    cache = SPTCache()
+    spt = cache.get(graph)
+    # Solves on the same topology reuse the trees, and cannot alter them
+    graph.add_route('X', 'P', metric=3)
+    g = graph.copy()
+    spt = cache.get(g)
+    g.add_route('Y', 'Q', metric=1)
+    spt.add_destination(g, 'Q', ['Y'])
+    assert spt.default_cost('Y', 'Q') == 1
+    assert cache.get(graph.copy()).default_cost('Y', 'Q') == sys.maxint
+    info = cache.cache_info()
+    assert (info.hits, info.misses) == (1, 2)
+    # Topology changes are either repaired or invalidate the trees
+    version = graph.version
+    graph.metric('X', 'Y', 1)
+    cache.repair(graph, version, ('X', 'Y'))
+    check_same_spt(cache.get(graph), graph)
+    graph.node['H1']['router'] = False
+    check_same_spt(cache.get(graph), graph)
+    info = cache.cache_info()
+    assert (info.hits, info.misses) == (2, 3)
+
+
+@pytest.mark.parametrize('kw', [{}, {'lazy': True}])
+def test_spt_cache_shares_trees(gadgets, monkeypatch, kw):
+    graph = gadgets.paper_gadget
+    graph.add_route('Y', 'P', metric=1)
+    cache = SPTCache(**kw)
+    dijkstra = []
+
+    def counted(f):
+        def wrapper(self, *args, **kwargs):
+            dijkstra.append(args)
+            return f(self, *args, **kwargs)
+        return wrapper
+
+    for name in ('spt', 'reverse_spt'):
+        monkeypatch.setattr(CompactIGPGraph, name,
+                            counted(getattr(CompactIGPGraph, name)))
+
+    def solve():
+        g = graph.overlay()
+        lsas = merger.PartialECMPMerger().solve(
+            g, {'P': IGPGraph([('H1', 'X'), ('X', 'Y'), ('A2', 'Y')])},
+            spt=cache.get(g))
+        assert lsas
+        return lsas
+
+    lsas = solve()
+    assert dijkstra
+    # The trees and in-trees queried by the first solve are kept in the
+    # cached ShortestPath
+    del dijkstra[:]
+    assert solve() == lsas
+    assert not dijkstra
+    # Repairing it does not alter the copies it gave
+    spt = cache.get(graph.copy())
+    spt.default_path('H1')
+    ref = graph.copy()
+    version = graph.version
+    graph.metric('X', 'Y', 1)
+    cache.repair(graph, version, ('X', 'Y'))
+    check_same_spt(spt, ref)
+    check_same_spt(cache.get(graph), graph)
+
+
+def test_overlay(gadgets):
+    graph = gadgets.paper_gadget
+    graph.add_route('X', 'P', metric=2)
+    ref = graph.copy()
+    g = graph.overlay()
+    assert g.version == graph.version
+    check_indexes(g)
+    # Changes to the overlay do not alter its base
+    g.add_fake_route('Y', 'P', metric=3)
+    g.add_local_route('A1', 'Q', ['H1'])
+    g.metric('X', 'H2', 42)
+    g['X']['P']['fake'] = True
+    g.node['H3']['router'] = False
+    g.remove_edge('A2', 'H2')
+    g.remove_node('H3')
+    check_indexes(g)
+    assert g.version != graph.version
+    assert g.metric('X', 'P') == 2 and g.is_fake_route('X', 'P')
+    assert not g.has_edge('A2', 'H2') and 'H3' not in g
+    check_indexes(graph)
+    assert sorted(graph.edges(data=True)) == sorted(ref.edges(data=True))
+    assert sorted(graph.nodes(data=True)) == sorted(ref.nodes(data=True))
+    # Overlays can be stacked, and copied into plain graphs
+    h = g.overlay()
+    h.add_edge('Y', 'H1', metric=7)
+    check_indexes(h)
+    assert not g.has_edge('Y', 'H1')
+    check_indexes(h.copy())
+    check_same_spt(ShortestPath(g), g.copy())
+
+
+def test_overlay_data_iteration(gadgets):
+    graph = gadgets.paper_gadget
+    ref = graph.copy()
+    routers = set(graph.routers)
+    g = graph.overlay()
+    # The attributes handed out by any accessor belong to the overlay
+    for _, data in g.nodes_iter(data=True):
+        data['router'] = False
+    for _, _, data in g.edges_iter(data=True):
+        data['metric'] = 42
+    for _, nbrs in g.succ.iteritems():
+        for data in nbrs.values():
+            data['metric'] = 43
+    for _, nbrs in g.pred.items():
+        for _, data in nbrs.iteritems():
+            data['fake'] = True
+    for data in g.node.values():
+        data['prefix'] = True
+    g.succ['X'].get('Y')['metric'] = 44
+    g.node.get('H1')['controller'] = True
+    check_indexes(g)
+    assert not g.routers and g.metric('X', 'Y') == 44
+    check_indexes(graph)
+    assert set(graph.routers) == routers
+    assert sorted(graph.edges(data=True)) == sorted(ref.edges(data=True))
+    assert sorted(graph.nodes(data=True)) == sorted(ref.nodes(data=True))
+
+
+def test_overlay_copies_on_write():
+    graph = IGPGraph()
+    for i in xrange(30):
+        graph.add_edge(i, i + 1, metric=1)
+        graph.add_edge(i + 1, i, metric=1)
+    for _, data in graph.nodes_iter(data=True):
+        data['router'] = True
+    graph.add_route(30, 'P', metric=1)
+    g = graph.overlay()
+
+    def owned():
+        return (set(g.node._owned), set(g.succ._owned), set(g.pred._owned))
+
+    # Reading the overlay, e.g. to solve requirements on it, copies nothing
+    CompactIGPGraph(g)
+    merger.PartialECMPMerger().solve(g, {'P': IGPGraph([(0, 1), (1, 2)])})
+    assert g.nodes(data=True) and g.edges(data=True)
+    assert owned() == (set(), set(), set())
+    # Changing an edge only copies it and the neighbors of its ends
+    g[3][4]['metric'] = 5
+    assert owned() == (set(), set([3]), set([4]))
+    assert g.pred[4][3]['metric'] == 5 and graph.metric(3, 4) == 1
+    assert g.succ[3]._owned == set([4]) and g.pred[4]._owned == set([3])
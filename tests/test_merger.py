@@ -3,13 +3,15 @@
 import sys
 import os
 import inspect
+import random
 import unittest
 import logging
 import collections
 from fibbingnode import log, fmt
 import fibbingnode.algorithms.merger as merger
 import fibbingnode.algorithms.utils as ssu
-from fibbingnode.misc.igp_graph import IGPGraph
+from fibbingnode.algorithms.ospf_simple import OSPFSimple
+from fibbingnode.misc.igp_graph import IGPGraph, CompactIGPGraph
 
 log.setLevel(logging.DEBUG)
 
@@ -128,6 +130,7 @@ class Gadgets():
         self._setUpWeird()
         self._setUpParallelTracks()
         self._setUpDoubleDiamond()
+        self._setUpFork()
 
     @staticmethod
     def _add_edge(g, src, dst, metric):
@@ -281,6 +284,24 @@ class Gadgets():
         for _, data in g.nodes_iter(data=True):
             data['router'] = True
 
+    def _setUpFork(self):
+        #      +--1-- B --1-- X --2--+
+        #     /        \             |
+        #    A          +-----1----- D
+        #     \        /             |
+        #      +--1-- C --1-- Y --2--+
+        self.fork = g = IGPGraph()
+        self._add_edge(g, 'A', 'B', 1)
+        self._add_edge(g, 'A', 'C', 1)
+        self._add_edge(g, 'B', 'D', 1)
+        self._add_edge(g, 'C', 'D', 1)
+        self._add_edge(g, 'B', 'X', 1)
+        self._add_edge(g, 'X', 'D', 2)
+        self._add_edge(g, 'C', 'Y', 1)
+        self._add_edge(g, 'Y', 'D', 2)
+        for _, data in g.nodes_iter(data=True):
+            data['router'] = True
+
 
 class MergerTestCase(unittest.TestCase):
     def __init__(self, *args, **kw):
@@ -452,6 +473,37 @@ class PartialECMPMergerTestCase(MergerTestCase):
                 expected_lsa_count)
 
 
+class PartialMergerTestCase(MergerTestCase):
+    def __init__(self, *args, **kw):
+        super(PartialMergerTestCase, self).__init__(*args, **kw)
+        self.solver_provider = merger.PartialMerger
+
+    def testForkWithOneChange(self, expected_lsa_count=3):
+        # A keeps its ECMP but only one of its paths has a fake node,
+        # it thus needs its own
+        self.log_test_name()
+        self._test(self.gadgets.fork,
+                   {'3_8': IGPGraph([('A', 'B'),
+                                     ('A', 'C'),
+                                     ('B', 'X'),
+                                     ('X', 'D'),
+                                     ('C', 'D'),
+                                     ('Y', 'D')])},
+                   expected_lsa_count)
+
+    def testForkWithTwoChanges(self, expected_lsa_count=2):
+        # Both paths of A have a fake node, which depend on each other
+        self.log_test_name()
+        self._test(self.gadgets.fork,
+                   {'3_8': IGPGraph([('A', 'B'),
+                                     ('A', 'C'),
+                                     ('B', 'X'),
+                                     ('X', 'D'),
+                                     ('C', 'Y'),
+                                     ('Y', 'D')])},
+                   expected_lsa_count)
+
+
 class FullMergerTestCase(MergerTestCase):
     def __init__(self, *args, **kw):
         super(FullMergerTestCase, self).__init__(*args, **kw)
@@ -498,6 +550,391 @@ class FullMergerTestCase(MergerTestCase):
     def testDoubleDiamond(self, expected_lsa_count=3):
         super(FullMergerTestCase, self).testDoubleDiamond(expected_lsa_count)
 
+
+class NoPathEnumerationMerger(merger.FullMerger):
+    """Fail on any enumeration of the IGP shortest paths"""
+    def solve_dest(self, dest, dag):
+        self._p.paths_to = self._no_paths_to
+        return super(NoPathEnumerationMerger, self).solve_dest(dest, dag)
+
+    @staticmethod
+    def _no_paths_to(u, dest):
+        raise AssertionError('Enumerated the paths from %s to %s' % (u, dest))
+
+
+class NoPathEnumerationTestCase(FullMergerTestCase):
+    def __init__(self, *args, **kw):
+        super(NoPathEnumerationTestCase, self).__init__(*args, **kw)
+        self.solver_provider = NoPathEnumerationMerger
+
+
+def explore_fake_neighbors(solver, node):
+    """List the global fake nodes reachable from node by exploring the
+    graph of solver"""
+    fakes, visited = set(), set()
+    to_visit = set(solver._cg.real_neighbors(node))
+    while to_visit:
+        n = to_visit.pop()
+        if n in visited:
+            continue
+        visited.add(n)
+        if solver.node(n).has_fake_node(subtype=merger.Node.GLOBAL):
+            fakes.add(n)
+        else:
+            to_visit |= set(solver._cg.real_neighbors(n))
+    return fakes
+
+
+class CheckedFakeNeighborsMerger(merger.PartialECMPMerger):
+    """Check the fake-neighbor regions against fresh explorations"""
+    def fake_neighbors(self, node):
+        fakes = super(CheckedFakeNeighborsMerger, self).fake_neighbors(node)
+        assert (set(n for n, _ in fakes) ==
+                explore_fake_neighbors(self, node))
+        return fakes
+
+
+class FakeNeighborsIndexTestCase(MergerTestCase):
+    def __init__(self, *args, **kw):
+        super(FakeNeighborsIndexTestCase, self).__init__(*args, **kw)
+        self.solver_provider = CheckedFakeNeighborsMerger
+
+
+class CheckedMemoMerger(merger.PartialECMPMerger):
+    """Check the memoized fixed nodes against fresh explorations"""
+    def fixed_nodes_for(self, n):
+        cached = super(CheckedMemoMerger, self).fixed_nodes_for(n)
+        del self._fixed_nodes[n]
+        assert cached == super(CheckedMemoMerger, self).fixed_nodes_for(n)
+        return cached
+
+
+class MemoTestCase(MergerTestCase):
+    def __init__(self, *args, **kw):
+        super(MemoTestCase, self).__init__(*args, **kw)
+        self.solver_provider = CheckedMemoMerger
+
+
+def path_walk_merges(solver):
+    """Merge the successive fake nodes along each path of the DAG, one path
+    at a time"""
+    for path in ssu.dag_paths_from_leaves(solver.dag, solver.dest):
+        fake_nodes = [(idx, n) for idx, n in enumerate(path[:-1])
+                      if solver.node(n).has_any_fake_node()]
+        for idx, (n_pos, n) in enumerate(fake_nodes[:-1]):
+            _, succ = fake_nodes[idx + 1]
+            node, nh = solver.node(n), path[n_pos + 1]
+            if node.fake == merger.Node.GLOBAL and\
+                    solver.node(succ).fake == merger.Node.GLOBAL and\
+                    nh in node.forced_nhs:
+                solver.merge(n, succ, nh)
+
+
+def random_instance(seed):
+    """Build a random topology, and a random requirement DAG towards one of
+    its prefixes"""
+    rand = random.Random(seed)
+    names = ['R%d' % i for i in xrange(rand.randint(4, 12))]
+    g = IGPGraph()
+    for i, n in enumerate(names[1:], 1):
+        Gadgets._add_edge(g, n, rand.choice(names[:i]), rand.randint(1, 5))
+    for _ in xrange(rand.randint(0, len(names))):
+        u, v = rand.sample(names, 2)
+        Gadgets._add_edge(g, u, v, rand.randint(1, 5))
+    for n in names:
+        g.node[n]['router'] = True
+    dest = '1_8'
+    sinks = rand.sample(names, rand.randint(1, 2))
+    for n in sinks:
+        g.add_route(n, dest, metric=1)
+    # Edges go towards the nodes closer to the sinks, in hops
+    rank = dict.fromkeys(sinks, 0)
+    to_visit = list(sinks)
+    while to_visit:
+        u = to_visit.pop(0)
+        for v in g.predecessors_iter(u):
+            if v in g.routers and v not in rank:
+                rank[v] = rank[u] + 1
+                to_visit.append(v)
+    order = {n: (rank[n], rand.random()) for n in names}
+    dag = IGPGraph([(n, dest) for n in sinks])
+    for u in names:
+        if u in sinks or rand.random() < .2:
+            continue
+        succs = [v for v in g.successors_iter(u)
+                 if v in order and order[v] < order[u]]
+        dag.add_edges_from((u, v) for v in rand.sample(
+            succs, min(len(succs), rand.randint(1, 2))))
+    return g, {dest: dag}
+
+
+class MergeOrderTestCase(unittest.TestCase):
+    def test_same_merges_as_path_walk(self):
+        for provider in (merger.PartialMerger, merger.PartialECMPMerger,
+                         merger.FullMerger):
+            walker = type('PathWalk', (provider,),
+                          {'merge_fake_nodes': path_walk_merges})
+            for seed in xrange(60):
+                g, reqs = random_instance(seed)
+                lsas = provider().solve(g, reqs)
+                g, reqs = random_instance(seed)
+                self.assertEqual(lsas, walker().solve(g, reqs),
+                                 '%s differs on instance %d' % (
+                                     provider.__name__, seed))
+
+    def test_overlay_requirements(self):
+        dag = IGPGraph([('H1', 'Y1'), ('H1', 'Y2'), ('Y1', 'X'), ('Y2', 'X'),
+                        ('H2', 'X'), ('X', 'D')])
+        lsas = merger.PartialECMPMerger().solve(Gadgets().ddiamond,
+                                                {'1_8': dag.copy()})
+        self.assertEqual(sorted(merger.PartialECMPMerger().solve(
+            Gadgets().ddiamond, {'1_8': dag.overlay()})), sorted(lsas))
+
+
+class RegionsTestCase(unittest.TestCase):
+    def test_one_way_links(self):
+        g = IGPGraph()
+        for u, v in (('A', 'B'), ('B', 'A'), ('B', 'C'), ('C', 'D'),
+                     ('D', 'C'), ('D', 'F'), ('C', 'E'), ('E', 'C')):
+            g.add_edge(u, v, metric=1)
+        for n in g:
+            g.node[n]['router'] = True
+        fakes = set(['E', 'F'])
+        regions = merger.Regions(CompactIGPGraph(g), fakes.__contains__)
+        self.assertEqual(regions.fake_nodes('A'), set(['E', 'F']))
+        # C cannot reach back {A, B}
+        self.assertEqual(regions.fake_nodes('E'), set(['E', 'F']))
+        fakes.add('C')
+        regions.changed('C')
+        self.assertEqual(regions.fake_nodes('A'), set(['C']))
+        self.assertEqual(regions.fake_nodes('D'), set(['C', 'F']))
+        fakes.difference_update(('C', 'F'))
+        regions.changed('C')
+        regions.changed('F')
+        self.assertEqual(regions.fake_nodes('B'), set(['E']))
+        self.assertEqual(regions.fake_nodes('C'), set(['E']))
+
+
+class BoundsTestCase(unittest.TestCase):
+    def test_views(self):
+        bounds = merger.Bounds(IGPGraph([('A', 'B'), ('A', 'C'), ('B', 'D'),
+                                         ('C', 'D')]))
+        a = bounds.node('A')
+        a.forced_nhs = ['B', 'C']
+        a.original_nhs = ['E']
+        self.assertEqual(a.forced_nhs, set(['B', 'C']))
+        self.assertEqual(a.original_nhs.symmetric_difference(a.forced_nhs),
+                         set(['B', 'C', 'E']))
+        # The bitsets number the neighbors of each node
+        self.assertEqual(a.dag_nhs, a.forced_nhs)
+        self.assertEqual(bounds.forced_nhs[bounds.ids['A']], 3)
+        self.assertEqual(bounds.original_nhs[bounds.ids['A']], 4)
+        # Across nodes, they are compared by name
+        self.assertEqual(bounds.node('B').dag_nhs, bounds.node('C').dag_nhs)
+        self.assertNotEqual(a.original_nhs, bounds.node('B').dag_nhs)
+        self.assertFalse(a.has_any_fake_node())
+        changed = []
+        bounds.listener = changed.append
+        a.add_fake_node()
+        a.lb += 5
+        a.remove_forced_nh('C')
+        self.assertEqual(changed, [a, a])
+        self.assertEqual(bounds.node('A').forced_nhs, set(['B']))
+        self.assertEqual((a.lb, a.fake), (5, merger.Node.GLOBAL))
+        self.assertTrue(a.has_fake_node(merger.Node.GLOBAL))
+        self.assertFalse(a.has_fake_node(merger.Node.LOCAL))
+        self.assertEqual(bounds.node('B').lb, merger.DEFAULT_LB)
+        # The nodes outside of the DAG are not allocated
+        self.assertEqual(sorted(n for n, _ in bounds.nodes()),
+                         ['A', 'B', 'C', 'D'])
+        self.assertFalse(bounds.node('E').has_any_fake_node())
+        a.remove_fake_node()
+        self.assertFalse(a.forced_nhs)
+
+    def test_transactions(self):
+        bounds = merger.Bounds(IGPGraph([('A', 'B'), ('A', 'C')]))
+        a = bounds.node('A')
+        a.forced_nhs = ['B', 'C']
+        a.add_fake_node()
+        bounds.add_ecmp_dep('A', 'A')
+        changed = []
+        bounds.listener = changed.append
+        bounds.begin()
+        a.lb, a.ub = 3, 10
+        a.remove_forced_nh('B')
+        bounds.begin()
+        a.remove_fake_node()
+        bounds.remove_ecmp_dep('A', 'A')
+        bounds.add_ecmp_dep('A', 'B')
+        bounds.commit()
+        self.assertEqual(bounds.ecmp['A'], set(['B']))
+        del changed[:]
+        bounds.rollback()
+        # All changes are reverted, including those of the inner one
+        self.assertEqual((a.lb, a.ub, a.fake), (merger.DEFAULT_LB,
+                                                merger.DEFAULT_UB,
+                                                merger.Node.GLOBAL))
+        self.assertEqual(a.forced_nhs, set(['B', 'C']))
+        self.assertEqual(bounds.ecmp['A'], set(['A']))
+        self.assertEqual(changed, [a])
+        self.assertEqual((bounds.transactions, bounds.rollbacks), (2, 1))
+
+    def test_merge_stats(self):
+        solver = merger.PartialECMPMerger()
+        dag = IGPGraph([('H1', 'Y1'), ('H1', 'Y2'), ('Y1', 'X'), ('Y2', 'X'),
+                        ('H2', 'X'), ('X', 'D')])
+        sequential = None
+        # The stats of a solve replace those of the previous one, and those
+        # of the workers are reported when solving in parallel
+        for processes in (1, 1, 2):
+            solver.processes = processes
+            solver.solve(Gadgets().ddiamond, collections.OrderedDict([
+                ('1_8', dag.copy()),
+                ('2_8', IGPGraph([('H1', 'Y2'), ('Y2', 'X'), ('X', 'D')]))]))
+            self.assertEqual(list(solver.stats.times), [None, '1_8', '2_8'])
+            self.assertEqual(
+                set(solver.stats.times['1_8']),
+                set(['check_dest', 'complete_dag', 'nexthops', 'place',
+                     'initialize', 'propagate', 'merge', 'remove',
+                     'create_lsas']))
+            counters = solver.stats.counters['1_8']
+            self.assertEqual((counters['merges_attempted'],
+                              counters['merges_applied'],
+                              counters['merges_undone']), (3, 3, 0))
+            self.assertTrue(counters['heap_ops'])
+            self.assertEqual(counters['lsas_after'], 3)
+            self.assertTrue(counters['lsas_before'] > 3)
+            self.assertTrue(counters['dag_include_spt_hits'])
+            self.assertTrue(counters['fixed_nodes_for_misses'])
+            if sequential is None:
+                sequential = dict(solver.stats.counters)
+            self.assertEqual(solver.stats.counters, sequential)
+            totals = solver.stats.totals()
+            self.assertEqual((totals['merges_attempted'],
+                              totals['merges_undone']), (4, 1))
+
+
+class ExpiringMerger(merger.PartialECMPMerger):
+    """Run out of time as soon as the fake nodes start being merged"""
+    def merge_fake_nodes(self):
+        self.deadline = 0
+        super(ExpiringMerger, self).merge_fake_nodes()
+
+
+class DeadlineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.gadgets = Gadgets()
+        self.dag = IGPGraph([('D2', 'B1'), ('B1', 'T1'), ('T1', 'T2'),
+                             ('T2', 'B2'), ('B2', 'D1')])
+
+    def reqs(self):
+        return {'3_8': self.dag.copy(),
+                '8_3': self.dag.reverse(copy=True)}
+
+    def test_expired_before_merging(self):
+        solver = merger.PartialECMPMerger(timeout=0)
+        topo = self.gadgets.square
+        lsas = solver.solve(topo, self.reqs())
+        self.assertEqual(solver.timed_out, set(['3_8', '8_3']))
+        self.assertTrue(check_fwd_dags(self.reqs(), topo, lsas, solver))
+        # The destinations fall back to the unmerged placement
+        simple = OSPFSimple()
+        simple.new_edge_metric = solver.new_edge_metric
+        self.assertEqual(sorted(lsas),
+                         sorted(simple.solve(Gadgets().square, self.reqs())))
+
+    def test_expired_while_merging(self):
+        solver = ExpiringMerger()
+        topo = self.gadgets.square
+        lsas = solver.solve(topo, self.reqs())
+        self.assertEqual(solver.timed_out, set(['3_8', '8_3']))
+        self.assertTrue(check_fwd_dags(self.reqs(), topo, lsas, solver))
+
+    def test_expired_in_workers(self):
+        solver = merger.PartialECMPMerger(processes=2, timeout=0)
+        lsas = solver.solve(self.gadgets.square, self.reqs())
+        self.assertEqual(solver.timed_out, set(['3_8', '8_3']))
+        self.assertEqual(len(lsas), 7)
+        # The workers report their statistics
+        self.assertEqual(solver.stats.totals()['timed_out'], 2)
+        self.assertEqual(solver.stats.totals()['lsas_after'], 7)
+
+    def test_in_time(self):
+        solver = merger.PartialECMPMerger(timeout=60)
+        lsas = solver.solve(self.gadgets.square, self.reqs())
+        self.assertFalse(solver.timed_out)
+        self.assertEqual(len(lsas), 5)
+
+
+class DestinationClassesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.gadgets = Gadgets()
+        self.dag = IGPGraph([('H1', 'Y1'), ('H1', 'Y2'), ('Y1', 'X'),
+                             ('Y2', 'X'), ('H2', 'X'), ('X', 'D')])
+
+    def test_solve_once(self):
+        reqs = collections.OrderedDict(('%d_8' % i, self.dag.copy())
+                                       for i in xrange(1, 4))
+        topo = self.gadgets.ddiamond
+        solver = merger.PartialECMPMerger()
+        lsas = solver.solve(topo, reqs)
+        self.assertEqual(list(solver.stats.times), [None, '1_8'])
+        self.assertEqual(solver.stats.counters['1_8']['equivalent_dests'], 2)
+        self.assertTrue(check_fwd_dags(reqs, topo, lsas, solver))
+        ref = merger.PartialECMPMerger().solve(Gadgets().ddiamond,
+                                               {'1_8': self.dag.copy()})
+        self.assertEqual(lsas, [lsa._replace(dest=dest) for dest in reqs
+                                for lsa in ref])
+
+    def test_timed_out_members(self):
+        solver = merger.PartialECMPMerger(timeout=0)
+        solver.solve(self.gadgets.ddiamond, {'1_8': self.dag.copy(),
+                                             '2_8': self.dag.copy()})
+        self.assertEqual(solver.timed_out, set(['1_8', '2_8']))
+
+
+class ParallelMerger(merger.PartialECMPMerger):
+    """Solve the destinations in two processes"""
+    def __init__(self):
+        super(ParallelMerger, self).__init__(processes=2)
+
+
+class ParallelMergerTestCase(MergerTestCase):
+    def __init__(self, *args, **kw):
+        super(ParallelMergerTestCase, self).__init__(*args, **kw)
+        self.solver_provider = ParallelMerger
+
+    def testSameResultsAsSequentialSolves(self):
+        self.log_test_name()
+        dag = IGPGraph([('D2', 'B1'),
+                        ('B1', 'T1'),
+                        ('T1', 'T2'),
+                        ('T2', 'B2'),
+                        ('B2', 'D1')])
+
+        def reqs():
+            return collections.OrderedDict([
+                ('3_8', dag.copy()),
+                ('8_3', dag.reverse(copy=True)),
+                ('4_8', IGPGraph([('T2', 'B2'), ('B2', 'D1')])),
+                ('5_8', IGPGraph([('T1', 'B1'), ('B1', 'D2')])),
+                ('6_8', dag.copy())])
+
+        for solver_provider in (merger.PartialECMPMerger, merger.FullMerger,
+                                OSPFSimple):
+            seq_reqs = reqs()
+            lsas = solver_provider().solve(self.gadgets.square.copy(),
+                                           seq_reqs)
+            for processes in (2, 3, 5):
+                par_reqs = reqs()
+                self.assertEqual(
+                    solver_provider(processes=processes).solve(
+                        self.gadgets.square.copy(), par_reqs), lsas)
+                # The DAGs are completed as in a sequential solve
+                for dest, completed in seq_reqs.iteritems():
+                    self.assertEqual(sorted(par_reqs[dest].edges()),
+                                     sorted(completed.edges()))
+
 if __name__ == '__main__':
     if HIDE_PASSING_LOGS:
         print '-' * 45
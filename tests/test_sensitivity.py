@@ -0,0 +1,76 @@
+import pytest
+
+from fibbingnode.algorithms.sensitivity import SensitivityIndex
+from fibbingnode.misc.igp_graph import (IGPGraph, CompactIGPGraph,
+                                        ShortestPath)
+from test_merger import Gadgets
+
+
+def change(index, graph, u, v, metric=None):
+    old = ShortestPath.default_weight(graph, u, v)
+    if metric is None:
+        graph.remove_edge(u, v)
+    else:
+        graph.add_edge(u, v, metric=metric)
+    return index.affected(graph, u, v, old)
+
+
+def test_sensitivity_index():
+    graph = Gadgets().square
+    graph.add_edge('D1', 'X', metric=1)
+    graph.add_edge('X', 'D1', metric=1)
+    index = SensitivityIndex()
+    compact = CompactIGPGraph(graph)
+    index.add(graph, compact, 'P', IGPGraph([('T1', 'T2'), ('T2', 'B2')]),
+              dag_local=True)
+    index.add(graph, compact, 'Q', IGPGraph([('B1', 'D2')]), dag_local=True)
+    assert len(index) == 2 and 'P' in index
+    # T1 -> B2 is on the shortest paths of T1 towards B2, B1 and D2
+    assert index.users('T1', 'B2') == set([('B2', 'T1'), ('P', 'T1'),
+                                           ('B1', 'T1'), ('D2', 'T1'),
+                                           ('Q', 'T1')])
+    # Increases of unused edges do not cross a tie
+    assert not change(index, graph, 'B2', 'D1', 200)
+    assert not change(index, graph, 'X', 'D1', 1)
+    # Decreases do once they reach one, T2 -> B2 -> B1 ties with T2 -> T1,
+    # while T2 -> B2 is in the DAG of P
+    assert not change(index, graph, 'B2', 'D1', 150)
+    assert change(index, graph, 'T2', 'B2', 15) == set(['P', 'Q'])
+    # Changing a used edge changes the distances
+    assert change(index, graph, 'B1', 'B2', 4) == set(['P'])
+    # Removals only affect the in-trees using the edge or the DAGs
+    assert change(index, graph, 'X', 'D1') == set(['P', 'Q'])
+    assert change(index, graph, 'B1', 'D2') == set(['Q'])
+    assert not change(index, graph, 'B2', 'D1')
+    index.remove('P')
+    assert 'P' not in index
+    assert index.users('T1', 'B2') == set([('B1', 'T1'), ('D2', 'T1'),
+                                           ('Q', 'T1')])
+    assert change(index, graph, 'T2', 'T1', 3) == set(['Q'])
+
+
+@pytest.mark.parametrize('dag_local', [True, False])
+def test_solver_footprint(dag_local):
+    graph = IGPGraph()
+    for u, v, metric in (('X', 'Z', 1), ('Z', 'Y', 1), ('X', 'M', 1),
+                         ('Y', 'N', 1), ('M', 'E', 1), ('M', 'F', 1),
+                         ('E', 'F', 10)):
+        graph.add_edge(u, v, metric=metric)
+        graph.add_edge(v, u, metric=metric)
+    for _, data in graph.nodes_iter(data=True):
+        data['router'] = True
+    index = SensitivityIndex()
+    index.add(graph, CompactIGPGraph(graph), 'P',
+              IGPGraph([('X', 'Z'), ('Z', 'Y')]), dag_local=dag_local)
+    # Unless the solver only uses the paths towards the nodes of the DAG,
+    # those towards their neighbors also matter, as well as the edges
+    # leaving the DAG and those letting its nodes reach each other
+    affected = set() if dag_local else set(['P'])
+    assert change(index, graph, 'X', 'M', 2) == affected
+    assert change(index, graph, 'Z', 'E', 5) == affected
+    assert change(index, graph, 'Z', 'E') == affected
+    # But remote edges are not
+    assert not change(index, graph, 'E', 'F')
+    assert not change(index, graph, 'E', 'F', 10)
+    # X now reaches Y without crossing Z, despite not using M -> N
+    assert change(index, graph, 'M', 'N', 100) == affected
@@ -17,5 +17,17 @@ class TestSimple(test_merger.MergerTestCase):
                                                    lsas,
                                                    solver))
 
+
+class ParallelSimple(smpl.OSPFSimple):
+    """Solve the destinations in two processes"""
+    def __init__(self):
+        super(ParallelSimple, self).__init__(processes=2)
+
+
+class TestParallelSimple(TestSimple):
+    def __init__(self, *args, **kwargs):
+        super(TestParallelSimple, self).__init__(*args, **kwargs)
+        self.solver_provider = ParallelSimple
+
 if __name__ == '__main__':
     unittest.main()
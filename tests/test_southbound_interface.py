@@ -0,0 +1,191 @@
+import collections
+
+import pytest
+
+import fibbingnode.algorithms.merger as merger
+import fibbingnode.algorithms.southbound_interface as sbi
+from fibbingnode.algorithms.ospf_simple import OSPFSimple
+from fibbingnode.misc.igp_graph import IGPGraph
+from test_merger import Gadgets
+
+
+class FakeSession(object):
+    """Stands for the connection to the southbound controller"""
+    def __init__(self, *args, **kw):
+        pass
+
+    def alive(self):
+        return True
+
+
+class FakeNodes(object):
+    """Record the LSAs sent to the southbound controller"""
+    def __init__(self, *args):
+        self.lsas = set()
+
+    def add(self, lsas):
+        self.lsas.update(lsas)
+
+    def remove(self, lsas):
+        self.lsas.difference_update(lsas)
+
+
+def recording(solver):
+    class RecordingSolver(solver):
+        """Record the prefixes whose requirements are solved"""
+        def __init__(self):
+            super(RecordingSolver, self).__init__()
+            self.solved = set()
+
+        def solve(self, topo, requirement_dags, spt=None, dests=None):
+            self.solved.update(requirement_dags if dests is None else dests)
+            return super(RecordingSolver, self).solve(
+                topo, requirement_dags, spt=spt, dests=dests)
+    return RecordingSolver
+
+
+RecordingSolver = recording(OSPFSimple)
+
+
+def make_manager(monkeypatch, g, solver=RecordingSolver):
+    monkeypatch.setattr(sbi, 'SJMPClient', FakeSession)
+    monkeypatch.setattr(sbi, 'ProxyCloner', FakeNodes)
+    m = sbi.SouthboundManager(optimizer=solver())
+    m.bootstrap_graph(g.edges(data=True), {})
+    return m
+
+
+@pytest.fixture(scope='function')
+def manager(monkeypatch):
+    # A remote part of the network, only used to reach D1
+    g = Gadgets().square
+    for u, v, metric in (('D1', 'X', 100), ('X', 'Y', 1), ('Y', 'Z', 1),
+                         ('X', 'Z', 1000)):
+        g.add_edge(u, v, metric=metric)
+        g.add_edge(v, u, metric=metric)
+    return make_manager(monkeypatch, g)
+
+
+def solved(m):
+    s = m.optimizer.solved
+    m.optimizer.solved = set()
+    return s
+
+
+def test_incremental_resolve(manager):
+    dag = IGPGraph([('D2', 'B1'), ('B1', 'T1'), ('T1', 'T2'), ('T2', 'B2'),
+                    ('B2', 'D1')])
+    manager.add_dag_requirement('3_8', dag)
+    assert solved(manager) == set(['3_8'])
+    # The other requirements reuse their solution
+    manager.add_dag_requirement('8_3', dag.reverse(copy=True))
+    assert solved(manager) == set(['8_3'])
+    assert set(manager.solver_stats.times) == set([None, '8_3'])
+    lsas = manager.advertized_lsa
+    assert lsas == manager.quagga_manager.lsas
+    assert set(lsa.dest for lsa in lsas) == set(['3_8', '8_3'])
+    # Edges unused towards the requirements do not trigger a solve
+    manager.add_edge('X', 'Z', {'metric': 500})
+    manager.add_edge('Z', 'X', {'metric': 500})
+    manager.commit()
+    assert not manager.affected_prefixes
+    assert not solved(manager)
+    assert manager.advertized_lsa == lsas
+    # While the others re-solve the affected requirements
+    manager.add_edge('T2', 'B2', {'metric': 1})
+    manager.add_edge('B2', 'T2', {'metric': 1})
+    manager.commit()
+    assert manager.affected_prefixes == set(['3_8', '8_3'])
+    assert solved(manager) == set(['3_8', '8_3'])
+    manager.remove_edge('X', 'Z')
+    manager.commit()
+    assert not manager.affected_prefixes
+    assert not solved(manager)
+    manager.remove_dag_requirement('8_3')
+    assert not solved(manager)
+    assert set(lsa.dest for lsa in manager.advertized_lsa) == set(['3_8'])
+    assert manager.advertized_lsa == manager.quagga_manager.lsas
+
+
+def test_bulk_requirements(manager):
+    dag = IGPGraph([('D2', 'B1'), ('B1', 'T1'), ('T1', 'T2'), ('T2', 'B2'),
+                    ('B2', 'D1')])
+    edges = sorted(dag.edges())
+    manager.add_dag_requirements_from({'3_8': dag, '8_3': dag})
+    assert solved(manager) == set(['3_8', '8_3'])
+    # The manager keeps its own copy of each requirement
+    assert manager.fwd_dags['3_8'] is not manager.fwd_dags['8_3']
+    assert sorted(dag.edges()) == edges
+    assert set(lsa.dest for lsa in manager.advertized_lsa) == set(['3_8',
+                                                                   '8_3'])
+
+
+@pytest.mark.parametrize('solver', [OSPFSimple, merger.PartialECMPMerger,
+                                    merger.FullMerger])
+def test_same_lsas_as_joint_solve(manager, solver):
+    manager.optimizer = solver()
+
+    def check():
+        # The requirements are solved in the order of fwd_dags
+        ref = solver().solve(manager.igp_graph.copy(),
+                             collections.OrderedDict(
+                                 (p, dag.copy())
+                                 for p, dag in manager.fwd_dags.iteritems()))
+        assert manager.advertized_lsa == set(ref)
+
+    dag = IGPGraph([('D2', 'B1'), ('B1', 'T1'), ('T1', 'T2'), ('T2', 'B2'),
+                    ('B2', 'D1')])
+    manager.add_dag_requirement('3_8', dag)
+    manager.add_dag_requirement('8_3', dag.reverse(copy=True))
+    check()
+    # Only 4_8 and the prefixes after it whose context changes are solved
+    manager.add_dag_requirement('4_8', IGPGraph([('T2', 'B2'),
+                                                 ('B2', 'D1')]))
+    manager.add_edge('X', 'Z', {'metric': 500})
+    manager.add_edge('Z', 'X', {'metric': 500})
+    manager.commit()
+    check()
+    manager.add_edge('T1', 'B1', {'metric': 4})
+    manager.add_edge('B1', 'T1', {'metric': 4})
+    manager.commit()
+    check()
+    manager.remove_dag_requirement('8_3')
+    check()
+
+
+def test_remote_flap(manager):
+    manager.optimizer = recording(merger.PartialECMPMerger)()
+    dag = IGPGraph([('D2', 'B1'), ('B1', 'T1'), ('T1', 'T2'), ('T2', 'B2'),
+                    ('B2', 'D1')])
+    manager.add_dag_requirement('3_8', dag)
+    assert solved(manager) == set(['3_8'])
+    lsas = manager.advertized_lsa
+    # X -> Z neither is on the shortest paths towards the DAG nor changes
+    # how its nodes reach each other
+    manager.remove_edge('X', 'Z')
+    manager.remove_edge('Z', 'X')
+    manager.commit()
+    manager.add_edge('X', 'Z', {'metric': 1000})
+    manager.add_edge('Z', 'X', {'metric': 1000})
+    manager.commit()
+    assert not manager.affected_prefixes
+    assert not solved(manager)
+    assert manager.advertized_lsa == lsas
+
+
+def test_context_changes(monkeypatch):
+    m = make_manager(monkeypatch, Gadgets().square,
+                     solver=recording(merger.PartialECMPMerger))
+    dag = IGPGraph([('D2', 'B1'), ('B1', 'T1'), ('T1', 'T2'), ('T2', 'B2'),
+                    ('B2', 'D1')])
+    m.fwd_dags = collections.OrderedDict()
+    m.add_dag_requirement('3_8', dag)
+    m.add_dag_requirement('8_3', dag.reverse(copy=True))
+    assert solved(m) == set(['3_8', '8_3'])
+    # 8_3 was solved with 3_8 attached to D1, which no longer has a single
+    # successor
+    m.remove_dag_requirement('3_8')
+    assert solved(m) == set(['8_3'])
+    ref = merger.PartialECMPMerger().solve(
+        m.igp_graph.copy(), {'8_3': dag.reverse(copy=True)})
+    assert m.advertized_lsa == set(ref)
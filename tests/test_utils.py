@@ -0,0 +1,103 @@
+import heapq
+import random
+import collections
+
+import pytest
+
+import fibbingnode.algorithms.utils as ssu
+from fibbingnode.misc.igp_graph import IGPGraph
+
+
+def test_indexed_max_heap():
+    rand = random.Random(42)
+    keys = {i: rand.randint(0, 20) for i in xrange(50)}
+    pq = ssu.IndexedMaxHeap((k, i) for i, k in keys.iteritems())
+    assert len(pq) == len(keys)
+    for _ in xrange(100):
+        i = rand.randrange(60)
+        if i in keys and rand.random() < .2:
+            pq.remove(i)
+            del keys[i]
+        else:
+            keys[i] = rand.randint(0, 20)
+            pq.push_or_update(keys[i], i)
+        assert i in keys or i not in pq
+    assert len(pq) == len(keys)
+    for i, k in keys.iteritems():
+        assert pq.key(i) == k
+    # Items are popped by decreasing (key, item)
+    ref = heapq.nlargest(len(keys), ((k, i) for i, k in keys.iteritems()))
+    assert [pq.pop() for _ in xrange(len(keys))] == ref
+    assert pq.is_empty()
+    with pytest.raises(IndexError):
+        pq.pop()
+    with pytest.raises(KeyError):
+        pq.remove(0)
+
+
+def test_indexed_max_heap_operations():
+    pq = ssu.IndexedMaxHeap([(1, 'a'), (2, 'b')])
+    assert pq.operations == 2
+    pq.push_or_update(3, 'a')
+    pq.push_or_update(0, 'c')
+    pq.pop()
+    pq.remove('c')
+    assert pq.operations == 6
+
+
+def test_next_hop_index():
+    index = ssu.NextHopIndex(IGPGraph([('A', 'B'), ('A', 'C'), ('B', 'C')]))
+    bits = index.bits('A', ['C', 'B'])
+    # The successors in the graph come first
+    assert bits == 3 and index.bits('A', ['B', 'C']) == bits
+    assert index.bits('A', ['D']) == 4
+    assert sorted(index.names('A', bits | 4)) == ['B', 'C', 'D']
+    assert index.bit('A', 'E') is None
+    # Each node has its own numbering
+    assert index.bits('B', ['C']) == index.bits('X', ['A']) == 1
+
+
+def test_solver_stats():
+    stats = ssu.SolverStats()
+    with stats.phase('prepare'):
+        pass
+    with pytest.raises(ValueError):
+        with stats.phase('solve', dest='a'):
+            raise ValueError()
+    stats.count('a', lsas=2)
+    other = ssu.SolverStats()
+    other.add_time('solve', 1, .5, dest='b')
+    other.add_time('solve', 1, .5, dest='b')
+    other.count('b', lsas=1)
+    stats.update(other)
+    assert list(stats.times) == [None, 'a', 'b']
+    assert stats.times['b'] == {'solve': [2, 1]}
+    assert list(stats.phase_totals()) == ['prepare', 'solve']
+    assert stats.phase_totals()['solve'][0] >= 2
+    assert stats.totals() == {'lsas': 3}
+    stats.clear()
+    assert not stats.times and not stats.totals()
+
+
+def test_destination_classes():
+    g = IGPGraph([('A', 'B'), ('B', 'C'), ('A', 'C')], metric=1)
+    for p, metric in (('p1', 1), ('p2', 1), ('p3', 2)):
+        g.add_edge('C', p, metric=metric)
+    dag = IGPGraph([('A', 'B'), ('B', 'C')])
+
+    def dag_to(dest):
+        d = dag.copy()
+        d.add_edge('C', dest)
+        return d
+
+    reqs = collections.OrderedDict([
+        ('p1', dag_to('p1')), ('p2', dag_to('p2')), ('p3', dag_to('p3')),
+        # Not in the graph, attached through the sinks of their DAG
+        ('q1', dag.copy()), ('q2', dag.copy()), ('q3', dag.reverse())])
+    assert ssu.destination_classes(g, reqs) == {'p1': ['p2'], 'p3': [],
+                                                'q1': ['q2'], 'q3': []}
+    # Destinations solved in different contexts are kept apart
+    contexts = dict.fromkeys(reqs, frozenset())
+    contexts['q2'] = frozenset(['C'])
+    assert ssu.destination_classes(g, reqs, contexts) == {
+        'p1': ['p2'], 'p3': [], 'q1': [], 'q2': [], 'q3': []}